@@ -0,0 +1,158 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=2
+'''
+_kernels
+========
+
+compiled kernels of the simulation (typed loops that release the GIL).
+They are used through the kernels module, which falls back to NumPy when
+this module is not built, and give the same output as the NumPy versions.
+The inputs are const memoryviews, so that read-only arrays (e.g. the
+memory-mapped results of the stage cache) can be passed; the outputs are
+new arrays.
+'''
+
+import numpy as np
+from libc.stdint cimport uint32_t, uint64_t
+
+ctypedef fused real:
+    float
+    double
+
+def pileup_starts(const double[:] tint_array, const long double[:] arrival, double window):
+    '''See kernels.pileup_starts'''
+    cdef Py_ssize_t n = arrival.shape[0], i, first = 0
+    cdef long double w = window
+    starts = np.zeros(n, dtype = np.uint8)
+    cdef unsigned char[:] st = starts
+    with nogil:
+        if n > 0:
+            st[0] = 1
+        for i in range(1, n):
+            if tint_array[i-1] >= window or arrival[i] >= arrival[first] + w:
+                st[i] = 1
+                first = i
+    return starts.view(bool)
+
+def histogram_rows(const double[:] values, const Py_ssize_t[:] offsets, const double[:] t, weights = None):
+    '''See kernels.histogram_rows'''
+    cdef Py_ssize_t nevents = offsets.shape[0] - 1, nbins = t.shape[0] - 1
+    cdef Py_ssize_t e, k, lo, idx
+    cdef double v, g, last = t[nbins], scale = nbins / (last - t[0]) if last > t[0] else 0.
+    cdef bint weighted = weights is not None
+    cdef const double[:] w
+    if weighted:
+        w = weights
+    hist = np.zeros((nevents, nbins))
+    cdef double[:, :] h = hist
+    with nogil:
+        for e in range(nevents):
+            for k in range(offsets[e], offsets[e+1]):
+                v = values[k]
+
+                if v != v:
+                    continue # nan
+
+                # number of edges <= v (numpy.searchsorted side right),
+                # guessed for evenly spaced edges and then corrected
+                g = (v - t[0]) * scale
+                if g < 0:
+                    lo = 0
+                elif g > nbins:
+                    lo = nbins + 1
+                else:
+                    lo = <Py_ssize_t> g
+                while lo <= nbins and t[lo] <= v:
+                    lo += 1
+                while lo > 0 and t[lo-1] > v:
+                    lo -= 1
+                idx = lo - 1
+                if v == last:
+                    idx = nbins - 1 # last bin includes the right edge
+                if idx >= 0 and idx < nbins:
+                    if weighted:
+                        h[e, idx] += w[k]
+                    else:
+                        h[e, idx] += 1.
+    return hist
+
+def one_pole(const real[:, :] rows, double b0, double b1, double a1):
+    '''See kernels.one_pole'''
+    cdef Py_ssize_t nrows = rows.shape[0], ncols = rows.shape[1], r, k
+    cdef real c0 = <real> b0, c1 = <real> b1, d1 = <real> a1, x, y, z
+    out = np.empty((nrows, ncols), dtype = np.float32 if real is float else np.float64)
+    cdef real[:, :] o = out
+    with nogil:
+        for r in range(nrows):
+            z = 0
+            for k in range(ncols):
+                x = rows[r, k]
+                y = z + c0 * x
+                o[r, k] = y
+                z = x * c1 - y * d1
+    return out
+
+def trigger_windows(const real[:, :] pulses, double threshold, Py_ssize_t samples, Py_ssize_t pretrig, Py_ssize_t ratio):
+    '''See kernels.trigger_windows'''
+    cdef Py_ssize_t n = pulses.shape[0], m = pulses.shape[1], r, k, i, j, src, ntrig = 0
+    cdef real th = <real> threshold
+    first = np.zeros(n, dtype = np.intp)
+    triggered = np.zeros(n, dtype = np.uint8)
+    cdef Py_ssize_t[:] fi = first
+    cdef unsigned char[:] tr = triggered
+    with nogil:
+        for r in range(n):
+            for k in range(m):
+                if pulses[r, k] >= th:
+                    tr[r] = 1
+                    fi[r] = k
+                    ntrig += 1
+                    break
+
+    rows = np.flatnonzero(triggered)
+    windows = np.empty((ntrig, samples), dtype = np.float32 if real is float else np.float64)
+    inside = np.empty((ntrig, samples), dtype = np.uint8)
+    cdef Py_ssize_t[:] ro = rows
+    cdef real[:, :] wi = windows
+    cdef unsigned char[:, :] ins = inside
+    with nogil:
+        for i in range(ntrig):
+            r = ro[i]
+            for j in range(samples):
+                src = fi[r] + (j - pretrig + 1) * ratio
+                if src >= 0 and src < m:
+                    wi[i, j] = pulses[r, src]
+                    ins[i, j] = 1
+                else:
+                    wi[i, j] = pulses[r, 0 if src < 0 else m - 1]
+                    ins[i, j] = 0
+    return triggered.view(bool), rows, windows, inside.view(bool)
+
+cdef inline void philox4x32(uint32_t* c, uint32_t k0, uint32_t k1) nogil:
+    cdef uint64_t p0, p1
+    cdef int r
+    for r in range(10):
+        p0 = <uint64_t> 0xD2511F53U * c[0]
+        p1 = <uint64_t> 0xCD9E8D57U * c[2]
+        c[0] = <uint32_t> (p1 >> 32) ^ c[1] ^ k0
+        c[2] = <uint32_t> (p0 >> 32) ^ c[3] ^ k1
+        c[1] = <uint32_t> p1
+        c[3] = <uint32_t> p0
+        k0 += 0x9E3779B9U
+        k1 += 0xBB67AE85U
+
+def philox_uniform(const uint64_t[:] key, const uint64_t[:] index, uint32_t stage, uint64_t seed):
+    '''See kernels.philox_uniform'''
+    cdef Py_ssize_t n = key.shape[0], i
+    cdef uint32_t c[4]
+    cdef uint32_t k0 = <uint32_t> seed, k1 = <uint32_t> (seed >> 32)
+    out = np.empty(n)
+    cdef double[:] o = out
+    with nogil:
+        for i in range(n):
+            c[0] = <uint32_t> index[i]
+            c[1] = stage
+            c[2] = <uint32_t> key[i]
+            c[3] = <uint32_t> (key[i] >> 32)
+            philox4x32(c, k0, k1)
+            o[i] = ((c[0] >> 6) * 67108864. + (c[1] >> 6) + 0.5) / 4503599627370496.
+    return out
@@ -0,0 +1,332 @@
+'''
+Analog
+======
+
+module with the combined response of the analog part of the acquisition
+chain (pmt and cable).
+
+The gaussian response of the pmt, the transit time, the conversion to current,
+the lowpass filter of the cable and its impedance are all linear and
+time-invariant. They are composed here into a single impulse response,
+so that the whole analog chain is one convolution of the photon histogram.
+Within the pulse window the result is the same as apply_pmt followed by
+apply_cable: the relative difference with respect to the pulse maximum
+is below TOLERANCE.
+
+The module also contains a grid-free engine (apply_analog_samples) that
+evaluates the pulses only at the digitizer sampling times, summing the
+closed-form response of each photoelectron.
+'''
+
+import numpy as np
+from scipy import signal, constants, special
+from pulsebatch import PulseBatch
+from pmt import pmt_kernel, histogram_batch, fft_convolve_rows, dynode_gain
+from cable import cable_filter
+from kernels import one_pole
+
+TOLERANCE = 1e-9 # agreement with the two-stage path (relative to the maximum)
+
+_kernels = {} # cache of the analog chain responses
+
+def analog_kernel(t, sigma = 5., transittime = 100., cutoff = 0.1, impedance = 50):
+    '''Impulse response of the pmt and cable, for one electron at the anode.
+    The response is calculated once for each input configuration and then cached.
+
+    Args:
+        t (numpy.array): time axis of the pulses
+
+    Kwargs:
+        sigma (float): the time spread of the gaussian response of the pmt [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        cutoff (float): cutoff of the cable filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+    Returns:
+        shift (int): the transit time in samples
+
+        h (numpy.array): the response [V], starting after the transit time.
+        The negligible tail (below 1e-12 of the maximum) is removed
+
+    '''
+    dt = t[1]-t[0]
+    key = (float(dt), len(t), float(sigma), float(transittime), float(cutoff), float(impedance))
+    if key not in _kernels:
+        shift = int(transittime/dt)
+        nout = max(len(t) - shift, 0)
+
+        # gaussian response converted to current
+        g = np.zeros(nout)
+        y = pmt_kernel(dt,sigma)[:nout]
+        g[:len(y)] = y * constants.e / (dt*1.e-9)
+
+        # cable filter
+        b, a = cable_filter(dt,cutoff,impedance)
+        h = signal.lfilter(b,a,g)
+
+        if len(h) > 0:
+            above = np.flatnonzero(np.abs(h) > 1e-12 * np.abs(h).max())
+            h = h[:above[-1]+1] if len(above) > 0 else h[:1]
+        h.flags.writeable = False
+        _kernels[key] = (shift, h)
+    return _kernels[key]
+
+def apply_analog_batch(batch, t, ndynodes = 10, delta = 4, sigma = 5., transittime = 100., cutoff = 0.1, impedance = 50, dtype = float, rng = None):
+    '''Applies the pmt and the cable to a batch of photon pulses with one
+    FFT convolution (same result as apply_pmt_batch followed by
+    apply_cable_batch, within TOLERANCE).
+
+    Args:
+        batch (PulseBatch): the photon pulses from the scintillator
+
+        t (numpy.array): the time axis of the pulses
+
+    Kwargs:
+        ndynodes (int): the number of  dynodes
+
+        delta (float): the average gain of the dynodes
+
+        sigma (float): the time spread of the gaussian response [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        cutoff (float): cutoff of the cable filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+        dtype (numpy.dtype): type of the pulses (see apply_pmt_batch)
+
+        rng (CounterRandom): random numbers of the dynode gain (see pmt.dynode_gain)
+
+    Returns:
+        newbatch (PulseBatch): the pulses at the end of the cable [V]
+
+    '''
+
+    # add poisson noise due to electron multiplication statistics
+    # -------
+
+    ww = dynode_gain(batch,ndynodes,delta,rng)
+
+    # histogram the data and convolve with the analog response
+    # -------
+
+    hist = histogram_batch(batch,t,ww,dtype)
+    shift, h = analog_kernel(t,sigma,transittime,cutoff,impedance)
+    newpulses = np.zeros((len(batch),len(t)), dtype = dtype)
+    if shift < len(t):
+        newpulses[:,shift:] = fft_convolve_rows(hist,h,len(t)-shift)
+
+    return PulseBatch.from_matrix(newpulses, batch.meta)
+
+def spe_response(x, sigma, tau):
+    '''Response to a single electron of a gaussian of width sigma followed
+    by a one-pole lowpass filter with time constant tau (exponentially
+    modified gaussian), normalized to unit area.
+
+    Args:
+        x (numpy.array): time from the center of the gaussian [ns]
+
+        sigma (float): width of the gaussian [ns]
+
+        tau (float): time constant of the filter [ns]
+
+    Returns:
+        g (numpy.array): the response [1/ns]
+
+    '''
+    z = (sigma/tau - x/sigma) / np.sqrt(2.)
+    return np.exp(-x**2 / (2*sigma**2)) * special.erfcx(z) / (2*tau)
+
+def spe_table(step, sigma, tau, xlo, xhi, nphase = 512):
+    '''Table of spe_response at the sampling times, for nphase + 1 phases
+    of the photon between two samples. The table is calculated once for
+    each set of parameters and then cached.
+
+    Args:
+        step (float): sampling period [ns]
+
+        sigma (float): width of the gaussian [ns]
+
+        tau (float): time constant of the filter [ns]
+
+        xlo (float): start of the table, from the center of the gaussian [ns]
+
+        xhi (float): the table covers at least up to xhi [ns]
+
+    Kwargs:
+        nphase (int): number of phases
+
+    Returns:
+        table (numpy.array): (nphase + 1 x width) array. Row i contains the
+        response at xlo + (i / nphase + j) * step, for j = 0, ..., width - 1
+
+    '''
+    key = ('spe', float(step), float(sigma), float(tau), float(xlo), float(xhi), nphase)
+    if key not in _kernels:
+        width = int(np.ceil((xhi - xlo) / step)) + 1
+        x = xlo + (np.arange(nphase + 1)[:,np.newaxis] / float(nphase) + np.arange(width)) * step
+        table = spe_response(x, sigma, tau)
+        table.flags.writeable = False
+        _kernels[key] = table
+    return _kernels[key]
+
+def spe_parameters(dt, sigma = 5., transittime = 100., cutoff = 0.1, impedance = 50):
+    '''Parameters of the response to one photoelectron (see spe_response)
+    equivalent to the fine-grid chain of time step dt: the gaussian kernel
+    is centered 5 sigma after the transit time (see apply_pmt) and the
+    time constant gives the same decay as the digital filter of the cable.
+
+    Args:
+        dt (float): time step of the fine-grid chain [ns]
+
+    Kwargs:
+        sigma (float): the time spread of the gaussian response [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        cutoff (float): cutoff of the cable filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+    Returns:
+        tau (float): time constant of the filter [ns]
+
+        delay (float): time from the photon to the center of the gaussian [ns]
+
+    '''
+    a = cable_filter(dt,cutoff,impedance)[1]
+    tau = -dt / np.log(-a[1])
+    delay = 5*sigma + int(transittime/dt)*dt
+    return tau, delay
+
+def spe_samples(times, scale, step, sigma, tau, nsigma = 5.):
+    '''Response of photoelectrons at the samples near each of them,
+    interpolated from the table spe_table, and start of the exponential
+    tail after the table.
+
+    Args:
+        times (numpy.array): times of the centers of the gaussians, from
+        the first sample [ns]
+
+        scale (numpy.array): area of the response of each photoelectron
+
+        step (float): sampling period [ns]
+
+        sigma (float): width of the gaussian [ns]
+
+        tau (float): time constant of the filter [ns]
+
+    Kwargs:
+        nsigma (float): half width of the tabulated region [sigma]
+
+    Returns:
+        k0 (numpy.array): first sample of the response of each photoelectron
+
+        values (numpy.array): (photons x width) response at the samples
+        k0, ..., k0 + width - 1
+
+        start (numpy.array): response at the sample k0 + width, after which
+        the response decays with time constant tau
+
+    '''
+    xlo, xhi = -nsigma*sigma, sigma**2/tau + nsigma*sigma
+    table = spe_table(step, sigma, tau, xlo, xhi)
+    nphase, width = table.shape[0] - 1, table.shape[1]
+    k0 = np.ceil((times + xlo) / step).astype(int)
+    u = ((k0 * step - times - xlo) / step) * nphase
+    i = np.minimum(u.astype(int), nphase - 1)
+    f = (u - i)[:,np.newaxis]
+    values = (table[i] * (1 - f) + table[i+1] * f) * scale[:,np.newaxis]
+    xt = (k0 + width) * step - times
+    start = scale * np.exp(sigma**2 / (2*tau**2) - xt/tau) / tau
+    return k0, values, start
+
+def apply_analog_samples(batch, tk, dt = 0.05, ndynodes = 10, delta = 4, sigma = 5., transittime = 100., cutoff = 0.1, impedance = 50, nsigma = 5., dtype = float,
+                         rng = None):
+    '''Grid-free version of apply_analog_batch: evaluates the pulses
+    at the times tk only (e.g. the digitizer samples), instead of on the
+    fine time axis.
+
+    Each photoelectron contributes the closed-form response spe_response,
+    with the same delay, time constant and gain as the fine-grid chain of
+    time step dt. Near the photon (within nsigma) the response is
+    interpolated from a cached table (see spe_table); the exponential tail
+    of all the photons is then accumulated with a one-pole recursion over
+    the samples.
+    At the sampling times the result agrees with apply_pmt_batch followed
+    by apply_cable_batch to better than 1e-4 of the pulse maximum (see
+    tests/test_analog.py).
+
+    Args:
+        batch (PulseBatch): the photon pulses from the scintillator
+
+        tk (numpy.array): the sampling times, equally spaced and starting at 0 [ns]
+
+    Kwargs:
+        dt (float): time step of the equivalent fine-grid chain [ns]
+
+        ndynodes (int): the number of  dynodes
+
+        delta (float): the average gain of the dynodes
+
+        sigma (float): the time spread of the gaussian response [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        cutoff (float): cutoff of the cable filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+        nsigma (float): half width of the tabulated region [sigma]
+
+        dtype (numpy.dtype): type of the pulses
+
+        rng (CounterRandom): random numbers of the dynode gain (see pmt.dynode_gain)
+
+    Returns:
+        newbatch (PulseBatch): the pulses at the end of the cable at the
+        times tk [V]
+
+    '''
+
+    # add poisson noise due to electron multiplication statistics
+    # -------
+
+    ww = dynode_gain(batch,ndynodes,delta,rng)
+
+    # parameters of the equivalent fine-grid chain
+    # -------
+
+    tau, delay = spe_parameters(dt,sigma,transittime,cutoff,impedance)
+    scale = ww * impedance * constants.e * 1.e9
+
+    nevents, nsamples = len(batch), len(tk)
+    step = tk[1] - tk[0]
+    times = batch.values[batch.offsets[0]:batch.offsets[-1]] + delay
+    event = batch.event_index()
+
+    # response near each photon, from the precomputed table
+    # -------
+
+    k0, values, start = spe_samples(times, scale, step, sigma, tau, nsigma)
+    width = values.shape[1]
+    k = k0[:,np.newaxis] + np.arange(width)
+    inside = (k >= 0) & (k < nsamples)
+    index = (event[:,np.newaxis] * nsamples + k)[inside]
+    newpulses = np.bincount(index, weights=values[inside], minlength=nevents*nsamples)
+    del values, k, inside, index
+
+    # exponential tail, starting from the first sample after the table
+    # -------
+
+    kt = k0 + width
+    inside = kt < nsamples
+    tail = np.bincount(event[inside] * nsamples + kt[inside], weights=start[inside], minlength=nevents*nsamples)
+    tail = one_pole(tail.reshape(nevents,nsamples), [1.], [1., -np.exp(-step/tau)])
+
+    newpulses = (newpulses.reshape(nevents,nsamples) + tail).astype(dtype, copy = False)
+    return PulseBatch.from_matrix(newpulses, batch.meta)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+'''
+benchmark
+=========
+
+Benchmark suite of dacsim
+-------------------------
+
+Times each stage of the simulation (scintillator pulse shapes, generation of
+the pulses, pile-up, pmt, cable, noise, digitizer and output) and the full
+run, for a base configuration and for sweeps of nps, dt, count rate
+(cre/crp), ptype and samples. Each configuration (point) runs in a separate
+process, so that the peak memory of each point is measured independently.
+
+For each point the results contain:
+
+ - stages: time of each stage [s] (minimum over the repetitions)
+ - total: time of the full run, excluding the start of the interpreter [s]
+ - events_per_s, photons_per_s: throughput of the full run
+ - peak_rss_mb: peak resident memory of the process [MB]
+
+The results are saved as JSON. If a baseline (a previous results file)
+is given, the times are compared with it and the stages that are slower
+than the baseline by more than the tolerance are flagged; the exit status
+is then 1.
+
+Usage::
+
+    ./dacsim_benchmark [-o results.json] [-b baseline.json] [-t 0.2]
+                       [-r 3] [--quick] [--only nps,dt]
+
+Options:
+
+ - -o: output file. Default benchmark.json
+ - -b: baseline file to compare with
+ - -t: tolerance on the ratio of the times (0.2 flags a stage 20% slower).
+   Differences below 5 ms are not flagged
+ - -r: number of repetitions of each point
+ - --quick: fewer pulses, for a fast check
+ - --only: comma separated list of sweeps to run ("base" for the base point)
+
+The baseline should be produced on the same machine, since the times
+depend on the hardware.
+'''
+
+import sys, os, time, json, argparse, resource, subprocess, tempfile, shutil, platform
+
+benchmark_path = os.path.dirname(os.path.realpath(__file__))
+
+# Add path to modules
+# ------
+
+modules_path = benchmark_path + '/src/'
+if os.path.isdir(modules_path):
+    sys.path.insert(0,modules_path)
+
+import numpy as np
+import scipy
+from scintillator import load_coefficients
+from edist import load_energy_spectrum
+from pileup import apply_pileup
+from pmt import apply_pmt_batch
+from cable import apply_cable_batch, apply_noise_batch
+from digitize import digitize_batch
+from analog import apply_analog_batch, apply_analog_samples
+from simulation import pulse_shapes, particle_counts, generate_batch, PRECISIONS
+from output import OutputWriter
+
+# base configuration (same as the example input of dacsim)
+BASE = {'nps': 1000, 'ptype': 'electron', 'cre': 200000, 'crp': 100000, 'output': 'benchmark',
+        'dt': 0.05, 'lc': 0.7, 'qeff': 0.26, 'k': 10.,
+        'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+        'cutoff': 0.2, 'imp': 50, 'noise': 0.01,
+        'bits': 12, 'minV': -0.1, 'maxV': 1.2, 'sampf': 0.4, 'samples': 256,
+        'th_on': 1, 'th_lvl': 50, 'pretrig_samp': 64, 'fp': 0}
+
+# parameters changed in each sweep
+SWEEPS = {'nps': [{'nps': n} for n in [250, 1000, 4000]],
+          'dt': [{'dt': dt} for dt in [0.1, 0.05, 0.025]],
+          'rate': [{'cre': cr, 'crp': cr / 2} for cr in [20000, 200000, 2000000]],
+          'ptype': [{'ptype': p} for p in ['electron', 'proton', 'all']],
+          'samples': [{'samples': s} for s in [128, 256, 512]]}
+
+STAGES = ['scintillator', 'generate', 'pileup', 'pmt', 'cable', 'noise', 'digitize', 'save']
+
+def point_name(params):
+    '''Name of a point, from the parameters that differ from BASE'''
+    changed = sorted((key, value) for key, value in params.items() if BASE.get(key) != value)
+    if len(changed) == 0:
+        return 'base'
+    return ','.join('%s=%s' % (key, value) for key, value in changed)
+
+def run_point(inp_dict):
+    '''Runs the simulation for one input dictionary, timing each stage.
+    The stages are the same as in dacsim (in memory, without streaming).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        result (dict): the times of the stages [s], the time of the full
+        run [s], the number of events and photons and the peak memory [MB]
+
+    '''
+    np.random.seed(inp_dict.get('seed', 0))
+    stages = {}
+    def timed(name, func, *args, **kwargs):
+        t0 = time.time()
+        res = func(*args, **kwargs)
+        stages[name] = stages.get(name, 0.) + time.time() - t0
+        return res
+
+    coeff_dict = load_coefficients()
+    energy, intensity = {}, {}
+    for ptype in ['electron', 'proton']:
+        energy[ptype], intensity[ptype] = load_energy_spectrum(ptype)
+
+    start = time.time()
+    plen = float(inp_dict['samples'])/inp_dict['sampf']
+    t, scint_dict = timed('scintillator', pulse_shapes, coeff_dict, inp_dict['dt'], plen)
+    tot_cr = inp_dict['cre'] + inp_dict['crp']
+
+    batch = timed('generate', generate_batch, particle_counts(inp_dict, inp_dict['nps']), t, scint_dict, energy, intensity, inp_dict)
+    nphot = len(batch.values)
+    batch, pileup_log, time_int = timed('pileup', apply_pileup, batch, tot_cr, plen)
+
+    dtype = PRECISIONS[inp_dict.get('precision','double')]
+    args = (inp_dict['ndyn'], inp_dict['delta'], inp_dict['sigma'], inp_dict['tt'])
+    if inp_dict.get('engine','grid') == 'samples':
+        tk = np.arange(0, t[-1] + (t[1]-t[0]), 1./inp_dict['sampf'])
+        batch = timed('analog', apply_analog_samples, batch, tk, t[1]-t[0], *(args + (inp_dict['cutoff'], inp_dict['imp'])), dtype = dtype)
+        t = tk
+    elif inp_dict.get('fused',0) == 1:
+        batch = timed('analog', apply_analog_batch, batch, t, *(args + (inp_dict['cutoff'], inp_dict['imp'], dtype)))
+    else:
+        batch = timed('pmt', apply_pmt_batch, batch, t, *(args + (dtype,)))
+        batch = timed('cable', apply_cable_batch, batch, t, inp_dict['cutoff'], inp_dict['imp'])
+    batch = timed('noise', apply_noise_batch, batch, inp_dict['noise'])
+    pulses_dig, triggered = timed('digitize', digitize_batch, batch, t, inp_dict['bits'], [inp_dict['minV'],inp_dict['maxV']],
+                                  inp_dict['sampf'], inp_dict['samples'], inp_dict['th_on'], inp_dict['th_lvl'],
+                                  inp_dict['pretrig_samp'], inp_dict['noise'])
+    del batch
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        def save():
+            writer = OutputWriter(os.path.join(tmpdir, inp_dict['output']), inp_dict['samples'], inp_dict['bits'], {'inp_dict': inp_dict})
+            writer.append(pulses_dig)
+            writer.append_time_int(time_int)
+            writer.close()
+        timed('save', save)
+    finally:
+        shutil.rmtree(tmpdir)
+    total = time.time() - start
+
+    return {'stages': stages, 'total': total, 'events': int(inp_dict['nps']), 'photons': nphot,
+            'events_per_s': inp_dict['nps'] / total, 'photons_per_s': nphot / total,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+def benchmark_point(params, repeat = 3):
+    '''Runs one point of the benchmark in separate processes (one per
+    repetition) and keeps the fastest time of each stage.
+
+    Args:
+        params (dict): the input parameters
+
+    Kwargs:
+        repeat (int): number of repetitions
+
+    Returns:
+        result (dict): see run_point
+
+    '''
+    best = None
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, os.path.realpath(__file__), '--point', json.dumps(params)])
+        res = json.loads(out.splitlines()[-1])
+        if best is None:
+            best = res
+            continue
+        for key, value in res['stages'].items():
+            best['stages'][key] = min(best['stages'][key], value)
+        if res['total'] < best['total']:
+            for key in ['total', 'events_per_s', 'photons_per_s', 'photons']:
+                best[key] = res[key]
+        best['peak_rss_mb'] = max(best['peak_rss_mb'], res['peak_rss_mb'])
+    best['params'] = params
+    return best
+
+def compare(results, baseline, tolerance = 0.2, min_time = 0.005):
+    '''Compares the results with a baseline.
+
+    Args:
+        results (dict): the results of the benchmark
+
+        baseline (dict): the results of a previous run
+
+    Kwargs:
+        tolerance (float): relative slowdown above which a stage is flagged
+
+        min_time (float): slowdowns shorter than this are not flagged [s]
+
+    Returns:
+        rows (list): (point, stage, baseline time, time, ratio, flagged)
+        for the stages present in both
+
+    '''
+    rows = []
+    for name, res in sorted(results['points'].items()):
+        if name not in baseline['points']:
+            continue
+        base = baseline['points'][name]
+        times = [(stage, base['stages'].get(stage), res['stages'][stage]) for stage in STAGES + ['analog'] if stage in res['stages']]
+        times.append(('total', base['total'], res['total']))
+        for stage, old, new in times:
+            if old is None or old <= 0:
+                continue
+            ratio = new / old
+            rows.append((name, stage, old, new, ratio, ratio > 1 + tolerance and new - old > min_time))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark suite of dacsim')
+    parser.add_argument('-o', '--output', default = 'benchmark.json', help = 'output file')
+    parser.add_argument('-b', '--baseline', help = 'baseline file to compare with')
+    parser.add_argument('-t', '--tolerance', type = float, default = 0.2, help = 'tolerance on the ratio of the times')
+    parser.add_argument('-r', '--repeat', type = int, default = 3, help = 'repetitions of each point')
+    parser.add_argument('--quick', action = 'store_true', help = 'fewer pulses')
+    parser.add_argument('--only', help = 'comma separated list of sweeps')
+    parser.add_argument('--point', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.point is not None:
+        print json.dumps(run_point(json.loads(args.point)))
+        return 0
+
+    sweeps = ['base'] + sorted(SWEEPS)
+    if args.only:
+        sweeps = args.only.split(',')
+    points = []
+    for sweep in sweeps:
+        for change in ([{}] if sweep == 'base' else SWEEPS[sweep]):
+            params = dict(BASE, **change)
+            if args.quick:
+                params['nps'] = max(params['nps'] / 10, 10)
+            if params not in points:
+                points.append(params)
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+               'machine': platform.platform(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'points': {}}
+    for params in points:
+        name = point_name(params)
+        print 'Running', name, '. . .'
+        res = benchmark_point(params, args.repeat)
+        results['points'][name] = res
+        print ' - total %.3f s, %.1f events/s, %.3g photons/s, peak memory %.1f MB' % (res['total'], res['events_per_s'],
+                                                                                      res['photons_per_s'], res['peak_rss_mb'])
+        print ' - ' + ', '.join('%s %.3f s' % (stage, res['stages'][stage]) for stage in STAGES + ['analog'] if stage in res['stages'])
+
+    f = open(args.output, 'w')
+    json.dump(results, f, indent = 1, sort_keys = True)
+    f.close()
+    print 'Results saved to', args.output
+
+    if args.baseline is None:
+        return 0
+    f = open(args.baseline)
+    baseline = json.load(f)
+    f.close()
+    rows = compare(results, baseline, args.tolerance)
+    print '\nComparison with', args.baseline
+    print '%-30s %-12s %10s %10s %7s' % ('point', 'stage', 'baseline', 'current', 'ratio')
+    for name, stage, old, new, ratio, flagged in rows:
+        print '%-30s %-12s %10.4f %10.4f %7.2f %s' % (name, stage, old, new, ratio, 'SLOWER' if flagged else '')
+    nslow = sum(row[-1] for row in rows)
+    print nslow, 'stages slower than the baseline by more than', '%g%%' % (100 * args.tolerance)
+    return 1 if nslow > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
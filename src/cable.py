@@ -7,6 +7,10 @@ module with cable filtering function and noise
 
 import numpy as np
 from scipy import signal
+from pulsebatch import PulseBatch
+from kernels import one_pole
+
+_filters = {} # cache of the filter coefficients
 
 def apply_cable(pulse, t, cutoff = 0.1, impedance = 50):
     '''Cable effect modeled as a lowpass filter
@@ -25,12 +29,40 @@ def apply_cable(pulse, t, cutoff = 0.1, impedance = 50):
         newpulse (numpy.array): filtered pulse [V]
 
     '''
-    sampling_freq = 1./(t[1]-t[0]) # GHz
-    Wn = (1./(2*np.pi))*(cutoff/sampling_freq)
-    b, a = signal.butter(1, Wn, 'low')
-    newpulse = signal.lfilter(b,a,pulse) * impedance
+    b, a = cable_filter(t[1]-t[0], cutoff, impedance)
+    newpulse = signal.lfilter(b,a,pulse)
     return newpulse
 
+def cable_filter(dt, cutoff = 0.1, impedance = 50):
+    '''Coefficients of the lowpass filter of the cable, including the impedance.
+    The coefficients are calculated once for each (dt, cutoff, impedance)
+    and then cached.
+
+    Args:
+        dt (float): time step of the pulses [ns]
+
+    Kwargs:
+        cutoff (float): cutoff of the filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+    Returns:
+        b (numpy.array): numerator coefficients (multiplied by the impedance)
+
+        a (numpy.array): denominator coefficients
+
+    '''
+    key = (float(dt), float(cutoff), float(impedance))
+    if key not in _filters:
+        sampling_freq = 1./dt # GHz
+        Wn = (1./(2*np.pi))*(cutoff/sampling_freq)
+        b, a = signal.butter(1, Wn, 'low')
+        b = b * impedance
+        b.flags.writeable = False
+        a.flags.writeable = False
+        _filters[key] = (b, a)
+    return _filters[key]
+
 def apply_noise(pulse, level = 0.02):
     '''Add electric noise (gaussian oscillation) to the pulse
 
@@ -47,4 +79,59 @@ def apply_noise(pulse, level = 0.02):
     noise = np.random.normal(0,level,len(pulse))
     newpulse = pulse + noise
     return newpulse
-    
+
+def apply_cable_batch(batch, t, cutoff = 0.1, impedance = 50):
+    '''Applies the cable filter to a batch of pulses (see apply_cable),
+    filtering all the pulses with one call. The filter is applied
+    with the precision of the pulses (float32 or float64).
+
+    Args:
+        batch (PulseBatch): input pulses from pmt
+
+        t (numpy.array): time axis of the pulses
+
+    Kwargs:
+        cutoff (float): cutoff of the filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+    Returns:
+        newbatch (PulseBatch): filtered pulses [V]
+
+    '''
+    pulses = batch.as_matrix()
+    b, a = cable_filter(t[1]-t[0], cutoff, impedance)
+    newpulses = one_pole(pulses, b, a)
+    return PulseBatch.from_matrix(newpulses, batch.meta)
+
+def apply_noise_batch(batch, level = 0.02, block = 256, rng = None):
+    '''Adds electric noise to a batch of pulses (see apply_noise).
+    The noise is drawn in blocks of pulses, in the same order as
+    drawing the noise of all the pulses at once, and added with
+    the precision of the pulses.
+
+    Args:
+        batch (PulseBatch): input pulses
+
+    Kwargs:
+        level (float): the amount of noise [V]
+
+        block (int): number of pulses drawn at once (limits the
+        memory of the temporary arrays)
+
+        rng (CounterRandom): counter-based random numbers, keyed by the
+        event and the sample (see streams module). numpy.random if None
+
+    Returns:
+        newbatch (PulseBatch): pulses with noise [V]
+
+    '''
+    pulses = batch.as_matrix()
+    newpulses = np.empty(pulses.shape, dtype = np.result_type(pulses.dtype, np.float32))
+    for i in range(0, len(pulses), block):
+        rows = pulses[i:i+block]
+        if rng is None:
+            newpulses[i:i+block] = rows + np.random.normal(0, level, rows.shape)
+        else:
+            newpulses[i:i+block] = rows + rng.normal('noise', batch.meta['event'][i:i+block,np.newaxis], np.arange(rows.shape[1]), level)
+    return PulseBatch.from_matrix(newpulses, batch.meta)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+cachetool
+=========
+
+Inspection of the stage cache of dacsim
+---------------------------------------
+
+Lists and clears the on-disk cache of the stage results (see the stagecache
+module and the input parameter cache of dacsim).
+
+Usage::
+
+    ./dacsim_cache [-d cache_dir] list [-v]
+    ./dacsim_cache [-d cache_dir] clear [--stage pmt] [--days 7]
+    ./dacsim_cache [-d cache_dir] trim --size 1024
+
+Commands:
+
+ - list: the entries, from the least to the most recently used, with their
+   stage, size and time of last use (-v also prints the parameters)
+ - clear: removes all the entries, or those of one stage, or those not used
+   in the last days
+ - trim: removes the least recently used entries until the cache is smaller
+   than size [MB]
+'''
+
+import sys, os, time, argparse
+
+cachetool_path = os.path.dirname(os.path.realpath(__file__))
+
+# Add path to modules
+# ------
+
+modules_path = cachetool_path + '/src/'
+if os.path.isdir(modules_path):
+    sys.path.insert(0,modules_path)
+
+from stagecache import StageCache
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Inspection of the stage cache of dacsim')
+    parser.add_argument('-d', '--dir', default = 'cache', help = 'cache directory')
+    sub = parser.add_subparsers(dest = 'command')
+    lst = sub.add_parser('list', help = 'list the entries')
+    lst.add_argument('-v', '--verbose', action = 'store_true', help = 'print the parameters of the entries')
+    clear = sub.add_parser('clear', help = 'remove entries')
+    clear.add_argument('--stage', help = 'remove only the entries of this stage')
+    clear.add_argument('--days', type = float, help = 'remove only the entries not used in the last days')
+    trim = sub.add_parser('trim', help = 'remove the least recently used entries')
+    trim.add_argument('--size', type = float, required = True, help = 'maximum size [MB]')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        sys.exit('No cache in ' + args.dir)
+    cache = StageCache(args.dir)
+
+    if args.command == 'list':
+        entries = cache.entries()
+        print '%-40s %-10s %10s  %s' % ('key', 'stage', 'size [MB]', 'last used')
+        for entry in entries:
+            print '%-40s %-10s %10.1f  %s' % (entry['key'], entry['stage'], entry['size'] / 1024.**2,
+                                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['used'])))
+            if args.verbose:
+                print '   ', ', '.join('%s=%s' % (key, value) for key, value in entry['params'])
+        print len(entries), 'entries, %.1f MB' % (sum(entry['size'] for entry in entries) / 1024.**2)
+    elif args.command == 'clear':
+        before = time.time() - args.days * 86400 if args.days is not None else None
+        removed = cache.clear(args.stage, before)
+        print len(removed), 'entries removed'
+    else:
+        removed = cache.trim(args.size)
+        print len(removed), 'entries removed, %.1f MB left' % (cache.size() / 1024.**2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
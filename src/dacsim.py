@@ -49,6 +49,107 @@ The code reads an input file in which the following variables MUST be defined:
  - pretrig_samp: number of pretrigger samples
  - fp: if 1, plot the first simulated pulse
 
+The following variables are optional:
+
+ - fused: if 1, apply the pmt and the cable as a single precomputed
+   impulse response (see analog module). Default 0
+ - mem: memory budget [MB]. If defined, the pulses are streamed through
+   the acquisition chain in chunks that fit in this amount of memory
+   (see simulation module). Default 0 (no streaming).
+   With nworkers, it is the budget of each worker
+ - nworkers: number of processes used for the simulation. If defined, the
+   pulses are simulated in parallel (see simulation.run_parallel).
+   For a given seed, the output does not depend on nworkers (with rng
+   counter, it is also the same as without nworkers)
+ - seed: master random seed. Random if not defined (with nworkers and sweeps
+   the seed is then drawn and printed)
+ - engine: grid (default) to simulate the pmt and the cable on the time axis
+   of the pulses, samples to evaluate them at the digitizer sampling times
+   only (see analog.apply_analog_samples). With samples the trigger is
+   found on the sampled pulse
+ - noise_engine: grid (default) to add the noise at every point of the time
+   axis of the pulses, samples to decimate the pulses to the sampling times
+   of the digitizer first and draw the noise only there (see noise module).
+   With samples the trigger is found on the sampled pulse
+ - noise_cutoff: cutoff of a first order lowpass on the noise [GHz], for
+   band-limited noise of rms noise. Needs noise_engine samples (or engine
+   samples, or acq_time)
+ - noise_psd: file with two columns, the frequency [GHz] and the power
+   spectral density of the noise, for colored noise of rms noise (with
+   noise_cutoff, the two spectra are multiplied). Same conditions as
+   noise_cutoff. The colored noise is read from a bank of noise samples
+   calculated once (see noise.noise_bank)
+ - noise_bank: number of samples of the bank of colored noise. Default 2**20
+ - photon_times: grid (default) to sample the photon times on the time axis of
+   the pulse shapes, continuous to draw them from the exponential components
+   of the scintillator (see scintillator.sample_times_continuous), without
+   rounding to the time step and at a constant cost per photon
+ - precision: double (default) or single. With single, the histograms and
+   the analog pulses (pmt, cable, noise) are float32, halving the memory
+   used by the acquisition chain; the FFT and the kernels stay in double
+   precision. The analog pulses differ from the double precision ones by
+   less than about 2e-6 of the full scale of the digitizer, so the ADC
+   codes differ by at most one level, for a fraction of the samples below
+   this difference divided by the level width (8e-3 at 12 bits; about
+   3e-5 in practice)
+ - metrics: name of a file in the output directory where the wall and cpu time,
+   the events and photons processed and the peak memory of each stage are
+   saved, with the counts of rejected events and pile-up (see metrics module).
+   CSV if the name ends with .csv, JSON otherwise
+ - profile: index of a chunk (with mem) or work unit (with nworkers) to be
+   profiled with cProfile (0 for the whole simulation without mem and
+   nworkers). The statistics are saved to output/<output>.prof
+   (see metrics.print_profile)
+ - sweep_<name>: comma separated values of the input parameter <name>
+   (e.g. sweep_cutoff 0.1,0.2,0.4). The simulation is run for each point of
+   the grid of all the sweep_ parameters, sharing the stages that do not
+   depend on the swept parameters (see sweep module). The output of point i
+   is output/<output>_<i>.dacsim, and output/<output>_sweep.json lists the
+   points. Cannot be used with mem, nworkers or oformat legacy
+ - sweep: JSON file with a list of sweep points, each a dictionary of input
+   parameters (instead of the sweep_ parameters)
+ - cache: directory of an on-disk cache of the stage results (see stagecache
+   module). The results of the stages are saved under a hash of the input
+   parameters they depend on, the seed and the data files, and a run that
+   only changes later stages (e.g. the digitizer) starts from the saved
+   pulses. The output is the same as without the cache. Cannot be used with
+   mem or nworkers. The cache can be listed and cleared with dacsim_cache
+ - cache_size: maximum size of the cache [MB]. The least recently used
+   results are removed first. Default 2048
+ - cache_stages: comma separated list of the stages saved to the cache.
+   Default pileup,pmt,analog,cable,noise
+ - acq_time: duration of a continuous acquisition [s] (list mode, see listmode
+   module). If defined, nps is ignored: the particles arrive at random times
+   with rate cre + crp on one continuous analog trace (the pulses that overlap
+   add up, also across the windows), and the trigger acquires a window at
+   each crossing of the threshold that is not lost in the dead time. The
+   metadata "time" of the output is the trigger time [s]. Needs th_on 1 and
+   cannot be used with sweeps, mem, nworkers, cache or oformat legacy
+ - holdoff: with acq_time, time the signal must stay below the threshold
+   before a crossing triggers [ns]. Default 0
+ - deadtime: with acq_time, dead time of the trigger after the end of each
+   window [ns]. Default 0 (dead only during the window)
+ - rng: numpy (default) to draw the random numbers from the sequential stream
+   of numpy.random, counter to calculate each random number from the seed and
+   the index of its pulse or event (see streams module). With counter, the
+   output does not depend on mem and nworkers, the index of the first pulse
+   of each event is saved in the metadata "event" and the event can be
+   simulated again on its own (see library.Simulation.replay); the particle
+   type of each pulse is drawn independently with ptype all, and the events
+   are grouped by pileup.local_pileup_groups. Cannot be used with sweeps,
+   cache or acq_time
+ - features: if 1, the features of each digitized pulse (baseline, amplitude,
+   time of the maximum, total and tail charge, their ratio and the constant
+   fraction time) are saved as metadata (see features module). Default 0
+ - feat_baseline, feat_total, feat_tail, feat_cfd: with features, number of
+   samples of the baseline, total and tail charge windows from the maximum
+   (e.g. feat_tail 20,300) [ns] and fraction of the constant fraction timing
+   (see features module)
+ - waveforms: all (default), none or n to save the waveform of one event
+   in n only (the metadata "waveform" is then the row of each event in
+   pulses.npy, -1 if not saved). Needs oformat dacsim
+ - oformat: format of the output, dacsim or legacy (see Output). Default dacsim
+
 example input file::
     
     # input example for dacsim
@@ -102,22 +203,52 @@ Output
 ------
 
 The codes generates a subdirectory called 'output' (if it does not exist) in
-the current directory and saves an output file with the name defined in the input
-and extension '.npy'.
-The output format is:
+the current directory and saves the output in a directory with the name defined in the input
+and extension '.dacsim', containing:
+
+ - header.json: inp_dict, coeff_dict, energy, intensity, t_dig and the number of pulses
+ - pulses.npy: the digitized pulses, as a (number of pulses x samples) integer array
+ - pileup_log.npy: the number of pile-up pulses in each event
+ - time_int.npy: the time intervals between pulses
+ - ptype.npy, energy.npy: the particle type (0 electron, 1 proton) and the deposited energy
+   [keVee] of the first pulse of each event
+ - event.npy: with rng counter, the index of the first pulse of each event
+ - baseline.npy, amplitude.npy, peak.npy, total.npy, tail.npy, psd.npy, cfd.npy:
+   with features 1, the features of each pulse
+ - waveform.npy: with waveforms none or n, the row of the waveform of each event
+   in pulses.npy (-1 if not saved)
+
+where t_dig is the digitized time axis, inp_dict is the input dictionary used to run the
+simulation, coeff_dict is the dictionary with the scintillator pulse shape coefficients,
+energy and intensity are the dictionaries containing the energy distributions for electrons and protons.
+The pulses are appended to the files while they are simulated. The files can be read
+with output.OutputReader (memory-mapped, with random access, chunked iteration and
+selection on the metadata), output.load_output or
+`numpy.load <http://docs.scipy.org/doc/numpy/reference/generated/numpy.load.html>`_
+(no pickle is needed).
+
+With 'oformat legacy' in the input, the output is instead a single file with extension '.npy'
+in the format:
 [t_dig,[p_1,p_2,...,p_nps],pileup_log,time_int,inp_dict,coeff_dict,energy,intensity]
-where t_dig is the digitized time axis, p_1,p_2,..,p_nps are the digitized pulses,
-pileup_log is a list containing the number of pile-up pulses in each event,
-time_int is an array containing the time intervals between pulses,
-inp_dict is the input dictionary used to run the simulation, coeff_dict is the dictionary
-with the scintillator pulse shape coefficients, energy and intensity are the dictionaries containing the
-energy distributions for electrons and protons.
-For information on how to read the file refer to the 
-`numpy.load <http://docs.scipy.org/doc/numpy/reference/generated/numpy.load.html>`_ function
+where p_1,p_2,..,p_nps are the digitized pulses. This format cannot be used together
+with mem or nworkers.
+
+Service
+-------
+
+The simulation can also run as a persistent service, which reads the data
+files once and keeps the pulse shapes and kernels between simulations::
+
+    dacsim --serve              # requests on the standard input
+    dacsim --serve socket_path  # requests on a Unix socket
+
+Each request is a line with a JSON object, e.g. {"file": "input.txt"} or
+{"input": {...}} with the input parameters, and is answered with a JSON line
+with the summary of the simulation (see the service module). From Python,
+library.Simulation runs simulations without the service.
 
 '''
 
-import pylab as pl
 import sys, os
 
 dacsim_path = os.path.dirname(os.path.realpath(__file__))
@@ -129,57 +260,37 @@ modules_path = dacsim_path + '/src/'
 if os.path.isdir(modules_path):
     sys.path.insert(0,modules_path)  
 
+from pulsebatch import *
+from kernels import *
+from streams import *
 from scintillator import *
 from pmt import *
 from cable import *
+from noise import *
 from digitize import *
 from pileup import *
 from edist import *
-
-def save_output(pulses,fname):
-    '''Saves the output file
-    
-    Args:
-        pulses (list): list of simulated pulses
-
-        fname (str): name of the output file
-    '''
-    dirpath = os.getcwd() + '/output/'
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
-    outfname = dirpath + fname
-    np.save(outfname, pulses)
-
-def read_input(fname):
-    '''Reads the input file and saves the parameters into a dictionary
-
-    Args:
-        fname (str): name of the input file
-
-    Returns:
-        inp_dict (dict): dictionary with the input parameters
-    '''
-    f = open(fname,'r')
-    lines = f.readlines()
-    f.close()
-    inp_dict = {}
-    for line in lines:
-        if line[0] == '#':
-            continue
-        else:
-            spl = line.split()
-            if len(spl) == 2:
-                try:
-                    inp_dict[spl[0]] = int(spl[1])
-                except:
-                    try:
-                        inp_dict[spl[0]] = float(spl[1])
-                    except:
-                        inp_dict[spl[0]] = spl[1]
-    return inp_dict
+from analog import *
+from simulation import *
+from features import *
+from output import *
+from metrics import *
+from sweep import *
+from listmode import *
+from stagecache import *
+from library import *
+from service import *
 
 if __name__ == '__main__':
-    
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+
+        # Run the persistent service
+        # ------
+
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
+
     # Print information
 
     print '- Welcome to DACSIM (Data ACquisition SIMulation) -'
@@ -188,12 +299,7 @@ if __name__ == '__main__':
     # Load dat files
     # ------
 
-    coeff_dict = load_coefficients()  
-    energy_e, intensity_e = load_energy_spectrum('electron')
-    energy_p, intensity_p = load_energy_spectrum('proton')
-
-    energy = {'electron': energy_e, 'proton': energy_p}
-    intensity = {'electron': intensity_e, 'proton': intensity_p}    
+    sim = Simulation()
 
     # Read input file
     # ------
@@ -206,78 +312,26 @@ if __name__ == '__main__':
     print 'Input values:'
     for key,value in inp_dict.items():
         print ' -', key, value
-    
 
-    # Calculate scintillator functions
+    # Run the simulation
     # ------
 
-    scint_dict = {}
-    plen = float(inp_dict['samples'])/inp_dict['sampf']
-    t, scint_dict['proton'] = scintillator('proton',coeff_dict,dt=inp_dict['dt'],plen=plen)
-    t, scint_dict['electron'] = scintillator('electron',coeff_dict,dt=inp_dict['dt'],plen=plen)
-
-    # Generate pulses
-    # ------
-
-    print 'Generating scintillator pulses. . .'
-
-    nps = inp_dict['nps']
-    tot_cr = inp_dict['cre'] + inp_dict['crp']
-
-    if inp_dict['ptype'] == 'all':
-        nel = int(float((inp_dict['cre'])/float(tot_cr)) * nps)
-        npr = int(float((inp_dict['crp'])/float(tot_cr)) * nps)
-        scint_pulses_e = generate_pulses(nel,t,scint_dict['electron'], energy['electron'], intensity['electron'], inp_dict['k'], inp_dict['lc'], inp_dict['qeff'])
-        scint_pulses_p = generate_pulses(npr,t,scint_dict['proton'], energy['proton'], intensity['proton'], inp_dict['k'], inp_dict['lc'], inp_dict['qeff'])
-        scint_pulses = np.append(scint_pulses_e,scint_pulses_p)
-        del scint_pulses_e
-        del scint_pulses_p
-        np.random.shuffle(scint_pulses)
-    else:
-        scint_pulses = generate_pulses(nps,t,scint_dict[inp_dict['ptype']], energy[inp_dict['ptype']], intensity[inp_dict['ptype']], inp_dict['k'], inp_dict['lc'], inp_dict['qeff'])
-
-    # Apply pileup
-    # ------
-
-    print 'Applying pile-up. . .'
-
-    pileup_pulses, pileup_log, time_int = apply_pileup(scint_pulses,tot_cr,plen)
-    del scint_pulses
-
-    # Apply acquisition chain modules
-    # ------
-
-    print 'Applying PMT. . .'
-    pmt_pulses = [ apply_pmt(p,t,inp_dict['ndyn'],inp_dict['delta'],inp_dict['sigma'],inp_dict['tt']) for p in pileup_pulses ]  
-    del pileup_pulses
-    print 'Applying cable. . .'
-    cable_pulses = [ apply_cable(p,t,inp_dict['cutoff'],inp_dict['imp']) for p in pmt_pulses ]
-    del pmt_pulses
-    print 'Applying noise. . .'
-    pulses_noise = [ apply_noise(p,inp_dict['noise']) for p in cable_pulses ]
-    del cable_pulses
-    print 'Digitizing. . .'
-    pulses_dig = [ digitize(p,t,inp_dict['bits'], [inp_dict['minV'],inp_dict['maxV']],inp_dict['sampf'], inp_dict['samples'],
-                            inp_dict['th_on'], inp_dict['th_lvl'], inp_dict['pretrig_samp'], inp_dict['noise']) for p in pulses_noise ]
-    del pulses_noise
-    print 'Updating pile-up log. . .'
-    pileup_log = [ n for n,p in zip(pileup_log,pulses_dig) if p is not None]
-    print 'Cleaning up pulse list. . .'
-    pulses_dig = [ p for p in pulses_dig if p is not None ]
-    print 'Calculating digitized time axis. . .'
-    t_dig = np.arange(0,float(inp_dict['samples'])/inp_dict['sampf'],1./inp_dict['sampf'])
-
-    # Save pulses
-    # ------
+    try:
+        summary = sim.run(inp_dict,verbose=True)
+    except ValueError as e:
+        sys.exit(str(e))
 
-    print 'Saving to output file. . .'
-    save_output([t_dig,pulses_dig,pileup_log,time_int,inp_dict,coeff_dict,energy,intensity],inp_dict['output'])
-    
     # Plot first pulse
     # ------
     
-    if inp_dict['fp'] == 1:
+    if inp_dict['fp'] == 1 and 'path' in summary and waveform_interval(inp_dict) > 0:
 
+        import pylab as pl
+        t_dig = np.arange(0,float(inp_dict['samples'])/inp_dict['sampf'],1./inp_dict['sampf'])
+        if inp_dict.get('oformat','dacsim') == 'dacsim':
+            pulses_dig = OutputReader(summary['path'])
+        else:
+            pulses_dig = np.load(summary['path'], allow_pickle = True)[1]
         pl.plot(t_dig,pulses_dig[0])
         pl.xlabel('t [ns]')
         pl.show()
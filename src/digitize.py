@@ -7,6 +7,9 @@ module with the function that takes care of the digitization of the pulse
 '''
 
 import numpy as np
+from pulsebatch import PulseBatch
+from noise import NoiseSource
+from kernels import trigger_windows
 
 def digitize(pulse, t, nbits=8, amprange=[-1.,1], sampfreq = 0.5, samples = 256, do_threshold = False, threshold = 50, pretriggersamples = 64,noise = 0.02):
     '''Digitize the signal
@@ -72,4 +75,119 @@ def digitize(pulse, t, nbits=8, amprange=[-1.,1], sampfreq = 0.5, samples = 256,
     newpulse = np.digitize(newpulse, codes)
 
     return newpulse
-    
+
+def digitize_batch(batch, t, nbits=8, amprange=[-1.,1], sampfreq = 0.5, samples = 256, do_threshold = False, threshold = 50, pretriggersamples = 64,noise = 0.02, noise_source = None):
+    '''Digitize a batch of signals (same as digitize for each pulse).
+    The trigger search, the decimation, the noise padding and the
+    quantization are done for all the pulses at once.
+
+    Args:
+        batch (PulseBatch): the input signals
+
+        t (numpy.array): the time axis
+
+    Kwargs:
+        nbits (int): resolution of the digitizer [bit]
+
+        amprange (list): amplitude range of the digitizer [max,min] [V]
+
+        sampfreq (float): sampling frequency of the digitizer [GHz]
+
+        samples = number of samples to acquire
+
+        do_threshold (bool): activate trigger threshold effect
+
+        threshold (int): level of trigger threshold (starting from baseline value)
+
+        pretriggersamples (int): number of samples before the trigger
+
+        noise (float): noise level [mV]
+
+        noise_source (NoiseSource): source of the padding noise (see
+        noise.NoiseSource). White noise of level noise if None. With
+        counter-based random numbers, the padding of each pulse is keyed
+        by its event (metadata "event")
+
+    Returns:
+        newbatch (PulseBatch): digitized pulses that passed the trigger
+        threshold, with their metadata
+
+        triggered (numpy.array): boolean array, True for the input pulses
+        that passed the trigger threshold
+
+    '''
+
+    pulses = batch.as_matrix()
+    dt = t[1] - t[0]
+    freq = 1. / dt
+    ratio = max(int(freq / sampfreq), 1)
+
+    dV = (amprange[1] - amprange[0]) / 2**nbits
+    th_V = threshold * dV
+
+    if do_threshold:
+
+        # Find the first sample above threshold and take the samples
+        # around it, the trigger sample being the last pretrigger sample
+        # ------
+
+        triggered, rows, newpulses, inside = trigger_windows(pulses, th_V, samples, pretriggersamples, ratio)
+
+        # Pad with noise where the window exceeds the pulse
+        # ------
+
+        if noise_source is None:
+            noise_source = NoiseSource(noise)
+        if noise_source.rng is None:
+            newpulses[~inside] = noise_source.take(np.count_nonzero(~inside))
+        else:
+            newpulses[~inside] = noise_source.rows(len(rows), samples, batch.meta['event'][rows])[~inside]
+    else:
+        triggered = np.ones(len(pulses), dtype = bool)
+        newpulses = pulses[:,::ratio]
+
+    newpulses = quantize(newpulses, nbits, amprange)
+
+    meta = dict((key, value[triggered]) for key, value in batch.meta.items())
+    return PulseBatch.from_matrix(newpulses, meta), triggered
+
+def quantize(signal, nbits=8, amprange=[-1.,1]):
+    '''Converts a signal to digitizer codes.
+    Same as numpy.digitize(signal, numpy.linspace(amprange[0],amprange[1],2**nbits)),
+    but calculated arithmetically.
+
+    Args:
+        signal (numpy.array): the input signal [V]
+
+    Kwargs:
+        nbits (int): resolution of the digitizer [bit]
+
+        amprange (list): amplitude range of the digitizer [max,min] [V]
+
+    Returns:
+        codes (numpy.array): the digitizer codes, from 0 to 2**nbits
+
+    '''
+    nlevels = 2**nbits
+    step = float(amprange[1] - amprange[0]) / (nlevels - 1)
+    codes = np.floor((signal - amprange[0]) / step)
+    np.clip(codes, -1, nlevels - 1, out = codes)
+    codes = codes.astype(np.intp) + 1
+
+    # correct the rounding errors at the edges of the levels, comparing
+    # each sample with the two levels around its code only
+    # ------
+
+    low = codes > 0
+    codes[low] -= signal[low] < _levels(codes[low] - 1, nlevels, step, amprange)
+    high = codes < nlevels
+    codes[high] += signal[high] >= _levels(codes[high], nlevels, step, amprange)
+    return codes
+
+def _levels(k, nlevels, step, amprange):
+    '''Levels k of the digitizer, with the same rounding as
+    numpy.linspace(amprange[0],amprange[1],nlevels)[k] (start + k*step,
+    the last level being exactly amprange[1]).'''
+    levels = amprange[0] + k*step
+    levels[k == nlevels - 1] = amprange[1]
+    return levels
@@ -0,0 +1,152 @@
+'''
+Features
+========
+
+module with the extraction of the features of the digitized pulses (input
+"features 1"): the baseline, the amplitude and the time of the maximum, the
+total and tail charge and their ratio for the pulse shape discrimination,
+and the constant fraction timing. The features are calculated for all the
+pulses of a batch at once, when the pulses are written (see
+output.OutputWriter), and saved as per-event metadata.
+
+The waveforms can then be saved for a subset of the events only (input
+"waveforms"): the metadata "waveform" is the row of the saved waveform of
+each event in pulses.npy, -1 if it was not saved.
+
+The integration windows are set in ns from the maximum of each pulse:
+
+ - feat_baseline: number of samples at the start of the window averaged for
+   the baseline. Default pretrig_samp - 1
+ - feat_total: start and end of the total charge window, e.g. -10,300
+ - feat_tail: start and end of the tail charge window, e.g. 20,300
+ - feat_cfd: fraction of the amplitude for the constant fraction timing.
+   Default 0.5
+'''
+
+import numpy as np
+
+FEATURES = ['baseline', 'amplitude', 'peak', 'total', 'tail', 'psd', 'cfd'] # names of the features
+
+TOTAL_WINDOW = (-10., 300.) # default total charge window, from the maximum [ns]
+TAIL_WINDOW = (20., 300.) # default tail charge window, from the maximum [ns]
+
+def extract_features(pulses, sampfreq, nbaseline = 1, total = TOTAL_WINDOW, tail = TAIL_WINDOW, fraction = 0.5, block = 4096):
+    '''Features of digitized pulses. The charges are the sums of the samples
+    above the baseline in the windows, times the sampling period.
+
+    Args:
+        pulses (numpy.array): the digitized pulses, one per row [adc codes]
+
+        sampfreq (float): sampling frequency of the digitizer [GHz]
+
+    Kwargs:
+        nbaseline (int): number of samples at the start of the pulses
+        averaged for the baseline
+
+        total (tuple): start and end of the total charge window, from the
+        maximum of the pulse [ns]
+
+        tail (tuple): start and end of the tail charge window, from the
+        maximum of the pulse [ns]
+
+        fraction (float): fraction of the amplitude for the constant
+        fraction timing
+
+        block (int): number of pulses processed at once (limits the memory
+        of the temporary arrays)
+
+    Returns:
+        features (dict): arrays with one entry per pulse: "baseline" [adc
+        codes], "amplitude" (maximum above the baseline) [adc codes],
+        "peak" (time of the maximum) [ns], "total" and "tail" (charges)
+        [adc codes x ns], "psd" (tail / total, 0 if total is not positive)
+        and "cfd" (time at which the leading edge crosses fraction of the
+        amplitude, interpolated between the samples) [ns]
+
+    '''
+    pulses = np.asarray(pulses)
+    n = len(pulses)
+    features = dict((key, np.zeros(n)) for key in FEATURES)
+    step = 1. / sampfreq
+    k = np.arange(pulses.shape[1])
+    nbaseline = min(max(int(nbaseline), 1), pulses.shape[1])
+    for i in range(0, n, block):
+        rows = pulses[i:i+block].astype(float)
+        baseline = rows[:,:nbaseline].mean(axis=1)
+        signal = rows - baseline[:,np.newaxis]
+        peak = signal.argmax(axis=1)
+        amplitude = signal[np.arange(len(rows)),peak]
+
+        # charges in the windows from the maximum
+        # ------
+
+        since = (k - peak[:,np.newaxis]) * step
+        charges = []
+        for start, stop in [total, tail]:
+            inside = (since >= start) & (since < stop)
+            charges.append(np.where(inside, signal, 0.).sum(axis=1) * step)
+        del since
+
+        # constant fraction timing on the leading edge: the crossing
+        # after the last sample below the level before the maximum
+        # ------
+
+        level = fraction * amplitude
+        below = (signal < level[:,np.newaxis]) & (k < peak[:,np.newaxis])
+        first = np.where(below.any(axis=1), len(k) - below[:,::-1].argmax(axis=1), 0)
+        del below
+        before = np.maximum(first - 1, 0)
+        low, high = signal[np.arange(len(rows)),before], signal[np.arange(len(rows)),first]
+        rise = np.where(first > 0, high - low, 1.)
+        time = np.where(first > 0, before + (level - low) / rise, 0.) * step
+
+        sel = slice(i, i + len(rows))
+        features['baseline'][sel] = baseline
+        features['amplitude'][sel] = amplitude
+        features['peak'][sel] = peak * step
+        features['total'][sel], features['tail'][sel] = charges
+        positive = charges[0] > 0
+        features['psd'][sel] = np.where(positive, charges[1], 0.) / np.where(positive, charges[0], 1.)
+        features['cfd'][sel] = time
+    return features
+
+def _window(value, name):
+    '''Start and end of an integration window from the input ("start,end")'''
+    window = tuple(float(x) for x in str(value).split(','))
+    if len(window) != 2 or window[0] >= window[1]:
+        raise ValueError('%s must be "start,end" with start < end [ns]' % name)
+    return window
+
+def feature_parameters(inp_dict):
+    '''Parameters of extract_features of the input parameters features,
+    feat_baseline, feat_total, feat_tail and feat_cfd (see the module
+    documentation), or None if the features are not extracted.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        parameters (dict): keyword arguments of extract_features
+
+    '''
+    if inp_dict.get('features', 0) != 1:
+        return None
+    return {'sampfreq': inp_dict['sampf'],
+            'nbaseline': inp_dict.get('feat_baseline', max(inp_dict['pretrig_samp'] - 1, 1)),
+            'total': _window(inp_dict.get('feat_total', '%g,%g' % TOTAL_WINDOW), 'feat_total'),
+            'tail': _window(inp_dict.get('feat_tail', '%g,%g' % TAIL_WINDOW), 'feat_tail'),
+            'fraction': inp_dict.get('feat_cfd', 0.5)}
+
+def waveform_interval(inp_dict):
+    '''Interval between the events whose waveform is saved, from the input
+    parameter "waveforms": all (default, 1), none (0) or n (one event in n)'''
+    value = inp_dict.get('waveforms', 'all')
+    interval = {'all': 1, 'none': 0}.get(value, value)
+    if not isinstance(interval, int) or interval < 0:
+        raise ValueError('waveforms must be all, none or a positive integer')
+    return interval
+
+def output_options(inp_dict):
+    '''Keyword arguments of output.OutputWriter for the features and the
+    waveforms of the input parameters'''
+    return {'features': feature_parameters(inp_dict), 'waveforms': waveform_interval(inp_dict)}
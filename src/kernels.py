@@ -0,0 +1,236 @@
+'''
+Kernels
+=======
+
+module with the inner loops of the simulation that are compiled when
+possible: the grouping of the pile-up pulses, the weighted histograms of
+the photon times, the one-pole recursion of the cable filter, the
+trigger search with the decimation of the digitizer and the counter-based
+random numbers (see streams module).
+
+Each kernel has a compiled version, typed and releasing the GIL (the
+_kernels extension, built from _kernels.pyx by CMake), and a NumPy
+version. The compiled version is used if the extension can be imported,
+unless the environment variable DACSIM_KERNELS is "numpy". The two
+versions give identical output, which is checked by tests/test_kernels.py.
+'''
+
+import os
+import numpy as np
+from scipy import signal
+
+try:
+    if os.environ.get('DACSIM_KERNELS') == 'numpy':
+        raise ImportError('compiled kernels disabled')
+    import _kernels
+except ImportError:
+    _kernels = None
+
+# NumPy versions
+# ------
+
+def _pileup_starts_numpy(tint_array, arrival, window):
+    n = len(arrival)
+
+    # a pulse after an interval longer than the window always starts a new event
+    starts = np.ones(n, dtype = bool)
+    starts[1:] = tint_array >= window
+
+    # inside each cluster of short intervals, jump from the first pulse of
+    # an event to the first pulse outside of its window, one event per
+    # cluster at each iteration
+    current = np.flatnonzero(~starts[1:])
+    current = current[starts[current]]
+    while len(current) > 0:
+        following = np.searchsorted(arrival, arrival[current] + window, side = 'left')
+        following = following[following < n]
+        following = following[~starts[following]]
+        starts[following] = True
+        current = following
+    return starts
+
+def _histogram_rows_numpy(values, offsets, t, weights = None):
+    nbins = len(t) - 1
+    idx = np.searchsorted(t,values,side='right') - 1
+    idx[values == t[-1]] = nbins - 1 # last bin includes the right edge
+    inside = (idx >= 0) & (idx < nbins)
+    event = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    flat = event[inside] * nbins + idx[inside]
+    w = None if weights is None else weights[inside]
+    hist = np.bincount(flat, weights=w, minlength=(len(offsets)-1)*nbins).reshape(len(offsets)-1,nbins)
+    return hist.astype(float, copy = False)
+
+def _one_pole_numpy(rows, b0, b1, a1):
+    dtype = np.float32 if rows.dtype == np.float32 else np.float64
+    b, a = np.array([b0, b1], dtype = dtype), np.array([1., a1], dtype = dtype)
+    return signal.lfilter(b, a, rows, axis = 1)
+
+def _trigger_windows_numpy(pulses, threshold, samples, pretrig, ratio):
+    above = pulses >= threshold
+    triggered = above.any(axis=1)
+    rows = np.flatnonzero(triggered)
+    trigger = above[rows].argmax(axis=1)
+    del above
+    src = trigger[:,np.newaxis] + (np.arange(samples) - pretrig + 1) * ratio
+    inside = (src >= 0) & (src < pulses.shape[1])
+    windows = pulses[rows[:,np.newaxis], np.clip(src,0,pulses.shape[1]-1)]
+    return triggered, rows, windows, inside
+
+PHILOX_M = (np.uint64(0xD2511F53), np.uint64(0xCD9E8D57)) # multipliers of Philox4x32
+PHILOX_W = (0x9E3779B9, 0xBB67AE85) # key increments of Philox4x32
+
+def philox4x32(c0, c1, c2, c3, k0, k1, rounds = 10):
+    '''Philox4x32 block function (NumPy version, on arrays of uint64 holding
+    32-bit words): the four words of the output for the counters
+    (c0, c1, c2, c3) and the key (k0, k1)'''
+    mask, shift = np.uint64(0xffffffff), np.uint64(32)
+    for r in range(rounds):
+        p0, p1 = c0 * PHILOX_M[0], c2 * PHILOX_M[1]
+        c0, c1, c2, c3 = (p1 >> shift) ^ c1 ^ np.uint64(k0), p1 & mask, (p0 >> shift) ^ c3 ^ np.uint64(k1), p0 & mask
+        k0, k1 = (k0 + PHILOX_W[0]) & 0xffffffff, (k1 + PHILOX_W[1]) & 0xffffffff
+    return c0, c1, c2, c3
+
+def _philox_uniform_numpy(key, index, stage, seed):
+    mask, shift = np.uint64(0xffffffff), np.uint64(32)
+    c0, c1, c2, c3 = philox4x32(index & mask, np.full(len(key), stage, dtype = np.uint64), key & mask, key >> shift,
+                                seed & 0xffffffff, seed >> 32)
+    return ((c0 >> np.uint64(6)) * 67108864. + (c1 >> np.uint64(6)) + 0.5) / 4503599627370496.
+
+NUMPY = {'pileup_starts': _pileup_starts_numpy, 'histogram_rows': _histogram_rows_numpy,
+         'one_pole': _one_pole_numpy, 'trigger_windows': _trigger_windows_numpy,
+         'philox_uniform': _philox_uniform_numpy}
+
+COMPILED = {} if _kernels is None else dict((name, getattr(_kernels, name)) for name in NUMPY)
+
+IMPLEMENTATION = 'compiled' if COMPILED else 'numpy' # selected at import
+
+_impl = COMPILED or NUMPY
+
+# Kernels
+# ------
+
+def pileup_starts(tint_array, arrival, window):
+    '''Finds the pulses that start a new event (see pileup.pileup_groups):
+    a pulse starts an event if it arrives at least window after the first
+    pulse of the current event.
+
+    Args:
+        tint_array (numpy.array): the time intervals between pulses [s]
+
+        arrival (numpy.array): arrival time of each pulse (longdouble) [s]
+
+        window (float): the length of an event [s]
+
+    Returns:
+        starts (numpy.array): boolean array, True for the first pulse
+        of each event
+
+    '''
+    return _impl['pileup_starts'](np.asarray(tint_array, dtype = float), arrival, window)
+
+def histogram_rows(values, offsets, t, weights = None):
+    '''Histograms of the photon times of several pulses, with the binning
+    of numpy.histogram(pulse,bins=t) and the weights summed in double
+    precision.
+
+    Args:
+        values (numpy.array): the photon times of the pulses, concatenated
+
+        offsets (numpy.array): start of each pulse in values, and the end
+        of the last one
+
+        t (numpy.array): the bin edges
+
+    Kwargs:
+        weights (numpy.array): weight of each photon (same length as values)
+
+    Returns:
+        hist (numpy.array): (pulses x len(t)-1) matrix with the histograms
+
+    '''
+    if weights is not None:
+        weights = np.asarray(weights, dtype = float)
+    return _impl['histogram_rows'](np.asarray(values, dtype = float), np.asarray(offsets, dtype = np.intp),
+                                   np.asarray(t, dtype = float), weights)
+
+def one_pole(rows, b, a):
+    '''Filters each row with a first order filter, with the same arithmetic
+    as scipy.signal.lfilter(b, a, rows, axis = 1) (zero initial state).
+    The filter is applied with the precision of the rows (float32 or
+    float64).
+
+    Args:
+        rows (numpy.array): 2D array of signals
+
+        b (numpy.array): numerator coefficients (one or two)
+
+        a (numpy.array): denominator coefficients (two)
+
+    Returns:
+        filtered (numpy.array): the filtered rows
+
+    '''
+    dtype = np.float32 if rows.dtype == np.float32 else np.float64
+    b = np.append(np.asarray(b, dtype = dtype), np.zeros(2, dtype = dtype))[:2]
+    a = np.asarray(a, dtype = dtype)
+    b, a = b / a[0], a / a[0]
+    return _impl['one_pole'](rows.astype(dtype, copy = False), float(b[0]), float(b[1]), float(a[1]))
+
+def trigger_windows(pulses, threshold, samples, pretrig, ratio):
+    '''Finds the first sample above threshold of each pulse and takes the
+    window of samples around it, one in ratio, the trigger sample being the
+    last pretrigger sample (see digitize.digitize_batch).
+
+    Args:
+        pulses (numpy.array): (pulses x points) matrix of signals
+
+        threshold (float): trigger threshold (compared with the precision
+        of the pulses)
+
+        samples (int): samples of the window
+
+        pretrig (int): samples of the window up to the trigger
+
+        ratio (int): points of the pulses between two samples
+
+    Returns:
+        triggered (numpy.array): boolean array, True for the pulses that
+        passed the threshold
+
+        rows (numpy.array): indices of the pulses that passed the threshold
+
+        windows (numpy.array): (triggered pulses x samples) matrix with the
+        windows. Outside of the pulse, the value at its edge
+
+        inside (numpy.array): boolean matrix, False where the window
+        exceeds the pulse
+
+    '''
+    return _impl['trigger_windows'](pulses, float(threshold), int(samples), int(pretrig), int(ratio))
+
+def philox_uniform(key, index, stage, seed):
+    '''Counter-based uniform random numbers: the Philox4x32-10 block
+    function of the counter (index, stage, key) with the seed as its key,
+    converted to a double with 52 random bits. Each number depends only on
+    its arguments, not on the numbers drawn before.
+
+    Args:
+        key (numpy.array): 64-bit key of each number (e.g. an event index)
+
+        index (numpy.array): 32-bit index of each number within its key
+        (broadcast with key)
+
+        stage (int): 32-bit code of the stage that uses the numbers
+
+        seed (int): 64-bit seed
+
+    Returns:
+        uniform (numpy.array): the numbers, in the open interval (0, 1),
+        with the shape of the broadcast key and index
+
+    '''
+    key, index = np.broadcast_arrays(np.asarray(key, dtype = np.uint64), np.asarray(index, dtype = np.uint64))
+    shape = key.shape
+    uniform = _impl['philox_uniform'](np.ascontiguousarray(key).ravel(), np.ascontiguousarray(index).ravel(),
+                                      int(stage) & 0xffffffff, int(seed) & 0xffffffffffffffff)
+    return uniform.reshape(shape)
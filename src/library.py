@@ -0,0 +1,421 @@
+'''
+Library
+=======
+
+module with the library interface of dacsim.
+
+A Simulation object reads the data files (scintillator coefficients and
+energy spectra) once and keeps the scintillator pulse shapes of each time
+step and pulse length, so that many simulations can be run from the same
+process without repeating this work. The pmt and analog kernels are also
+kept, since they are cached by their modules (see pmt.pmt_kernel and
+analog.analog_kernel).
+
+Usage::
+
+    sim = Simulation()
+    summary = sim.run(read_input('input.txt'))            # as dacsim
+    result = sim.simulate(dict(inp_dict, th_lvl = 80))    # in memory
+    result = sim.replay(inp_dict, event)                  # one event (rng counter)
+
+The persistent service of dacsim (see the service module) runs the
+simulations of its requests with a Simulation.
+'''
+
+import os
+import numpy as np
+from scintillator import load_coefficients
+from edist import load_energy_spectrum
+from pileup import apply_pileup
+from simulation import (pulse_shapes, particle_counts, generate_batch, acquire, count_events,
+                        run_stream, run_parallel, sampled_noise, draw_events, event_batch, replay_event)
+from noise import colored_noise
+from output import OutputWriter
+from metrics import Metrics, print_record, photon_count
+from sweep import STAGES, sweep_points, first_stage, run_sweep, run_point
+from stagecache import StageCache
+from listmode import run_listmode
+from streams import counter_rng
+from features import output_options
+
+def read_input(fname):
+    '''Reads the input file and saves the parameters into a dictionary
+
+    Args:
+        fname (str): name of the input file
+
+    Returns:
+        inp_dict (dict): dictionary with the input parameters
+    '''
+    f = open(fname,'r')
+    lines = f.readlines()
+    f.close()
+    inp_dict = {}
+    for line in lines:
+        if line[0] == '#':
+            continue
+        else:
+            spl = line.split()
+            if len(spl) == 2:
+                try:
+                    inp_dict[spl[0]] = int(spl[1])
+                except:
+                    try:
+                        inp_dict[spl[0]] = float(spl[1])
+                    except:
+                        inp_dict[spl[0]] = spl[1]
+    return inp_dict
+
+def output_path(fname):
+    '''Returns the path of an output file in the output directory,
+    creating the directory if it does not exist
+
+    Args:
+        fname (str): name of the output file
+
+    Returns:
+        path (str): path of the output file
+    '''
+    dirpath = os.getcwd() + '/output/'
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    return dirpath + fname
+
+def save_output(pulses,fname):
+    '''Saves the output file
+
+    Args:
+        pulses (list): list of simulated pulses
+
+        fname (str): name of the output file
+    '''
+    np.save(output_path(fname), pulses)
+
+def check_input(inp_dict, sweep = False):
+    '''Checks that the input parameters can be used together, raising
+    ValueError if not (Simulation.run checks the input and the input of
+    each sweep point, with its overrides).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Kwargs:
+        sweep (bool): the input is part of a sweep
+
+    '''
+    oformat = inp_dict.get('oformat','dacsim')
+    options = output_options(inp_dict)
+    counter = inp_dict.get('rng','numpy') == 'counter'
+    if sweep and (inp_dict.get('nworkers',0) > 0 or inp_dict.get('mem',0) > 0 or oformat != 'dacsim'):
+        raise ValueError('sweeps cannot be used with nworkers, mem or oformat legacy')
+    if oformat != 'dacsim' and (inp_dict.get('nworkers',0) > 0 or inp_dict.get('mem',0) > 0):
+        raise ValueError('oformat legacy cannot be used with nworkers or mem')
+    if oformat != 'dacsim' and (options['features'] is not None or options['waveforms'] != 1):
+        raise ValueError('features and waveforms need oformat dacsim')
+    if 'cache' in inp_dict and (inp_dict.get('nworkers',0) > 0 or inp_dict.get('mem',0) > 0):
+        raise ValueError('cache cannot be used with nworkers or mem')
+    if 'acq_time' in inp_dict and (sweep or inp_dict.get('nworkers',0) > 0 or inp_dict.get('mem',0) > 0
+                                   or 'cache' in inp_dict or oformat != 'dacsim'):
+        raise ValueError('acq_time cannot be used with sweeps, nworkers, mem, cache or oformat legacy')
+    if colored_noise(inp_dict) and not sampled_noise(inp_dict) and 'acq_time' not in inp_dict:
+        raise ValueError('noise_cutoff and noise_psd need noise_engine samples or engine samples')
+    if 'acq_time' in inp_dict and inp_dict['th_on'] != 1:
+        raise ValueError('acq_time needs the trigger (th_on 1)')
+    if counter and (sweep or 'cache' in inp_dict or 'acq_time' in inp_dict):
+        raise ValueError('rng counter cannot be used with sweeps, cache or acq_time')
+
+class Simulation(object):
+    '''Simulation of the acquisition chain, keeping the data files and
+    the scintillator pulse shapes between runs.
+
+    Kwargs:
+        coeff_dict (dict): the scintillator coefficients. Read from
+        "dat/scintillator.dat" if not given (see load_coefficients)
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type.
+        energy and intensity are read from the spectrum files if not
+        given (see load_energy_spectrum)
+
+    '''
+
+    def __init__(self, coeff_dict = None, energy = None, intensity = None):
+        if coeff_dict is None:
+            coeff_dict = load_coefficients()
+        if energy is None or intensity is None:
+            energy, intensity = {}, {}
+            for ptype in ['electron', 'proton']:
+                energy[ptype], intensity[ptype] = load_energy_spectrum(ptype)
+        self.coeff_dict = coeff_dict
+        self.energy = energy
+        self.intensity = intensity
+        self._shapes = {}
+
+    def shapes(self, inp_dict):
+        '''Scintillator pulse shapes for the time step and the pulse
+        length of an input (calculated once and then kept).
+
+        Args:
+            inp_dict (dict): dictionary with the input parameters
+
+        Returns:
+            t (numpy.array): time axis of the pulse shapes
+
+            scint_dict (dict): pulse shape of each particle type (see
+            simulation.pulse_shapes)
+
+        '''
+        plen = float(inp_dict['samples'])/inp_dict['sampf']
+        key = (float(inp_dict['dt']), plen)
+        if key not in self._shapes:
+            self._shapes[key] = pulse_shapes(self.coeff_dict,inp_dict['dt'],plen)
+        return self._shapes[key]
+
+    def header(self, inp_dict):
+        '''Header of the output of a simulation (see OutputWriter)'''
+        t_dig = np.arange(0,float(inp_dict['samples'])/inp_dict['sampf'],1./inp_dict['sampf'])
+        return {'inp_dict': inp_dict, 'coeff_dict': self.coeff_dict, 't_dig': t_dig.tolist(),
+                'energy': dict((key, value.tolist()) for key, value in self.energy.items()),
+                'intensity': dict((key, value.tolist()) for key, value in self.intensity.items())}
+
+    def simulate(self, inp_dict, metrics = None):
+        '''Runs a simulation in memory, without writing the output.
+        The random generator is seeded with the input parameter "seed",
+        if defined. With the input parameter "cache", the stages start
+        from the results in the cache, and with "rng counter" the events
+        are drawn as in simulation.run_parallel (the seed is then drawn if
+        not defined in both cases).
+
+        Args:
+            inp_dict (dict): dictionary with the input parameters
+
+        Kwargs:
+            metrics (Metrics): records the stages
+
+        Returns:
+            result (dict): the digitized pulses "pulses" (PulseBatch) that
+            passed the trigger, the time intervals "time_int", the number
+            of simulated events "nevents" and the input dictionary
+            "inp_dict" (with the seed drawn, if any)
+
+        '''
+        if metrics is None:
+            metrics = Metrics()
+        if inp_dict.get('rng','numpy') == 'counter':
+            if 'seed' not in inp_dict:
+                inp_dict = dict(inp_dict, seed = np.random.randint(2**31))
+            t, scint_dict = self.shapes(inp_dict)
+            with metrics.stage('draw', inp_dict['nps']):
+                pulses, first, time_int = draw_events(inp_dict,self.energy,self.intensity)
+            with metrics.stage('generate', inp_dict['nps']) as record:
+                batch = event_batch(pulses,np.diff(np.append(first,inp_dict['nps'])),t,scint_dict,inp_dict)
+                record['photons'] = photon_count(batch)
+            del pulses
+            pulses_dig, triggered = acquire(batch,t,inp_dict,metrics)
+            return {'pulses': pulses_dig, 'time_int': time_int, 'nevents': len(triggered), 'inp_dict': inp_dict}
+        if 'cache' in inp_dict:
+            if 'seed' not in inp_dict:
+                inp_dict = dict(inp_dict, seed = np.random.randint(2**31))
+            cache = StageCache(inp_dict['cache'],inp_dict.get('cache_size',2048))
+            result, level = run_point(inp_dict,self.coeff_dict,self.energy,self.intensity,cache=cache,metrics=metrics)
+            count_events(metrics,result['meta'],result['triggered'])
+            return {'pulses': result['batch'], 'time_int': result['time_int'], 'nevents': len(result['triggered']),
+                    'inp_dict': inp_dict, 'start': STAGES[level][0] if level < len(STAGES) else 'output',
+                    'cache_mb': cache.size() / 1024.**2}
+
+        if 'seed' in inp_dict:
+            np.random.seed(inp_dict['seed'])
+        t, scint_dict = self.shapes(inp_dict)
+        plen = float(inp_dict['samples'])/inp_dict['sampf']
+        nps = inp_dict['nps']
+
+        # Generate pulses
+        # ------
+
+        with metrics.stage('generate',nps) as record:
+            scint_pulses = generate_batch(particle_counts(inp_dict,nps),t,scint_dict,self.energy,self.intensity,inp_dict)
+            record['photons'] = photon_count(scint_pulses)
+
+        # Apply pileup
+        # ------
+
+        with metrics.stage('pileup',nps):
+            pileup_pulses, pileup_log, time_int = apply_pileup(scint_pulses,inp_dict['cre'] + inp_dict['crp'],plen)
+        del scint_pulses
+
+        # Apply acquisition chain modules
+        # ------
+
+        pulses_dig, triggered = acquire(pileup_pulses,t,inp_dict,metrics)
+        return {'pulses': pulses_dig, 'time_int': time_int, 'nevents': len(triggered), 'inp_dict': inp_dict}
+
+    def replay(self, inp_dict, event):
+        '''Simulates again one event of a simulation with counter-based
+        random numbers (input "rng counter"), see simulation.replay_event.
+
+        Args:
+            inp_dict (dict): dictionary with the input parameters, with the
+            seed of the simulation
+
+            event (int): the event (metadata "event" of the output)
+
+        Returns:
+            result (dict): the digitized pulse "pulses" (PulseBatch, empty
+            if the event did not pass the trigger) and "triggered"
+
+        '''
+        t, scint_dict = self.shapes(inp_dict)
+        pulses_dig, triggered = replay_event(inp_dict,t,scint_dict,self.energy,self.intensity,event)
+        return {'pulses': pulses_dig, 'triggered': bool(triggered[0])}
+
+    def run(self, inp_dict, verbose = False):
+        '''Runs a simulation and writes its output, as dacsim (see the
+        documentation of dacsim for the input parameters and the output).
+
+        Args:
+            inp_dict (dict): dictionary with the input parameters
+
+        Kwargs:
+            verbose (bool): print the progress of the simulation
+
+        Returns:
+            summary (dict): the path of the output ("path", or "paths" and
+            "sweep" for a sweep), the seed, the numbers of simulated events
+            ("events"), saved pulses ("pulses") and, if not all, saved
+            waveforms ("waveforms"), the pile-up counters and the path of
+            the metrics file, if any
+
+        '''
+        inp_dict = dict(inp_dict)
+        summary = {}
+        t, scint_dict = self.shapes(inp_dict)
+        plen = float(inp_dict['samples'])/inp_dict['sampf']
+        t_dig = np.arange(0,plen,1./inp_dict['sampf'])
+        oformat = inp_dict.get('oformat','dacsim')
+        profile_file = output_path(inp_dict['output'] + '.prof')
+        metrics = Metrics([print_record] if verbose else [], inp_dict.get('profile'), profile_file)
+
+        points = sweep_points(inp_dict)
+        for inp in [inp_dict] + [dict(inp_dict, **point) for point in points]:
+            check_input(inp, len(points) > 0)
+        options = output_options(inp_dict)
+        counter = inp_dict.get('rng','numpy') == 'counter'
+
+        draw_seed = len(points) > 0 or inp_dict.get('nworkers',0) > 0 or 'cache' in inp_dict or counter
+        if 'seed' not in inp_dict and draw_seed:
+            inp_dict['seed'] = np.random.randint(2**31)
+        counter_rng(inp_dict) # checks the input "rng"
+        if 'seed' in inp_dict:
+            summary['seed'] = inp_dict['seed']
+            if verbose and draw_seed:
+                print 'Random seed:', inp_dict['seed']
+
+        if len(points) > 0:
+
+            # Run a sweep of the input parameters
+            # ------
+
+            cache = StageCache(inp_dict['cache'],inp_dict.get('cache_size',2048)) if 'cache' in inp_dict else None
+            if verbose:
+                if cache is not None:
+                    print 'Stage cache:', cache.path
+                for key in sorted(set(key for point in points for key in point)):
+                    print ' -', key, 'is used from stage', first_stage(key, inp_dict)
+                print 'Running', len(points), 'sweep points. . .'
+            header = self.header(inp_dict)
+            del header['inp_dict'], header['t_dig']
+            summary['paths'] = run_sweep(inp_dict,points,self.coeff_dict,self.energy,self.intensity,header,metrics,verbose,cache)
+            summary['sweep'] = output_path(inp_dict['output'] + '_sweep.json')
+            if verbose: print ' -', len(summary['paths']), 'outputs saved, listed in', summary['sweep']
+            self._write_metrics(inp_dict, metrics, summary, verbose)
+            return summary
+
+        # Prepare the output
+        # ------
+
+        if oformat == 'dacsim':
+            writer = OutputWriter(output_path(inp_dict['output']),inp_dict['samples'],inp_dict['bits'],self.header(inp_dict),
+                                  **output_options(inp_dict))
+
+        if verbose: print 'Stages:'
+        if 'acq_time' in inp_dict:
+
+            # Acquire a continuous stream of pulses
+            # ------
+
+            if 'seed' in inp_dict:
+                np.random.seed(inp_dict['seed'])
+            with metrics.profiler(0):
+                nevents = run_listmode(inp_dict,t,scint_dict,self.energy,self.intensity,writer,verbose=verbose,metrics=metrics)
+
+        elif inp_dict.get('nworkers',0) > 0 or (counter and inp_dict.get('mem',0) > 0):
+
+            # Simulate the pulses on a pool of processes (in work units
+            # without nworkers)
+            # ------
+
+            nevents = run_parallel(inp_dict,t,scint_dict,self.energy,self.intensity,writer,verbose=verbose,metrics=metrics)
+
+        elif inp_dict.get('mem',0) > 0:
+
+            # Stream the pulses through all the stages
+            # ------
+
+            if 'seed' in inp_dict:
+                np.random.seed(inp_dict['seed'])
+            nevents = run_stream(inp_dict,t,scint_dict,self.energy,self.intensity,writer,verbose=verbose,metrics=metrics)
+
+        else:
+
+            with metrics.profiler(0):
+                result = self.simulate(inp_dict, metrics)
+                pulses_dig, time_int, nevents = result['pulses'], result['time_int'], result['nevents']
+                if verbose and 'start' in result:
+                    print ' - started from stage', result['start'], '(cache size %.1f MB)' % result['cache_mb']
+                del result
+
+                # Save pulses
+                # ------
+
+                with metrics.stage('write',len(pulses_dig)):
+                    if oformat == 'dacsim':
+                        writer.append(pulses_dig)
+                        writer.append_time_int(time_int)
+                    else:
+                        pileup_log = pulses_dig.meta['pileup'].tolist()
+                        npulses = len(pulses_dig)
+                        pulses_dig = pulses_dig.to_list()
+                        save_output([t_dig,pulses_dig,pileup_log,time_int,inp_dict,self.coeff_dict,self.energy,self.intensity],inp_dict['output'])
+                        summary['path'] = output_path(inp_dict['output'] + '.npy')
+                del pulses_dig
+
+        if oformat == 'dacsim':
+            writer.close()
+            npulses = writer.nevents
+            summary['path'] = writer.path
+            if writer.waveforms != 1:
+                summary['waveforms'] = writer.pulses.nrows
+        summary['events'], summary['pulses'] = int(nevents), int(npulses)
+        summary['pileup'] = metrics.counters.get('pileup',0)
+        summary['pileup_events'] = metrics.counters.get('pileup_events',0)
+
+        if verbose:
+            if 'acq_time' in inp_dict:
+                print ' -', nevents - npulses, 'pulses not acquired (below the threshold, in the dead time or hold-off)'
+            else:
+                print ' -', nevents - npulses, 'events below the trigger threshold'
+            print ' -', npulses, 'pulses saved to', summary['path']
+            if 'waveforms' in summary:
+                print ' -', summary['waveforms'], 'waveforms saved'
+            print ' -', summary['pileup_events'], 'events with pile-up,', summary['pileup'], 'pile-up pulses'
+        self._write_metrics(inp_dict, metrics, summary, verbose)
+        if verbose and inp_dict.get('profile') is not None and os.path.exists(profile_file):
+            print ' - profile of chunk', inp_dict['profile'], 'saved to', profile_file
+        return summary
+
+    def _write_metrics(self, inp_dict, metrics, summary, verbose):
+        if 'metrics' in inp_dict:
+            summary['metrics'] = output_path(inp_dict['metrics'])
+            metrics.write(summary['metrics'])
+            if verbose: print ' - metrics saved to', summary['metrics']
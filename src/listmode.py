@@ -0,0 +1,423 @@
+'''
+Listmode
+========
+
+module with the list-mode engine: a continuous acquisition of a given
+duration instead of a number of isolated pulses.
+
+The particles arrive at random times (a Poisson process with rate
+cre + crp). The analog signal of all the pulses is built as one continuous
+trace at the sampling times of the digitizer (with the response of the
+grid-free engine, see analog.apply_analog_samples), so that the pile-up is
+the sum of the overlapping pulses, also across the acquisition windows.
+A trigger runs on the trace as on a real digitizer:
+
+ - a trigger is a crossing of the threshold (rising edge)
+ - hold-off: a crossing only triggers if the signal was below the threshold
+   for at least the hold-off time before it (re-arming of the trigger)
+ - dead time: the crossings during the acquisition window of a trigger,
+   and during the dead time after it, are lost (non-paralyzable)
+
+Each trigger acquires a window of samples (with pretrig_samp samples up to
+the trigger sample, as digitize.digitize_batch), which is written to the
+output when it is complete.
+
+The trace is processed in blocks of samples. The responses of the photons
+that extend past the current block are kept in a ring buffer of fixed size
+(AnalogTrace), and the trigger keeps only the samples of the windows that
+are still open (TriggerStream), so the memory does not depend on the
+duration of the acquisition.
+'''
+
+import numpy as np
+from scipy import signal, constants
+from pulsebatch import PulseBatch
+from pmt import dynode_gain
+from analog import spe_parameters, spe_samples
+from digitize import quantize
+from noise import noise_source
+from simulation import PRECISIONS, generate_batch
+from metrics import Metrics, photon_count, peak_rss
+
+BLOCK = 2**18 # samples of the trace processed at once
+
+MAX_PHOTONS = 100000 # photons whose responses are calculated at once
+
+def arrival_counts(inp_dict, n):
+    '''Number of arrivals of each particle type, among n arrivals.
+    With ptype all, each arrival is an electron with probability
+    cre / (cre + crp).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        n (int): total number of arrivals
+
+    Returns:
+        counts (dict): number of arrivals of each particle type
+
+    '''
+    if inp_dict['ptype'] == 'all':
+        nel = np.random.binomial(n, float(inp_dict['cre']) / (inp_dict['cre'] + inp_dict['crp']))
+        return {'electron': nel, 'proton': n - nel}
+    return {inp_dict['ptype']: n}
+
+def dead_time_filter(index, dead):
+    '''Selects the triggers accepted with a non-paralyzable dead time:
+    a trigger is accepted if it comes at least dead samples after the
+    last accepted trigger.
+
+    Args:
+        index (numpy.array): sorted sample indices of the candidate triggers
+
+        dead (int): dead time [samples]
+
+    Returns:
+        accepted (numpy.array): boolean array, True for the accepted triggers
+
+    '''
+    n = len(index)
+    accepted = np.ones(n, dtype = bool)
+    if n == 0:
+        return accepted
+
+    # a candidate after a gap longer than the dead time is always accepted
+    accepted[1:] = np.diff(index) >= dead
+
+    # inside each cluster of short gaps, jump from the accepted trigger to
+    # the first candidate after its dead time, one trigger per cluster at
+    # each iteration (as pileup.pileup_groups)
+    current = np.flatnonzero(~accepted[1:])
+    current = current[accepted[current]]
+    while len(current) > 0:
+        following = np.searchsorted(index, index[current] + dead, side = 'left')
+        following = following[following < n]
+        following = following[~accepted[following]]
+        accepted[following] = True
+        current = following
+    return accepted
+
+class AnalogTrace(object):
+    '''Continuous analog trace (pmt and cable) at the sampling times,
+    built one block of samples at a time. The responses of the photons
+    are added to a buffer of block + horizon samples; when a block is
+    complete, its samples are returned and the buffer is shifted.
+
+    Args:
+        step (float): sampling period [ns]
+
+        dt (float): time step of the equivalent fine-grid chain [ns]
+
+        plen (float): maximum time of the photons after the arrival [ns]
+
+    Kwargs:
+        block (int): samples of each block
+
+        ndynodes (int): the number of  dynodes
+
+        delta (float): the average gain of the dynodes
+
+        sigma (float): the time spread of the gaussian response [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        cutoff (float): cutoff of the cable filter [GHz]
+
+        impedance (float): impedance of the cable [ohm]
+
+        nsigma (float): half width of the tabulated region of the response [sigma]
+
+    '''
+
+    def __init__(self, step, dt, plen, block = BLOCK, ndynodes = 10, delta = 4, sigma = 5., transittime = 100., cutoff = 0.1, impedance = 50, nsigma = 5.):
+        self.step = step
+        self.block = block
+        self.ndynodes = ndynodes
+        self.delta = delta
+        self.sigma = sigma
+        self.impedance = impedance
+        self.nsigma = nsigma
+        self.tau, self.delay = spe_parameters(dt,sigma,transittime,cutoff,impedance)
+        xhi = sigma**2/self.tau + nsigma*sigma
+        width = int(np.ceil((xhi + nsigma*sigma) / step)) + 1
+        horizon = int(np.ceil((plen + self.delay + xhi) / step)) + width + 2
+        self.near = np.zeros(block + horizon) # responses near the photons
+        self.impulses = np.zeros(block + horizon) # starts of the exponential tails
+        self.zi = np.zeros(1) # state of the tail recursion
+        self.start = 0 # index of the first sample of the buffer
+
+    def add(self, batch, arrival):
+        '''Adds the responses of the photons of a batch of pulses.
+
+        Args:
+            batch (PulseBatch): the photon times of the pulses, from their arrival [ns]
+
+            arrival (numpy.array): arrival time of each pulse, from the first
+            sample of the current block [ns]
+
+        '''
+        ww = dynode_gain(batch,self.ndynodes,self.delta)
+        scale = ww * self.impedance * constants.e * 1.e9
+        times = batch.values[batch.offsets[0]:batch.offsets[-1]] + np.repeat(arrival, batch.counts) + self.delay
+        for i in range(0, len(times), MAX_PHOTONS):
+            k0, values, start = spe_samples(times[i:i+MAX_PHOTONS], scale[i:i+MAX_PHOTONS], self.step, self.sigma, self.tau, self.nsigma)
+            k = k0[:,np.newaxis] + np.arange(values.shape[1])
+            self.near += np.bincount(k.ravel(), weights = values.ravel(), minlength = len(self.near))
+            self.impulses += np.bincount(k0 + values.shape[1], weights = start, minlength = len(self.impulses))
+
+    def advance(self):
+        '''Completes the current block.
+
+        Returns:
+            trace (numpy.array): the samples of the block [V]
+
+        '''
+        block = self.block
+        tail, self.zi = signal.lfilter([1.], [1., -np.exp(-self.step/self.tau)], self.impulses[:block], zi = self.zi)
+        trace = self.near[:block] + tail
+        for buf in [self.near, self.impulses]:
+            buf[:-block] = buf[block:]
+            buf[-block:] = 0.
+        self.start += block
+        return trace
+
+class TriggerStream(object):
+    '''Trigger and acquisition windows on a continuous trace, pushed one
+    block of samples at a time.
+
+    Args:
+        threshold (float): trigger threshold [V]
+
+        samples (int): samples of each window
+
+        pretrig (int): samples of the window up to the trigger sample
+
+    Kwargs:
+        dead (int): samples after the end of a window during which the
+        triggers are lost
+
+        holdoff (int): samples below the threshold needed before a crossing
+
+        noise (float): noise level used to pad the windows that start
+        before the beginning of the trace [V]
+
+    '''
+
+    def __init__(self, threshold, samples, pretrig, dead = 0, holdoff = 0, noise = 0.):
+        self.threshold = threshold
+        self.samples = samples
+        self.pretrig = pretrig
+        self.gap = samples - pretrig + 1 + dead # minimum samples between accepted triggers
+        self.holdoff = holdoff
+        self.noise = noise
+        self.history = np.zeros(0) # samples from history_start that can still be in a window
+        self.history_start = 0
+        self.pending = np.zeros(0, dtype = int) # accepted triggers with incomplete windows
+        self.last_above = False # last sample of the previous block above threshold
+        self.last_fall = -2**62 # last sample that went below the threshold
+        self.next_allowed = -2**62 # first sample after the dead time
+        self.counters = {'crossings': 0, 'holdoff': 0, 'dead': 0}
+
+    def push(self, trace):
+        '''Adds the next block of samples.
+
+        Args:
+            trace (numpy.array): the samples [V]
+
+        Returns:
+            triggers (numpy.array): sample index of the triggers whose
+            windows are complete
+
+            windows (numpy.array): (triggers x samples) matrix with the
+            windows [V]
+
+        '''
+        start = self.history_start + len(self.history)
+
+        # rising and falling edges
+        # ------
+
+        above = trace >= self.threshold
+        before = np.empty(len(trace), dtype = bool)
+        before[0] = self.last_above
+        before[1:] = above[:-1]
+        rising = np.flatnonzero(above & ~before) + start
+        falling = np.flatnonzero(~above & before) + start
+        self.counters['crossings'] += len(rising)
+
+        # hold-off: time below the threshold before each crossing
+        # ------
+
+        fall = np.append(self.last_fall, falling)
+        previous = fall[np.searchsorted(fall, rising, side = 'right') - 1]
+        armed = rising - previous >= self.holdoff
+        self.counters['holdoff'] += len(rising) - np.count_nonzero(armed)
+        if len(falling) > 0:
+            self.last_fall = falling[-1]
+        if len(trace) > 0:
+            self.last_above = above[-1]
+
+        # dead time
+        # ------
+
+        candidates = rising[armed]
+        live = candidates >= self.next_allowed
+        candidates = candidates[live]
+        accepted = candidates[dead_time_filter(candidates, self.gap)]
+        self.counters['dead'] += len(rising) - np.count_nonzero(~armed) - len(accepted)
+        if len(accepted) > 0:
+            self.next_allowed = accepted[-1] + self.gap
+        self.pending = np.append(self.pending, accepted)
+
+        # complete windows
+        # ------
+
+        self.history = np.append(self.history, trace)
+        end = start + len(trace)
+        first = self.pending - self.pretrig + 1
+        done = first + self.samples <= end
+        triggers, first = self.pending[done], first[done]
+        index = first[:,np.newaxis] + np.arange(self.samples) - self.history_start
+        windows = self.history[np.maximum(index, 0)]
+        before = index < 0
+        windows[before] = np.random.normal(0, self.noise, np.count_nonzero(before))
+        self.pending = self.pending[~done]
+
+        # keep the samples that can still be in a window
+        keep = end - self.pretrig
+        if len(self.pending) > 0:
+            keep = min(keep, self.pending[0] - self.pretrig + 1)
+        keep = max(keep, self.history_start)
+        self.history = self.history[keep - self.history_start:]
+        self.history_start = keep
+        return triggers, windows
+
+def run_listmode(inp_dict, t, scint_dict, energy, intensity, writer, verbose = False, metrics = None, block = BLOCK):
+    '''Simulates a continuous acquisition of duration acq_time (input
+    parameter, [s]) and writes the acquired windows. The metadata of each
+    window are the trigger time "time" [s], the particle type and energy of
+    the last pulse that arrived before the trigger (-1 and nan if the noise
+    triggered before the first pulse) and the number of other pulses that
+    arrived within the window ("pileup"). The windows that are not complete
+    at the end of the acquisition are not written.
+
+    The input parameters holdoff and deadtime [ns] (default 0) set the
+    hold-off and the dead time after the end of each window. The noise of
+    the trace can be white, band-limited or colored (see noise.noise_source).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        writer (OutputWriter): the output
+
+    Kwargs:
+        verbose (bool): print the progress of the acquisition
+
+        metrics (Metrics): records the total time of each stage and the
+        counters "arrivals", "crossings", "holdoff" (crossings before the
+        re-arming), "dead" (crossings lost in the dead time), "pileup" and
+        "pileup_events"
+
+        block (int): samples of the trace processed at once
+
+    Returns:
+        narrivals (int): number of pulses that arrived during the acquisition
+
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    stages = Metrics()
+    step = 1. / inp_dict['sampf']
+    plen = t[-1] + (t[1] - t[0])
+    rate = inp_dict['cre'] + inp_dict['crp']
+    nsamples = int(round(inp_dict['acq_time'] * 1e9 / step))
+    nblocks = (nsamples + block - 1) // block
+    dtype = PRECISIONS[inp_dict.get('precision','double')]
+    amprange = [inp_dict['minV'], inp_dict['maxV']]
+    dV = (amprange[1] - amprange[0]) / 2**inp_dict['bits']
+
+    trace = AnalogTrace(step, t[1] - t[0], plen, block, inp_dict['ndyn'], inp_dict['delta'], inp_dict['sigma'],
+                        inp_dict['tt'], inp_dict['cutoff'], inp_dict['imp'])
+    trigger = TriggerStream(inp_dict['th_lvl'] * dV, inp_dict['samples'], inp_dict['pretrig_samp'],
+                            int(round(inp_dict.get('deadtime',0) / step)), int(round(inp_dict.get('holdoff',0) / step)),
+                            inp_dict['noise'])
+    noise = noise_source(inp_dict)
+    arrivals = np.zeros(0) # arrival time [ns], particle type and energy of the recent pulses
+    ptypes, energies = np.zeros(0, dtype = int), np.zeros(0)
+    narrivals, last_time = 0, 0.
+
+    if verbose: print 'Acquiring', inp_dict['acq_time'], 's in', nblocks, 'blocks of', block, 'samples. . .'
+    for b in range(nblocks):
+        length = min(block, nsamples - b * block)
+        t0 = b * block * step
+
+        # Pulses arriving in the block
+        # ------
+
+        with stages.stage('generate') as record:
+            n = np.random.poisson(rate * length * step * 1e-9)
+            batch = generate_batch(arrival_counts(inp_dict, n), t, scint_dict, energy, intensity, inp_dict)
+            arrival = np.sort(np.random.random_sample(len(batch))) * length * step
+            record['events'], record['photons'] = len(batch), photon_count(batch)
+        narrivals += len(batch)
+
+        # Analog trace and noise
+        # ------
+
+        with stages.stage('analog', len(batch), record['photons']):
+            trace.add(batch, arrival)
+            samples = trace.advance()[:length]
+        with stages.stage('noise'):
+            samples = (samples + noise.take(length)).astype(dtype, copy = False)
+
+        # Trigger and windows
+        # ------
+
+        with stages.stage('trigger') as record:
+            triggers, windows = trigger.push(samples)
+            record['events'] = len(triggers)
+            times = triggers * step # [ns]
+            arrivals = np.append(arrivals, t0 + arrival)
+            ptypes = np.append(ptypes, batch.meta['ptype'])
+            energies = np.append(energies, batch.meta['energy'])
+            # last pulse before each trigger: -1 (ptype -1, energy nan) if
+            # the noise triggers before the first arrival
+            last = np.searchsorted(arrivals, times, side = 'right') - 1
+            lo = np.searchsorted(arrivals, times - (inp_dict['pretrig_samp'] - 1) * step, side = 'left')
+            hi = np.searchsorted(arrivals, times + (inp_dict['samples'] - inp_dict['pretrig_samp'] + 1) * step, side = 'left')
+            meta = {'time': times * 1e-9, 'ptype': np.append(ptypes, -1)[last], 'energy': np.append(energies, np.nan)[last],
+                    'pileup': np.maximum(hi - lo - 1, 0)}
+
+            # keep the pulses that can still be in a window
+            keep = np.searchsorted(arrivals, (trigger.history_start - 1) * step, side = 'left')
+            keep = min(keep, max(len(arrivals) - 1, 0))
+            arrivals, ptypes, energies = arrivals[keep:], ptypes[keep:], energies[keep:]
+
+        if len(triggers) > 0:
+            with stages.stage('digitize', len(triggers)):
+                pulses_dig = PulseBatch.from_matrix(quantize(windows, inp_dict['bits'], amprange), meta)
+            with stages.stage('write', len(triggers)):
+                writer.append(pulses_dig)
+                writer.append_time_int(np.diff(np.append(last_time, meta['time'])))
+            last_time = meta['time'][-1]
+            metrics.count('pileup', np.sum(meta['pileup']))
+            metrics.count('pileup_events', np.count_nonzero(meta['pileup']))
+
+        if verbose and (b + 1) % max(nblocks // 10, 1) == 0:
+            print ' - %.3g s acquired, %d pulses, %d windows' % ((b * block + length) * step * 1e-9, narrivals, writer.nevents)
+
+    for name, tot in stages.summary().items():
+        metrics.add({'stage': name, 'chunk': 0, 'wall': tot['wall'], 'cpu': tot['cpu'], 'events': tot['events'],
+                     'photons': tot['photons'], 'peak_rss_mb': peak_rss()})
+    metrics.count('arrivals', narrivals)
+    for name, value in trigger.counters.items():
+        metrics.count(name, value)
+    return narrivals
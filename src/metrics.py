@@ -0,0 +1,195 @@
+'''
+Metrics
+=======
+
+module with the instrumentation of the simulation stages.
+
+A Metrics object records, for each execution of a stage (e.g. pmt, cable,
+digitize), the wall and CPU time, the number of events and photons
+processed and the peak resident memory of the process. It also keeps
+counters, such as the events rejected by the trigger and the pile-up
+pulses. The records are passed to callback functions as soon as each stage
+ends (e.g. print_record for the progress output of dacsim) and can be saved
+as a JSON or CSV file.
+
+Usage::
+
+    metrics = Metrics([print_record])
+    with metrics.stage('pmt', events = len(batch)) as record:
+        ...
+    metrics.count('rejected', 10)
+    metrics.write('metrics.json')
+
+One chunk of the simulation can also be profiled with cProfile
+(see Metrics.profiler).
+'''
+
+import time, json, csv, resource, cProfile, pstats
+from contextlib import contextmanager
+
+COLUMNS = ['stage', 'chunk', 'wall', 'cpu', 'events', 'photons', 'peak_rss_mb'] # columns of the CSV file
+
+def cpu_time():
+    '''CPU time (user + system) of the process [s]'''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss():
+    '''Peak resident memory of the process [MB]'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def photon_count(batch):
+    '''Number of photons in a batch of photon pulses'''
+    return int(batch.offsets[-1] - batch.offsets[0])
+
+def print_record(record):
+    '''Callback that prints one line for each stage'''
+    line = ' - %-10s %8.3f s wall %8.3f s cpu %8d events' % (record['stage'], record['wall'], record['cpu'], record['events'])
+    if record['photons'] > 0:
+        line += ' %10d photons' % record['photons']
+    else:
+        line += ' ' * 18
+    print line + ' %8.1f MB' % record['peak_rss_mb']
+
+class Metrics(object):
+    '''Collects the metrics of the stages of a simulation.
+
+    Kwargs:
+        callbacks (list): functions called with the record (dict) of each
+        stage when the stage ends
+
+        profile (int): index of the chunk (or work unit) to be profiled
+        with cProfile. None to disable the profiling
+
+        profile_file (str): file where the profile statistics are saved
+        (see pstats). Default "dacsim.prof"
+
+    '''
+
+    def __init__(self, callbacks = None, profile = None, profile_file = 'dacsim.prof'):
+        self.callbacks = list(callbacks or [])
+        self.profile = profile
+        self.profile_file = profile_file
+        self.records = []
+        self.counters = {}
+        self.chunk = 0 # index of the current chunk, stored in the records
+
+    @contextmanager
+    def stage(self, name, events = 0, photons = 0):
+        '''Context manager that records one execution of a stage.
+        The record is yielded, so that the numbers of events and photons
+        can be updated inside the block.
+
+        Args:
+            name (str): name of the stage
+
+        Kwargs:
+            events (int): number of events processed
+
+            photons (int): number of photons processed
+
+        '''
+        record = {'stage': name, 'chunk': self.chunk, 'events': int(events), 'photons': int(photons)}
+        wall, cpu = time.time(), cpu_time()
+        yield record
+        record['wall'] = time.time() - wall
+        record['cpu'] = cpu_time() - cpu
+        record['peak_rss_mb'] = peak_rss()
+        self.add(record)
+
+    def add(self, record):
+        '''Adds a record (e.g. from another process) and calls the callbacks'''
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def count(self, name, value):
+        '''Adds value to the counter name'''
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def merge(self, records, counters):
+        '''Adds the records and counters collected by another Metrics object
+        (e.g. in a worker process).
+
+        Args:
+            records (list): the records
+
+            counters (dict): the counters
+
+        '''
+        for record in records:
+            self.add(record)
+        for name, value in counters.items():
+            self.count(name, value)
+
+    @contextmanager
+    def profiler(self, chunk):
+        '''Context manager that runs the block with cProfile if chunk is
+        the chunk selected for profiling, and saves the statistics to
+        profile_file. The chunk index is also stored in the records of
+        the stages run in the block.
+
+        Args:
+            chunk (int): index of the chunk
+
+        '''
+        self.chunk = chunk
+        if self.profile is None or chunk != self.profile:
+            yield
+            return
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(self.profile_file)
+
+    def summary(self):
+        '''Totals of each stage.
+
+        Returns:
+            stages (dict): for each stage, the number of calls, the wall and
+            cpu time [s], the events and photons processed and the throughput
+            [events/s, photons/s]
+
+        '''
+        stages = {}
+        for record in self.records:
+            tot = stages.setdefault(record['stage'], {'calls': 0, 'wall': 0., 'cpu': 0., 'events': 0, 'photons': 0})
+            tot['calls'] += 1
+            for key in ['wall', 'cpu', 'events', 'photons']:
+                tot[key] += record[key]
+        for tot in stages.values():
+            tot['events_per_s'] = tot['events'] / tot['wall'] if tot['wall'] > 0 else 0.
+            tot['photons_per_s'] = tot['photons'] / tot['wall'] if tot['wall'] > 0 else 0.
+        return stages
+
+    def write(self, fname):
+        '''Saves the metrics. With extension ".csv", one row per record
+        (see COLUMNS), followed by one row per counter (in the columns stage
+        and events). Otherwise JSON, with the summary, the counters, the
+        peak memory and the records.
+
+        Args:
+            fname (str): name of the file
+
+        '''
+        f = open(fname, 'wb' if fname.endswith('.csv') else 'w')
+        if fname.endswith('.csv'):
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for record in self.records:
+                writer.writerow([record[key] for key in COLUMNS])
+            for name, value in sorted(self.counters.items()):
+                writer.writerow([name, '', '', '', value, '', ''])
+        else:
+            json.dump({'stages': self.summary(), 'counters': self.counters, 'records': self.records,
+                       'peak_rss_mb': max([peak_rss()] + [r['peak_rss_mb'] for r in self.records])},
+                      f, indent = 1, sort_keys = True)
+        f.close()
+
+def print_profile(fname, n = 20):
+    '''Prints the n functions with the largest cumulative time
+    from a profile file written by Metrics.profiler'''
+    pstats.Stats(fname).sort_stats('cumulative').print_stats(n)
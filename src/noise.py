@@ -0,0 +1,209 @@
+'''
+Noise
+=====
+
+module with the electronic noise at the sampling times of the digitizer.
+
+The noise stage of the grid chain (see cable.apply_noise_batch) draws the
+noise at every point of the time axis of the pulses, although the digitizer
+keeps only one point in ratio = dt_sampling / dt. With the input
+"noise_engine samples", the pulses are instead decimated to the sampling
+times first and the noise is drawn only there (apply_noise_samples), for
+the whole batch at once. The trigger is then found on the sampled pulses,
+as on a real digitizer.
+
+A NoiseSource also draws the noise used by the digitizer to pad the windows
+that exceed the pulses. Besides white noise, it can give band-limited
+(input "noise_cutoff") or colored noise (input "noise_psd"): this noise is
+read from a bank of noise samples calculated once (see noise_bank), with
+slices of the bank starting at random positions, instead of being filtered
+again for every pulse.
+
+With counter-based random numbers (input "rng counter", see streams module),
+the noise of each sample (or the start of the slice of the bank) is keyed
+by the event and the sample, so that it does not depend on the other
+events of the batch.
+'''
+
+from collections import OrderedDict
+import numpy as np
+from pulsebatch import PulseBatch
+from streams import counter_rng
+
+BANK_SIZE = 2**20 # samples of a noise bank
+MAX_BANKS = 4 # noise banks kept in the cache (the bank depends on the seed of the run)
+
+_banks = OrderedDict() # cache of the noise banks, the most recently used last
+
+def noise_bank(level, step, cutoff = None, psd = None, size = BANK_SIZE, seed = None):
+    '''Bank of colored noise samples, from white noise shaped in the
+    frequency domain. The bank is circular (it continues from its last
+    sample to the first without discontinuity) and is calculated once for
+    each set of arguments and then cached (the MAX_BANKS banks used last).
+
+    Args:
+        level (float): rms of the noise [V]
+
+        step (float): sampling period [ns]
+
+    Kwargs:
+        cutoff (float): cutoff of a first order lowpass on the noise [GHz]
+
+        psd (str): name of a file with two columns, the frequency [GHz] and
+        the power spectral density of the noise (any unit, interpolated;
+        zero above the last frequency)
+
+        size (int): number of samples of the bank
+
+        seed (int): seed of the white noise (random if None)
+
+    Returns:
+        bank (numpy.array): the noise samples (read-only) [V]
+
+    '''
+    key = (float(level), float(step), cutoff, psd, int(size), seed)
+    if key in _banks:
+        _banks[key] = _banks.pop(key)
+    else:
+        while len(_banks) >= MAX_BANKS:
+            _banks.popitem(last = False)
+        white = np.random.RandomState(seed).normal(0, 1, size)
+        f = np.fft.rfftfreq(size, step)
+        shape = np.ones(len(f))
+        if cutoff is not None:
+            shape /= 1 + (f / cutoff)**2
+        if psd is not None:
+            freq, density = np.loadtxt(psd, unpack = True)
+            shape *= np.interp(f, freq, density, right = 0.)
+        shape[0] = 0. # no offset
+        bank = np.fft.irfft(np.fft.rfft(white) * np.sqrt(shape), size)
+        bank *= level / bank.std()
+        bank.flags.writeable = False
+        _banks[key] = bank
+    return _banks[key]
+
+class NoiseSource(object):
+    '''Source of electronic noise samples.
+
+    Args:
+        level (float): rms of the noise [V]
+
+    Kwargs:
+        bank (numpy.array): bank of noise samples (see noise_bank). If None,
+        the noise is white and drawn when it is needed
+
+        rng (CounterRandom): counter-based random numbers for the noise of
+        the events (see rows). numpy.random if None
+
+        stage (str): stage of the counter-based random numbers
+
+    '''
+
+    def __init__(self, level, bank = None, rng = None, stage = 'noise'):
+        self.level = level
+        self.bank = bank
+        self.rng = rng
+        self.stage = stage
+
+    def take(self, n):
+        '''Noise samples. From a bank, the samples are a slice of the bank
+        (a read-only view, or a copy of several slices if n is larger than
+        the bank).
+
+        Args:
+            n (int): number of samples
+
+        Returns:
+            noise (numpy.array): the samples [V]
+
+        '''
+        if self.bank is None:
+            return np.random.normal(0, self.level, n)
+        size = len(self.bank)
+        if n > size:
+            return np.concatenate([self.take(min(size, n - i)) for i in range(0, n, size)])
+        start = np.random.randint(size - n + 1)
+        return self.bank[start:start+n]
+
+    def rows(self, nrows, ncols, events = None):
+        '''Noise samples for nrows pulses of ncols samples. With
+        counter-based random numbers, the noise of each pulse is keyed by
+        its event and the slices of the bank wrap around its end.
+
+        Kwargs:
+            events (numpy.array): the event of each pulse (see streams
+            module), needed with counter-based random numbers
+
+        Returns:
+            noise (numpy.array): (nrows x ncols) matrix of samples [V]
+
+        '''
+        if self.rng is None:
+            return self.take(nrows * ncols).reshape(nrows, ncols)
+        events = np.asarray(events)[:,np.newaxis]
+        if self.bank is None:
+            return self.rng.normal(self.stage, events, np.arange(ncols), self.level)
+        size = len(self.bank)
+        start = (self.rng.uniform(self.stage, events) * size).astype(int)
+        return self.bank[(start + np.arange(ncols)) % size]
+
+def colored_noise(inp_dict):
+    '''True if the input defines band-limited or colored noise'''
+    return 'noise_cutoff' in inp_dict or 'noise_psd' in inp_dict
+
+def noise_source(inp_dict, stage = 'noise'):
+    '''NoiseSource of the input parameters noise, noise_cutoff, noise_psd
+    and noise_bank (size of the bank, default BANK_SIZE), at the sampling
+    frequency of the digitizer. The bank is drawn with the input seed, so
+    that it is the same in all the processes of a simulation.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Kwargs:
+        stage (str): stage of the counter-based random numbers (input
+        "rng counter"), noise or digitize
+
+    Returns:
+        source (NoiseSource): the noise source
+
+    '''
+    rng = counter_rng(inp_dict)
+    if not colored_noise(inp_dict):
+        return NoiseSource(inp_dict['noise'], rng = rng, stage = stage)
+    bank = noise_bank(inp_dict['noise'], 1. / inp_dict['sampf'], inp_dict.get('noise_cutoff'), inp_dict.get('noise_psd'),
+                      inp_dict.get('noise_bank', BANK_SIZE), inp_dict.get('seed'))
+    return NoiseSource(inp_dict['noise'], bank, rng, stage)
+
+def apply_noise_samples(batch, t, sampfreq, source, block = 256):
+    '''Decimates a batch of pulses to the sampling times of the digitizer
+    (one point in ratio, as digitize.digitize_batch) and adds the noise at
+    these times only, with the precision of the pulses.
+
+    Args:
+        batch (PulseBatch): input pulses
+
+        t (numpy.array): time axis of the pulses
+
+        sampfreq (float): sampling frequency of the digitizer [GHz]
+
+        source (NoiseSource): the noise
+
+    Kwargs:
+        block (int): number of pulses drawn at once (limits the
+        memory of the temporary arrays)
+
+    Returns:
+        newbatch (PulseBatch): the sampled pulses with noise [V]
+
+        tk (numpy.array): the sampling times
+
+    '''
+    ratio = max(int((1. / (t[1] - t[0])) / sampfreq), 1)
+    pulses = batch.as_matrix()[:,::ratio]
+    newpulses = np.empty(pulses.shape, dtype = np.result_type(pulses.dtype, np.float32))
+    events = batch.meta.get('event')
+    for i in range(0, len(pulses), block):
+        rows = pulses[i:i+block]
+        newpulses[i:i+block] = rows + source.rows(*rows.shape, events = None if events is None else events[i:i+block])
+    return PulseBatch.from_matrix(newpulses, batch.meta), t[::ratio]
@@ -0,0 +1,299 @@
+'''
+Output
+======
+
+module with the functions used to write and read the output files.
+
+The output of a simulation is a directory "<output>.dacsim" containing:
+
+ - header.json: the input dictionary, the scintillator coefficients, the energy
+   spectra, the digitized time axis and the number of pulses
+ - pulses.npy: the digitized pulses, as one (n x samples) integer array
+ - pileup_log.npy: the number of pile-up pulses in each event
+ - time_int.npy: the time intervals between pulses [s]
+ - <key>.npy: the other per-event metadata (e.g. ptype, energy, and the
+   features of the pulses, see features module)
+
+With the waveforms of a subset of the events only, pulses.npy contains the
+saved waveforms and the metadata "waveform" is the row of each event in it
+(-1 if its waveform was not saved).
+
+All the arrays are .npy files that can be appended to while streaming and
+read without pickle. OutputReader memory-maps them, so that single pulses or
+chunks of pulses can be read without loading the whole file.
+'''
+
+import os, json, struct
+import numpy as np
+from pulsebatch import PulseBatch
+from features import extract_features
+
+EXTENSION = '.dacsim'
+
+HEADER_LEN = 128 # fixed length of the header of the appendable .npy files
+
+class NpyWriter(object):
+    '''Writes a 2D array to a .npy file one block of rows at a time.
+    The header has a fixed length and is rewritten with the final
+    number of rows when the writer is closed, so the file can be read
+    with numpy.load (also with mmap_mode).
+
+    Args:
+        fname (str): name of the file
+
+        dtype (numpy.dtype): type of the data
+
+        ncols (int): number of columns (None for a 1D array)
+
+    '''
+
+    def __init__(self, fname, dtype, ncols = None):
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.ncols = ncols
+        self.nrows = 0
+        self.f = open(fname, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        if self.ncols is None:
+            shape = (int(self.nrows),)
+        else:
+            shape = (int(self.nrows), int(self.ncols))
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(self.dtype), shape)
+        preamble = np.lib.format.magic(1, 0) + struct.pack('<H', HEADER_LEN - 10)
+        header = header.ljust(HEADER_LEN - len(preamble) - 1) + '\n'
+        self.f.seek(0)
+        self.f.write(preamble + header.encode('latin1'))
+
+    def append(self, rows):
+        '''Appends rows to the file.
+
+        Args:
+            rows (numpy.array): the rows to be written
+
+        '''
+        rows = np.ascontiguousarray(rows, dtype = self.dtype)
+        if self.ncols is not None:
+            rows = rows.reshape(-1, self.ncols)
+        self.f.seek(0, 2)
+        rows.tofile(self.f)
+        self.nrows += len(rows)
+
+    def close(self):
+        '''Writes the final header and closes the file.'''
+        self._write_header()
+        self.f.close()
+
+class OutputWriter(object):
+    '''Writes the output directory of a simulation, one batch of
+    digitized pulses at a time.
+
+    Args:
+        path (str): path of the output directory (EXTENSION is added
+        if missing)
+
+        samples (int): number of digitized samples of each pulse
+
+        nbits (int): resolution of the digitizer [bit]
+
+    Kwargs:
+        header (dict): information saved in header.json (must be
+        serializable with json)
+
+        features (dict): parameters of features.extract_features. If
+        given, the features of the pulses are saved as metadata
+
+        waveforms (int): the waveform of one event in waveforms is saved
+        (1 all, 0 none). The events are counted from the first
+        appended event
+
+    '''
+
+    def __init__(self, path, samples, nbits, header = None, features = None, waveforms = 1):
+        if not path.endswith(EXTENSION):
+            path += EXTENSION
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.header = dict(header or {})
+        self.header['samples'] = samples
+        self.header['nbits'] = nbits
+        self.pulses = NpyWriter(os.path.join(path, 'pulses.npy'), np.min_scalar_type(2**nbits), samples)
+        self.time_int = NpyWriter(os.path.join(path, 'time_int.npy'), float)
+        self.meta = None
+        self.features = features
+        self.waveforms = waveforms
+        self.nevents = 0
+        self._write_header()
+
+    def _write_header(self):
+        self.header['npulses'] = self.pulses.nrows
+        self.header['nevents'] = self.nevents
+        f = open(os.path.join(self.path, 'header.json'), 'w')
+        json.dump(self.header, f, sort_keys = True)
+        f.close()
+
+    def append(self, batch):
+        '''Appends digitized pulses and their metadata.
+
+        Args:
+            batch (PulseBatch): the digitized pulses
+
+        '''
+        # the width of an empty batch is 0: use the number of samples
+        pulses = batch.as_matrix().reshape(len(batch), self.pulses.ncols)
+        meta = dict(batch.meta)
+        if self.features is not None:
+            meta.update(extract_features(pulses, **self.features))
+        if self.waveforms != 1:
+            if self.waveforms == 0:
+                keep = np.zeros(len(batch), dtype = bool)
+            else:
+                keep = (self.nevents + np.arange(len(batch))) % self.waveforms == 0
+            meta['waveform'] = np.where(keep, self.pulses.nrows + np.cumsum(keep) - 1, -1)
+            pulses = pulses[keep]
+        if self.meta is None:
+            self.meta = {}
+            for key, value in meta.items():
+                name = 'pileup_log' if key == 'pileup' else key
+                self.meta[key] = NpyWriter(os.path.join(self.path, name + '.npy'), value.dtype)
+        self.pulses.append(pulses)
+        for key, writer in self.meta.items():
+            writer.append(meta[key])
+        self.nevents += len(batch)
+
+    def append_time_int(self, time_int):
+        '''Appends time intervals between pulses.
+
+        Args:
+            time_int (numpy.array): the time intervals [s]
+
+        '''
+        self.time_int.append(time_int)
+
+    def close(self):
+        '''Closes the files and writes the final header.'''
+        self.pulses.close()
+        self.time_int.close()
+        for writer in (self.meta or {}).values():
+            writer.close()
+        self._write_header()
+
+def load_output(path, mmap_mode = None):
+    '''Reads an output directory.
+
+    Args:
+        path (str): path of the output directory
+
+    Kwargs:
+        mmap_mode (str): memory-map the arrays (see numpy.load)
+
+    Returns:
+        header (dict): the content of header.json
+
+        arrays (dict): the arrays of the output (pulses, pileup_log,
+        time_int and the other metadata), by file name
+
+    '''
+    if not os.path.isdir(path) and os.path.isdir(path + EXTENSION):
+        path += EXTENSION
+    f = open(os.path.join(path, 'header.json'))
+    header = json.load(f)
+    f.close()
+    arrays = {}
+    for fname in sorted(os.listdir(path)):
+        if fname.endswith('.npy'):
+            arrays[fname[:-4]] = np.load(os.path.join(path, fname), mmap_mode = mmap_mode, allow_pickle = False)
+    return header, arrays
+
+class OutputReader(object):
+    '''Lazy reader of an output directory. The arrays are memory-mapped:
+    the pulses are read from disk only when they are accessed.
+
+    Usage::
+
+        out = OutputReader('output/myout')
+        first = out[0]                        # first pulse
+        some = out[100:200]                   # pulses 100 to 199
+        single = out[out.find(pileup_log=0)]  # pulses without pile-up
+        for batch in out.chunks(10000):       # PulseBatch with metadata
+            ...
+
+    Args:
+        path (str): path of the output directory
+
+    '''
+
+    def __init__(self, path):
+        self.header, arrays = load_output(path, mmap_mode = 'r')
+        self.pulses = arrays.pop('pulses')
+        self.time_int = arrays.pop('time_int')
+        self.meta = arrays
+        self.waveform = arrays.get('waveform')
+        self.t_dig = np.array(self.header['t_dig'])
+        self.inp_dict = self.header['inp_dict']
+
+    def __len__(self):
+        if self.waveform is not None:
+            return len(self.waveform)
+        return len(self.pulses)
+
+    def __getitem__(self, index):
+        '''Pulses by event index (int, slice, array of indices or boolean
+        mask). ValueError if the waveform of an event was not saved'''
+        if self.waveform is None:
+            return np.asarray(self.pulses[index])
+        rows = np.asarray(self.waveform[index])
+        if np.any(rows < 0):
+            raise ValueError('the waveform of the event was not saved (see the metadata "waveform")')
+        return np.asarray(self.pulses[rows])
+
+    def find(self, **conditions):
+        '''Finds the events that satisfy conditions on the metadata,
+        without reading the pulses. Each condition is either a value
+        (equality) or a function applied to the metadata array.
+
+        Example: find(pileup_log = 0, energy = lambda e: e > 500)
+
+        Returns:
+            index (numpy.array): indices of the selected events
+
+        '''
+        mask = np.ones(len(self), dtype = bool)
+        for key, condition in conditions.items():
+            if callable(condition):
+                mask &= condition(np.asarray(self.meta[key]))
+            else:
+                mask &= np.asarray(self.meta[key]) == condition
+        return np.flatnonzero(mask)
+
+    def take(self, index):
+        '''Reads a set of events with their metadata.
+
+        Args:
+            index (numpy.array): indices of the events (or slice)
+
+        Returns:
+            batch (PulseBatch): the pulses and their metadata. If the
+            waveform of some of the events was not saved, the pulses have
+            no samples
+
+        '''
+        meta = dict((key, np.asarray(value[index])) for key, value in self.meta.items())
+        if self.waveform is not None and np.any(meta['waveform'] < 0):
+            return PulseBatch.from_matrix(np.zeros((len(meta['waveform']), 0), dtype = self.pulses.dtype), meta)
+        return PulseBatch.from_matrix(self[index], meta)
+
+    def chunks(self, size = 10000):
+        '''Iterates over the events in chunks.
+
+        Kwargs:
+            size (int): number of events of each chunk
+
+        Returns:
+            batches (iterator): PulseBatch with the pulses and metadata of each chunk
+
+        '''
+        for start in range(0, len(self), size):
+            yield self.take(slice(start, start + size))
@@ -6,42 +6,199 @@ module that simulates pile-up effects
 '''
 
 import numpy as np
+from pulsebatch import PulseBatch
+from kernels import pileup_starts
 
-def apply_pileup(plist,rate,plen):
+def apply_pileup(plist,rate,plen,tint_array=None):
     '''Applies pile-up to the scintillator pulses.
 
     Args:
-        plist (list): the list of scintillator pulses.
+        plist (list): the list of scintillator pulses. A PulseBatch
+        is also accepted
 
         rate (float): the total count rate
 
         plen (float): pulse length [ns]
 
+    Kwargs:
+        tint_array (numpy.array): the time intervals between pulses [s].
+        Drawn from the exponential distribution if not given
+
     Returns:
         plist (list): the list of scintillator pulses with pileup.
+        If the input is a PulseBatch, a PulseBatch is returned, with the
+        metadata of the first pulse of each event and the number of
+        pile-up pulses in the metadata "pileup"
+
+        pileup_log (list): the number of pile-up pulses in each event
+
+        tint_array (numpy.array): the time intervals between pulses [s]
 
     '''
-    if type(plist) == np.ndarray:
-        plist = list(plist)
-    n = len(plist)
-    tint_array = np.random.exponential(1./rate,n-1) # time intervals
-    i = 0
-    t_0 = 0
-    counter = 0
-    pileup_log = []
-    for tint in tint_array:
-        if (tint + t_0) < plen*1e-9:
-            plist[i] = np.append(plist[i],plist[i+1]+(tint+t_0)*1e9)
-            del plist[i+1]
-            t_0 += tint
-            counter += 1
+    if isinstance(plist, PulseBatch):
+        batch = plist
+    else:
+        batch = PulseBatch.from_list(list(plist))
+    n = len(batch)
+    if tint_array is None:
+        tint_array = np.random.exponential(1./rate,n-1) # time intervals
+
+    # Find the pile-up events
+    # ------
+
+    starts, arrival = pileup_groups(tint_array,plen)
+    first = np.flatnonzero(starts)
+    pileup_log = np.diff(np.append(first,n)) - 1
+
+    # Shift the photon times of the piled-up pulses
+    # ------
+
+    group = np.cumsum(starts) - 1
+    shift = ((arrival - arrival[first][group]) * 1e9).astype(float)
+    values = batch.values[batch.offsets[0]:batch.offsets[-1]]
+    values = values + np.repeat(shift,batch.counts)
+    offsets = batch.offsets[np.append(first,n)] - batch.offsets[0]
+
+    meta = dict((key, value[first]) for key, value in batch.meta.items())
+    meta['pileup'] = pileup_log
+    newbatch = PulseBatch(values, offsets, meta)
+
+    if isinstance(plist, PulseBatch):
+        return newbatch, pileup_log, tint_array
+    return newbatch.to_list(), pileup_log.tolist(), tint_array
+
+class PileupStream(object):
+    '''Applies pile-up to a stream of chunks of scintillator pulses.
+    The last event of each chunk is held back until the next chunk shows
+    whether more pulses pile up on it, so the result is the same as
+    applying pile-up to all the pulses at once.
+
+    Args:
+        rate (float): the total count rate
+
+        plen (float): pulse length [ns]
+
+    '''
+
+    def __init__(self, rate, plen):
+        self.rate = rate
+        self.plen = plen
+        self.pending = None # pulses of the last (open) event
+        self.pending_tint = np.zeros(0)
+
+    def push(self, batch):
+        '''Adds a chunk of pulses to the stream.
+
+        Args:
+            batch (PulseBatch): the scintillator pulses
+
+        Returns:
+            newbatch (PulseBatch): the completed events (see apply_pileup)
+
+            tint_array (numpy.array): the time intervals drawn for the
+            pulses of this chunk [s]
+
+        '''
+        if self.pending is None:
+            tint_array = np.random.exponential(1./self.rate,max(len(batch)-1,0))
+            pulses = batch
         else:
-            i += 1
-            t_0 = 0
-            pileup_log.append(counter)
-            counter = 0
-
-    if len(plist) - len(pileup_log) == 1:
-        pileup_log.append(counter)
-            
-    return plist, pileup_log, tint_array
+            tint_array = np.random.exponential(1./self.rate,len(batch))
+            pulses = PulseBatch.concatenate([self.pending,batch])
+        if len(pulses) == 0:
+            return pulses, tint_array
+        tint = np.append(self.pending_tint,tint_array)
+        newbatch, pileup_log, tint = apply_pileup(pulses,self.rate,self.plen,tint)
+
+        # hold back the last event
+        last = len(pulses) - 1 - pileup_log[-1]
+        self.pending = pulses.take(np.arange(last,len(pulses)))
+        self.pending_tint = tint[last:]
+        return newbatch.take(np.arange(len(newbatch)-1)), tint_array
+
+    def flush(self):
+        '''Closes the stream.
+
+        Returns:
+            newbatch (PulseBatch): the last event (see apply_pileup)
+
+        '''
+        if self.pending is None:
+            return PulseBatch(np.zeros(0), np.zeros(1))
+        newbatch = apply_pileup(self.pending,self.rate,self.plen,self.pending_tint)[0]
+        self.pending = None
+        self.pending_tint = np.zeros(0)
+        return newbatch
+
+def pileup_groups(tint_array,plen):
+    '''Finds which pulses start a new event.
+    A pulse is piled up on the first pulse of the current event if it
+    arrives less than plen after it.
+
+    Args:
+        tint_array (numpy.array): the time intervals between pulses [s]
+
+        plen (float): pulse length [ns]
+
+    Returns:
+        starts (numpy.array): boolean array, True for the first pulse
+        of each event
+
+        arrival (numpy.array): arrival time of each pulse [s]
+
+    '''
+    n = len(tint_array) + 1
+    window = plen*1e-9
+
+    # extended precision so that differences of arrival times
+    # are as accurate as the sum of the intervals
+    arrival = np.zeros(n, dtype = np.longdouble)
+    np.cumsum(tint_array, out = arrival[1:])
+
+    starts = pileup_starts(tint_array, arrival, window)
+    return starts, arrival
+
+def local_pileup_groups(tint_array,plen):
+    '''Finds which pulses start a new event, as pileup_groups, with the
+    time of each pulse from the first pulse of its event summed over the
+    intervals of the event only, one after the other. The grouping and the
+    times of an event then depend only on its own intervals, and can be
+    calculated again for a single event (see simulation.replay_event).
+
+    Args:
+        tint_array (numpy.array): the time intervals between pulses [s]
+
+        plen (float): pulse length [ns]
+
+    Returns:
+        starts (numpy.array): boolean array, True for the first pulse
+        of each event
+
+        shift (numpy.array): time of each pulse from the first pulse of
+        its event [ns]
+
+    '''
+    tint_array = np.asarray(tint_array, dtype = float)
+    n = len(tint_array) + 1
+    window = plen*1e-9
+    starts = np.ones(n, dtype = bool)
+    starts[1:] = tint_array >= window
+    since = np.zeros(n) # time from the first pulse of the event [s]
+
+    # the clusters of short intervals are independent: the pulses at the
+    # same position of all the clusters are processed at once
+    first = np.flatnonzero(starts)
+    length = np.diff(np.append(first, n))
+    position = 1
+    while True:
+        keep = length > position
+        first, length = first[keep], length[keep]
+        if len(first) == 0:
+            break
+        i = first + position
+        local = since[i-1] + tint_array[i-1]
+        new = local >= window
+        starts[i[new]] = True
+        since[i] = np.where(new, 0., local)
+        position += 1
+    return starts, since * 1e9
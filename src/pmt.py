@@ -6,7 +6,11 @@ module with the photomultiplier response function
 '''
 
 import numpy as np
-from scipy import stats, constants
+from scipy import stats, constants, fftpack
+from pulsebatch import PulseBatch
+from kernels import histogram_rows
+
+_kernels = {} # cache of the gaussian responses
 
 
 def apply_pmt(pulse,t,ndynodes=10,delta=4,sigma=5.,transittime=100.):
@@ -46,9 +50,7 @@ def apply_pmt(pulse,t,ndynodes=10,delta=4,sigma=5.,transittime=100.):
     # -------
 
     dt = t[1]-t[0]
-    t2 = np.arange(-5*sigma,5*sigma,dt)
-    y = stats.norm.pdf(t2, loc=0, scale=sigma)
-    y /= sum(y)
+    y = pmt_kernel(dt,sigma)
 
     # Convolve pulse with gaussian response
     # -------
@@ -66,3 +68,165 @@ def apply_pmt(pulse,t,ndynodes=10,delta=4,sigma=5.,transittime=100.):
     newpulse *= constants.e / (dt*1.e-9)
 
     return newpulse
+
+def pmt_kernel(dt,sigma):
+    '''Gaussian response of the pmt, normalized to unit sum.
+    The response is calculated once for each (dt, sigma) and then cached.
+
+    Args:
+        dt (float): time step [ns]
+
+        sigma (float): the time spread of the gaussian response [ns]
+
+    Returns:
+        y (numpy.array): the response, sampled from -5 sigma to 5 sigma
+
+    '''
+    key = (float(dt), float(sigma))
+    if key not in _kernels:
+        t2 = np.arange(-5*sigma,5*sigma,dt)
+        y = stats.norm.pdf(t2, loc=0, scale=sigma)
+        y /= sum(y)
+        y.flags.writeable = False
+        _kernels[key] = y
+    return _kernels[key]
+
+def histogram_batch(batch,t,weights=None,dtype=float,block=256):
+    '''Histograms all the pulses of a batch at once, with the same
+    binning as numpy.histogram(pulse,bins=t).
+
+    Args:
+        batch (PulseBatch): the photon pulses
+
+        t (numpy.array): the bin edges
+
+    Kwargs:
+        weights (numpy.array): weight of each photon (same length as batch.values)
+
+        dtype (numpy.dtype): type of the histograms
+
+        block (int): number of events histogrammed at once (limits the
+        memory of the temporary arrays)
+
+    Returns:
+        hist (numpy.array): (events x len(t)-1) matrix with the histograms
+
+    '''
+    nbins = len(t) - 1
+    hist = np.zeros((len(batch),nbins), dtype=dtype)
+    for i in range(0,len(batch),block):
+        j = min(i+block,len(batch))
+        lo, hi = batch.offsets[i], batch.offsets[j]
+        w = None if weights is None else weights[lo-batch.offsets[0]:hi-batch.offsets[0]]
+        hist[i:j] = histogram_rows(batch.values[lo:hi], batch.offsets[i:j+1] - lo, t, w)
+    return hist
+
+def fft_convolve_rows(rows,kernel,nout,block=16):
+    '''Convolves each row of a matrix with a kernel using the FFT.
+    Equivalent to numpy.convolve(row,kernel)[:nout] for each row.
+
+    Args:
+        rows (numpy.array): 2D array of signals
+
+        kernel (numpy.array): the kernel
+
+        nout (int): number of output samples to keep
+
+    Kwargs:
+        block (int): number of rows transformed at once (limits the
+        memory of the temporary arrays)
+
+    Returns:
+        out (numpy.array): (rows x nout) matrix, with the type of rows
+
+    '''
+    nfft = fftpack.next_fast_len(rows.shape[1] + len(kernel) - 1)
+    fkernel = np.fft.rfft(kernel,nfft)
+    out = np.zeros((rows.shape[0],nout), dtype=rows.dtype)
+    nkeep = min(nout,rows.shape[1] + len(kernel) - 1)
+    for i in range(0,rows.shape[0],block):
+        frows = np.fft.rfft(rows[i:i+block],nfft,axis=1)
+        out[i:i+block,:nkeep] = np.fft.irfft(frows * fkernel,nfft,axis=1)[:,:nkeep]
+    return out
+
+def dynode_gain(batch,ndynodes=10,delta=4,rng=None):
+    '''Draws the number of electrons at the anode for each photon of a batch,
+    with poisson statistics at the first dynode.
+
+    Args:
+        batch (PulseBatch): the photon pulses from the scintillator
+
+    Kwargs:
+        ndynodes (int): the number of  dynodes
+
+        delta (float): the average gain of the dynodes
+
+        rng (CounterRandom): counter-based random numbers, keyed by the
+        event and the photon (see streams module). numpy.random if None
+
+    Returns:
+        ww (numpy.array): the number of electrons, one per value of the batch
+
+    '''
+    if rng is not None:
+        return (rng.poisson('pmt',delta-1,*rng.batch_values('pmt',batch))+1) * delta**(ndynodes-1)
+    return (np.random.poisson(delta-1,len(batch.values))+1) * delta**(ndynodes-1)
+
+def apply_pmt_batch(batch,t,ndynodes=10,delta=4,sigma=5.,transittime=100.,dtype=float,rng=None):
+    '''Adds the pmt response to a batch of photon pulses (see apply_pmt).
+    All the pulses are histogrammed with one bincount and convolved
+    with the cached gaussian response using the FFT.
+
+    Args:
+        batch (PulseBatch): the photon pulses from the scintillator
+
+        t (numpy.array): the time axis of the pulses
+
+    Kwargs:
+        ndynodes (int): the number of  dynodes
+
+        delta (float): the average gain of the dynodes
+
+        sigma (float): the time spread of the gaussian response [ns]
+
+        transittime (float): the transit time of the pmt [ns]
+
+        dtype (numpy.dtype): type of the pulses (e.g. numpy.float32 to
+        halve the memory). The FFT is always calculated in double precision
+
+        rng (CounterRandom): random numbers of the dynode gain (see dynode_gain)
+
+    Returns:
+        newbatch (PulseBatch): the current pulses produced by the pmt,
+        one row of len(t) samples per event
+
+    '''
+
+    # add poisson noise due to electron multiplication statistics
+    # -------
+
+    ww = dynode_gain(batch,ndynodes,delta,rng)
+
+    # histogram the data
+    # -------
+
+    hist = histogram_batch(batch,t,ww,dtype)
+
+    # Convolve the pulses with the gaussian response,
+    # including the transit time as an offset
+    # -------
+
+    dt = t[1]-t[0]
+    y = pmt_kernel(dt,sigma)
+    shift = int(transittime/dt)
+    newpulses = np.zeros((len(batch),len(t)), dtype=dtype)
+    if shift < len(t):
+        newpulses[:,shift:] = fft_convolve_rows(hist,y,len(t)-shift)
+    del hist
+
+    # Convert the pulses from n_electrons to current
+    # -----
+
+    newpulses *= constants.e / (dt*1.e-9)
+
+    return PulseBatch.from_matrix(newpulses, batch.meta)
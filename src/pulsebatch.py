@@ -0,0 +1,204 @@
+'''
+Pulsebatch
+==========
+
+module with the container used to pass pulses between the modules.
+
+A PulseBatch stores a set of pulses of different lengths (e.g. the photon
+times of the scintillator pulses) in one flat buffer plus an array of
+offsets, instead of a list of separate arrays. Pulses with the same length
+(e.g. the waveforms from the pmt, cable and digitizer) can be viewed as
+an (events x samples) matrix without copying.
+'''
+
+import numpy as np
+
+class PulseBatch(object):
+    '''Ragged batch of pulses.
+    Pulse i is values[offsets[i]:offsets[i+1]].
+
+    Args:
+        values (numpy.array): flat buffer with the values of all the pulses
+
+        offsets (numpy.array): start of each pulse in values, followed by
+        the end of the last pulse (length = number of pulses + 1)
+
+    Kwargs:
+        meta (dict): per-event metadata. Each value is an array with one
+        entry per pulse
+
+    '''
+
+    def __init__(self, values, offsets, meta = None):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        if meta is None:
+            meta = {}
+        self.meta = dict((key, np.asarray(value)) for key, value in meta.items())
+        for key, value in self.meta.items():
+            if len(value) != len(self):
+                raise ValueError('metadata "%s" has %d entries for %d pulses' % (key, len(value), len(self)))
+
+    @classmethod
+    def from_counts(cls, values, counts, meta = None):
+        '''Builds a batch from a flat buffer and the length of each pulse.
+
+        Args:
+            values (numpy.array): flat buffer with the values of all the pulses
+
+            counts (numpy.array): number of values of each pulse
+
+        Kwargs:
+            meta (dict): per-event metadata
+
+        Returns:
+            batch (PulseBatch): the batch
+
+        '''
+        offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+        return cls(values, offsets, meta)
+
+    @classmethod
+    def from_list(cls, pulses, meta = None):
+        '''Builds a batch from a list of arrays.
+
+        Args:
+            pulses (list): list of pulses
+
+        Kwargs:
+            meta (dict): per-event metadata
+
+        Returns:
+            batch (PulseBatch): the batch
+
+        '''
+        counts = np.array([len(p) for p in pulses], dtype = np.int64)
+        if len(pulses) > 0:
+            values = np.concatenate(pulses)
+        else:
+            values = np.zeros(0)
+        return cls.from_counts(values, counts, meta)
+
+    @classmethod
+    def from_matrix(cls, matrix, meta = None):
+        '''Builds a batch from an (events x samples) matrix.
+        The values buffer is a view of the matrix.
+
+        Args:
+            matrix (numpy.array): 2D array with one pulse per row
+
+        Kwargs:
+            meta (dict): per-event metadata
+
+        Returns:
+            batch (PulseBatch): the batch
+
+        '''
+        matrix = np.ascontiguousarray(matrix)
+        n, width = matrix.shape
+        offsets = np.arange(n + 1, dtype = np.int64) * width
+        return cls(matrix.reshape(-1), offsets, meta)
+
+    @classmethod
+    def concatenate(cls, batches):
+        '''Joins several batches into one.
+        Only the metadata present in all the batches is kept.
+
+        Args:
+            batches (list): list of PulseBatch
+
+        Returns:
+            batch (PulseBatch): the joined batch
+
+        '''
+        batches = list(batches)
+        values = np.concatenate([b.values for b in batches])
+        counts = np.concatenate([b.counts for b in batches])
+        keys = set(batches[0].meta)
+        for b in batches[1:]:
+            keys &= set(b.meta)
+        meta = dict((key, np.concatenate([b.meta[key] for b in batches])) for key in keys)
+        return cls.from_counts(values, counts, meta)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def counts(self):
+        '''Number of values of each pulse'''
+        return np.diff(self.offsets)
+
+    @property
+    def width(self):
+        '''Common length of the pulses, None if the lengths differ'''
+        counts = self.counts
+        if len(counts) == 0:
+            return 0
+        if np.all(counts == counts[0]):
+            return int(counts[0])
+        return None
+
+    def event_index(self):
+        '''Returns the index of the pulse each value belongs to.
+
+        Returns:
+            index (numpy.array): array with the same length as values
+
+        '''
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def as_matrix(self):
+        '''Returns the pulses as an (events x samples) matrix.
+        This is a view of the values buffer; all the pulses must
+        have the same length.
+
+        Returns:
+            matrix (numpy.array): 2D array with one pulse per row
+
+        '''
+        width = self.width
+        if width is None:
+            raise ValueError('pulses in the batch have different lengths')
+        return self.values.reshape(len(self), width)
+
+    def take(self, index):
+        '''Selects a subset of the pulses.
+
+        Args:
+            index (numpy.array): indices of the pulses to keep, or boolean
+            mask with one entry per pulse
+
+        Returns:
+            batch (PulseBatch): new batch with the selected pulses
+
+        '''
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        counts = self.counts[index]
+        offsets = np.zeros(len(index) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+        src = np.repeat(self.offsets[:-1][index] - offsets[:-1], counts)
+        src += np.arange(offsets[-1])
+        meta = dict((key, value[index]) for key, value in self.meta.items())
+        return PulseBatch(self.values[src], offsets, meta)
+
+    def to_list(self):
+        '''Returns the pulses as a list of arrays (views of the values buffer).
+
+        Returns:
+            pulses (list): list of pulses
+
+        '''
+        if len(self) == 0:
+            return []
+        values = self.values[self.offsets[0]:self.offsets[-1]]
+        return np.split(values, self.offsets[1:-1] - self.offsets[0])
@@ -7,6 +7,7 @@ module with scintillator functions
 
 import os
 import numpy as np
+from pulsebatch import PulseBatch
 
 def load_coefficients():
     '''Reads the scintillator coefficients from the 
@@ -91,7 +92,68 @@ def scintillator(ptype, coeff_dict, plen = 600, dt = 0.05):
         print 'ERROR! ptype not valid!'
         return 0
 
-def generate_pulses(n, t, amp, energy, spectrum, k = 10., lc = 1., qeff = 1.):
+def decay_components(ptype, coeff_dict, plen = 600):
+    '''Components of the scintillator pulse shape, as probabilities of
+    a photon emitted before the end of the pulse.
+
+    Args:
+        ptype (str): type of pulse. Can be "electron" or "proton"
+
+        coeff_dict (dict): dictionary with scintillator coefficients
+
+    Kwargs:
+        plen (float): pulse length [ns]
+
+    Returns:
+        decay (numpy.array): (2 x number of components) array with the
+        decay constants [ns] and the probability of each component (the
+        integral of the component up to plen, normalized)
+
+    '''
+    coeff = np.array(coeff_dict[ptype], dtype = float)
+    tau, amp = coeff[:,0], coeff[:,1]
+    weight = amp * tau * -np.expm1(-plen / tau)
+    return np.array([tau, weight / weight.sum()])
+
+def sample_times_continuous(nphots, decay, plen, uniform = None):
+    '''Samples the photon times of many pulses from the sum of exponentials
+    of the scintillator, without a time axis: for each photon a component
+    is chosen with its probability and the time is drawn from the
+    exponential distribution of the component, truncated at plen.
+    The cost per photon does not depend on the pulse length or on a
+    time step.
+
+    Args:
+        nphots (numpy.array): number of photons of each pulse
+
+        decay (numpy.array): decay constants and probabilities of the
+        components (see decay_components)
+
+        plen (float): pulse length [ns]
+
+    Kwargs:
+        uniform (numpy.array): one uniform random number per photon (e.g.
+        counter-based, see streams module). Drawn from numpy.random if None
+
+    Returns:
+        times (numpy.array): flat array with the photon times of all
+        the pulses, one pulse after the other [ns]
+
+    '''
+    tau, prob = decay[0], decay[1] / np.sum(decay[1])
+    cdf = np.append(0., np.cumsum(prob))
+    cdf[-1] = 1.
+
+    # one uniform number per photon: its position within the interval
+    # of the chosen component is again uniform
+    # ------
+
+    u = np.random.random_sample(int(np.sum(nphots))) if uniform is None else uniform
+    component = np.minimum(cdf.searchsorted(u, side = 'right') - 1, len(tau) - 1)
+    u = np.minimum((u - cdf[component]) / prob[component], 1.)
+    return -tau[component] * np.log1p(u * np.expm1(-plen / tau[component]))
+
+def generate_pulses(n, t, amp, energy, spectrum, k = 10., lc = 1., qeff = 1., decay = None):
     '''Generates scintillator pulses selcting random times
     according to the scintillator pulse shape.
     
@@ -113,13 +175,98 @@ def generate_pulses(n, t, amp, energy, spectrum, k = 10., lc = 1., qeff = 1.):
 
         qeff (float): quantum efficiency of the PMT. Implemented here
         and not in the pmt module to speed up the calculation
+
+        decay (numpy.array): components of the pulse shape (see
+        decay_components). If given, the photon times are continuous,
+        drawn from the components up to the end of the time axis t
+        (see sample_times_continuous) instead of from amp
     
     Returns:
         mypulses (list): list containing the simulated pulses. Each pulse
         consists of an array of times of photon production
     
     '''
-    
+
+    if n == 0:
+        return []
+    times, mynphots, nphots = _generate_times(n, t, amp, energy, spectrum, k, lc, qeff, decay)
+    mypulses = np.split(times, np.cumsum(mynphots)[:-1])
+    return mypulses
+
+def generate_pulse_batch(n, t, amp, energy, spectrum, k = 10., lc = 1., qeff = 1., decay = None):
+    '''Same as generate_pulses, but returns the pulses as a PulseBatch.
+    The deposited energy of each pulse [keVee] is stored in the
+    metadata "energy".
+
+    Args:
+        n (int): the number of pulses to be generated
+
+        t (numpy.array): time axis of the scintillator pulse shape
+
+        amp (numpy.array): amplitude of the scintillator pulse shape
+
+        energy (numpy.array): energy axis [keVee]
+
+        spectrum (numpy.array): normalized spectrum
+
+    Kwargs:
+        k (float): conversion from keVee to number of photons
+
+        lc (float): light collection efficiency
+
+        qeff (float): quantum efficiency of the PMT
+
+        decay (numpy.array): components of the pulse shape, to sample
+        continuous photon times (see generate_pulses)
+
+    Returns:
+        batch (PulseBatch): the photon times of the simulated pulses
+
+    '''
+    times, mynphots, nphots = _generate_times(n, t, amp, energy, spectrum, k, lc, qeff, decay)
+    return PulseBatch.from_counts(times, mynphots, {'energy': nphots / k})
+
+def _generate_times(n, t, amp, energy, spectrum, k, lc, qeff, decay = None):
+    '''Draws the photon times of n pulses. Returns the flat array of
+    photon times, the number of detected photons of each pulse and the
+    number of photons before the poisson randomization.
+    '''
+    mynphots, nphots = draw_nphots(n, energy, spectrum, k, lc, qeff)
+
+    # Generate the photon times
+    # ------
+
+    if decay is not None:
+        times = sample_times_continuous(mynphots, decay, t[-1] + (t[1] - t[0]))
+    else:
+        times = sample_times(mynphots, t, amp)
+    return times, mynphots, nphots
+
+def draw_nphots(n, energy, spectrum, k = 10., lc = 1., qeff = 1.):
+    '''Draws the number of detected photons of n pulses.
+
+    Args:
+        n (int): the number of pulses
+
+        energy (numpy.array): energy axis [keVee]
+
+        spectrum (numpy.array): normalized spectrum
+
+    Kwargs:
+        k (float): conversion from keVee to number of photons
+
+        lc (float): light collection efficiency
+
+        qeff (float): quantum efficiency of the PMT
+
+    Returns:
+        mynphots (numpy.array): number of detected photons of each pulse
+
+        nphots (numpy.array): number of photons of each pulse before
+        the poisson randomization (energy * k)
+
+    '''
+
     # Convert energy axis to nphots axis
     # ------
 
@@ -136,11 +283,50 @@ def generate_pulses(n, t, amp, energy, spectrum, k = 10., lc = 1., qeff = 1.):
     # ------
 
     mynphots = np.random.poisson(nphots*qeff*lc, n)
+    return mynphots, nphots
 
-    # Generate the pulses list
-    # ------
+def shape_cdf(amp):
+    '''Calculates the cumulative distribution of the scintillator pulse shape.
 
-    mypulses = [np.random.choice(t, numphots, p = amp) for numphots in mynphots]
-    return mypulses
-    
+    Args:
+        amp (numpy.array): amplitude of the scintillator pulse shape
+
+    Returns:
+        cdf (numpy.array): normalized cumulative distribution of amp
+
+    '''
+    cdf = np.cumsum(amp, dtype = float)
+    cdf /= cdf[-1]
+    return cdf
+
+def sample_times(nphots, t, amp, cdf = None, uniform = None):
+    '''Samples the photon times of many pulses with a single
+    inverse-CDF call. The random numbers are drawn in the same order
+    as calling numpy.random.choice(t, n, p = amp) once per pulse, so the
+    distribution (and the random stream) is the same.
 
+    Args:
+        nphots (numpy.array): number of photons of each pulse
+
+        t (numpy.array): time axis of the scintillator pulse shape
+
+        amp (numpy.array): amplitude of the scintillator pulse shape
+
+    Kwargs:
+        cdf (numpy.array): precomputed cumulative distribution of amp
+        (see shape_cdf). Calculated from amp if not given
+
+        uniform (numpy.array): one uniform random number per photon (e.g.
+        counter-based, see streams module). Drawn from numpy.random if None
+
+    Returns:
+        times (numpy.array): flat array with the photon times of all
+        the pulses, one pulse after the other
+
+    '''
+    if cdf is None:
+        cdf = shape_cdf(amp)
+    if uniform is None:
+        uniform = np.random.random_sample(int(np.sum(nphots)))
+    idx = cdf.searchsorted(uniform, side = 'right')
+    return t[idx]
@@ -0,0 +1,171 @@
+'''
+Service
+=======
+
+module with a persistent simulation service.
+
+The service (see serve) keeps a Simulation (see the library module) in a
+long-running process, so that the data files, pulse shapes and kernels are
+loaded once, and reads the requests, one JSON object per line, from the
+standard input or from a Unix socket. Each request is answered with one
+JSON line. The requests are:
+
+ - {"input": {...}}: runs the simulation for an input dictionary (with the
+   same keys and values as the input file, see library.read_input) and
+   writes the output, as dacsim
+ - {"file": "input.txt"}: the same, reading the input file
+ - {"command": "ping"}: checks that the service is running
+ - {"command": "shutdown"}: stops the service
+
+A simulation request can also contain "cwd", the directory where the data
+files are read and the output directory is written (default: the directory
+of the service), and "verbose" to print the progress of the simulation
+(to the standard error when serving on the standard input and output).
+The answer is {"status": "ok", "result": {...}} with the summary of the
+simulation (see library.Simulation.run), or {"status": "error", "error": "..."}.
+'''
+
+import os, sys, stat, json, socket, SocketServer
+from library import Simulation, read_input
+
+def _from_json(value):
+    '''Converts the unicode strings of a decoded JSON object to str'''
+    if isinstance(value, dict):
+        return dict((_from_json(key), _from_json(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+def handle_request(request, simulations):
+    '''Answers one request of the service (see the module documentation).
+
+    Args:
+        request (dict): the request
+
+        simulations (dict): the Simulation of each working directory,
+        created when the directory is first used
+
+    Returns:
+        response (dict): the answer
+
+    '''
+    try:
+        request = _from_json(request)
+        command = request.get('command', 'run')
+        if command in ['ping', 'shutdown']:
+            return {'status': 'ok'}
+        if command != 'run':
+            raise ValueError('unknown command ' + command)
+        cwd = os.getcwd()
+        os.chdir(os.path.realpath(request.get('cwd', cwd)))
+        try:
+            if os.getcwd() not in simulations:
+                simulations[os.getcwd()] = Simulation()
+            inp_dict = request['input'] if 'input' in request else read_input(request['file'])
+            result = simulations[os.getcwd()].run(inp_dict, verbose = request.get('verbose', False))
+        finally:
+            os.chdir(cwd)
+        return {'status': 'ok', 'result': result}
+    except Exception as e:
+        return {'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)}
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    '''Answers the requests of one connection to the socket'''
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'status': 'error', 'error': 'invalid request: %s' % e}
+            else:
+                response = handle_request(request, self.server.simulations)
+                if isinstance(request, dict) and request.get('command') == 'shutdown':
+                    self.server.running = False
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+            if not self.server.running:
+                return
+
+def serve(address = None):
+    '''Runs the service until the shutdown command (or the end of the
+    standard input). The requests are answered one at a time.
+
+    Kwargs:
+        address (str): path of the Unix socket. If None, the requests
+        are read from the standard input and answered on the standard
+        output; the progress of the simulations is then printed to the
+        standard error. A socket left at the path by a previous service
+        is replaced; any other file raises ValueError
+
+    '''
+    simulations = {}
+    if address is None:
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            for line in iter(sys.stdin.readline, ''):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'status': 'error', 'error': 'invalid request: %s' % e}
+                    request = {}
+                else:
+                    response = handle_request(request, simulations)
+                stdout.write(json.dumps(response) + '\n')
+                stdout.flush()
+                if isinstance(request, dict) and request.get('command') == 'shutdown':
+                    break
+        finally:
+            sys.stdout = stdout
+        return
+
+    if os.path.exists(address):
+        if not stat.S_ISSOCK(os.stat(address).st_mode):
+            raise ValueError('%s exists and is not a socket' % address)
+        os.remove(address)
+    server = SocketServer.UnixStreamServer(address, _RequestHandler)
+    server.simulations = simulations
+    server.running = True
+    print 'Serving on', address
+    try:
+        while server.running:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.remove(address)
+
+def request(address, req, timeout = None):
+    '''Sends one request to a service listening on a Unix socket and
+    returns the answer.
+
+    Args:
+        address (str): path of the socket
+
+        req (dict): the request
+
+    Kwargs:
+        timeout (float): timeout of the connection [s] (None: no timeout)
+
+    Returns:
+        response (dict): the answer
+
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(address)
+    f = sock.makefile('rw')
+    try:
+        f.write(json.dumps(req) + '\n')
+        f.flush()
+        return json.loads(f.readline())
+    finally:
+        # the connection stays open until the file is closed too
+        f.close()
+        sock.close()
@@ -0,0 +1,688 @@
+'''
+Simulation
+==========
+
+module that runs the acquisition chain on batches of pulses, either
+on all the pulses at once or streaming them in chunks that fit in a
+given amount of memory
+'''
+
+import multiprocessing
+import numpy as np
+from pulsebatch import PulseBatch
+from scintillator import scintillator, decay_components, generate_pulse_batch, draw_nphots, sample_times, sample_times_continuous
+from pileup import apply_pileup, PileupStream, pileup_groups, local_pileup_groups
+from pmt import apply_pmt_batch
+from cable import apply_cable_batch, apply_noise_batch
+from digitize import digitize_batch
+from noise import colored_noise, noise_source, apply_noise_samples
+from analog import apply_analog_batch, apply_analog_samples
+from metrics import Metrics, photon_count
+from streams import counter_rng, positions
+
+PARTICLES = ['electron', 'proton'] # codes of the metadata "ptype"
+
+PRECISIONS = {'double': np.float64, 'single': np.float32} # type of the analog pulses (input "precision")
+
+UNIT_PHOTONS = 200000 # maximum number of photons in a parallel work unit
+UNIT_EVENTS = 256 # maximum number of events in a parallel work unit
+
+def particle_counts(inp_dict, n):
+    '''Number of pulses of each particle type (see the ptype input).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        n (int): total number of pulses
+
+    Returns:
+        counts (dict): number of pulses for each particle type
+
+    '''
+    if inp_dict['ptype'] == 'all':
+        tot_cr = inp_dict['cre'] + inp_dict['crp']
+        nel = int(float((inp_dict['cre'])/float(tot_cr)) * n)
+        npr = int(float((inp_dict['crp'])/float(tot_cr)) * n)
+        return {'electron': nel, 'proton': npr}
+    return {inp_dict['ptype']: n}
+
+def pulse_shapes(coeff_dict, dt, plen):
+    '''Scintillator pulse shapes of all the particle types.
+
+    Args:
+        coeff_dict (dict): dictionary with scintillator coefficients
+
+        dt (float): time step [ns]
+
+        plen (float): pulse length [ns]
+
+    Returns:
+        t (numpy.array): time axis of the pulse shapes
+
+        scint_dict (dict): pulse shape of each particle type (see
+        scintillator) and its components "<ptype>_decay" up to the end
+        of the time axis (see decay_components)
+
+    '''
+    scint_dict = {}
+    for ptype in ['proton', 'electron']:
+        t, scint_dict[ptype] = scintillator(ptype,coeff_dict,dt=dt,plen=plen)
+        scint_dict[ptype + '_decay'] = decay_components(ptype,coeff_dict,t[-1] + (t[1]-t[0]))
+    return t, scint_dict
+
+def photon_decay(scint_dict, ptype, inp_dict):
+    '''Components of the pulse shape of a particle type used to sample
+    the photon times, or None to sample them on the time axis (input
+    "photon_times", grid or continuous)'''
+    if inp_dict.get('photon_times','grid') == 'continuous':
+        return scint_dict[ptype + '_decay']
+    return None
+
+def generate_batch(counts, t, scint_dict, energy, intensity, inp_dict):
+    '''Generates the scintillator pulses of one or more particle types.
+    The pulses of different types are shuffled. The particle type is
+    stored in the metadata "ptype" (index in PARTICLES).
+
+    Args:
+        counts (dict): number of pulses for each particle type
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+        (see pulse_shapes)
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        batch (PulseBatch): the photon times of the pulses
+
+    '''
+    batches = []
+    for ptype in sorted(counts):
+        batch = generate_pulse_batch(counts[ptype],t,scint_dict[ptype], energy[ptype], intensity[ptype], inp_dict['k'], inp_dict['lc'], inp_dict['qeff'],
+                                     photon_decay(scint_dict, ptype, inp_dict))
+        batch.meta['ptype'] = np.repeat(PARTICLES.index(ptype), len(batch))
+        batches.append(batch)
+    if len(batches) == 1:
+        return batches[0]
+    batch = PulseBatch.concatenate(batches)
+    return batch.take(np.random.permutation(len(batch)))
+
+def acquire_stages(inp_dict):
+    '''Names of the stages applied by acquire, in order. The pmt and the
+    cable are a single "analog" stage with the fused kernel (input "fused")
+    or the grid-free engine (input "engine samples").
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        stages (list): names of the stages
+
+    '''
+    if inp_dict.get('engine','grid') == 'samples' or inp_dict.get('fused',0) == 1:
+        return ['analog', 'noise', 'digitize']
+    return ['pmt', 'cable', 'noise', 'digitize']
+
+def sampled_noise(inp_dict):
+    '''True if the noise is drawn only at the sampling times of the
+    digitizer (input "noise_engine samples", or the grid-free engine,
+    whose pulses are already sampled), see noise.apply_noise_samples'''
+    return inp_dict.get('noise_engine','grid') == 'samples' or inp_dict.get('engine','grid') == 'samples'
+
+def apply_stage(stage, batch, t, inp_dict):
+    '''Applies one stage of the acquisition chain (see acquire_stages).
+
+    Args:
+        stage (str): name of the stage
+
+        batch (PulseBatch): the pulses from the previous stage
+
+        t (numpy.array): time axis of the pulses
+
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        newbatch (PulseBatch): the pulses after the stage
+
+        t (numpy.array): time axis of the new pulses (the sampling times
+        after the analog stage of the grid-free engine and after the
+        noise stage with noise_engine samples)
+
+        triggered (numpy.array): for the digitize stage, boolean array,
+        True for the pulses that passed the trigger threshold. None for
+        the other stages
+
+    '''
+    dtype = PRECISIONS[inp_dict.get('precision','double')]
+    rng = counter_rng(inp_dict)
+    triggered = None
+    if stage == 'analog' and inp_dict.get('engine','grid') == 'samples':
+        tk = np.arange(0, t[-1] + (t[1]-t[0]), 1./inp_dict['sampf'])
+        batch = apply_analog_samples(batch,tk,t[1]-t[0],inp_dict['ndyn'],inp_dict['delta'],inp_dict['sigma'],inp_dict['tt'],
+                                     inp_dict['cutoff'],inp_dict['imp'],dtype=dtype,rng=rng)
+        t = tk
+    elif stage == 'analog':
+        batch = apply_analog_batch(batch,t,inp_dict['ndyn'],inp_dict['delta'],inp_dict['sigma'],inp_dict['tt'],
+                                   inp_dict['cutoff'],inp_dict['imp'],dtype,rng)
+    elif stage == 'pmt':
+        batch = apply_pmt_batch(batch,t,inp_dict['ndyn'],inp_dict['delta'],inp_dict['sigma'],inp_dict['tt'],dtype,rng)
+    elif stage == 'cable':
+        batch = apply_cable_batch(batch,t,inp_dict['cutoff'],inp_dict['imp'])
+    elif stage == 'noise' and sampled_noise(inp_dict):
+        batch, t = apply_noise_samples(batch,t,inp_dict['sampf'],noise_source(inp_dict))
+    elif stage == 'noise':
+        if colored_noise(inp_dict):
+            raise ValueError('noise_cutoff and noise_psd need noise_engine samples or engine samples')
+        batch = apply_noise_batch(batch,inp_dict['noise'],rng=rng)
+    elif stage == 'digitize':
+        batch, triggered = digitize_batch(batch,t,inp_dict['bits'], [inp_dict['minV'],inp_dict['maxV']],inp_dict['sampf'],
+                                          inp_dict['samples'], inp_dict['th_on'], inp_dict['th_lvl'], inp_dict['pretrig_samp'],
+                                          inp_dict['noise'], noise_source(inp_dict,'digitize'))
+    else:
+        raise ValueError('unknown stage "%s"' % stage)
+    return batch, t, triggered
+
+def count_events(metrics, meta, triggered):
+    '''Adds the events rejected by the trigger and the pile-up of a batch
+    (from its metadata) to the counters "rejected", "pileup" and
+    "pileup_events" of metrics'''
+    metrics.count('rejected', len(triggered) - np.count_nonzero(triggered))
+    if 'pileup' in meta:
+        metrics.count('pileup', np.sum(meta['pileup']))
+        metrics.count('pileup_events', np.count_nonzero(meta['pileup']))
+
+def acquire(batch, t, inp_dict, metrics = None):
+    '''Applies the pmt, the cable, the noise and the digitizer to
+    a batch of pulses (with pile-up already applied).
+    The events rejected by the trigger and the pile-up pulses are added
+    to the counters "rejected", "pileup" and "pileup_events" of metrics.
+
+    Args:
+        batch (PulseBatch): the photon times of the pulses
+
+        t (numpy.array): time axis of the pulses
+
+        inp_dict (dict): dictionary with the input parameters
+
+    Kwargs:
+        metrics (Metrics): records the stages
+
+    Returns:
+        pulses_dig (PulseBatch): the digitized pulses that passed the trigger
+
+        triggered (numpy.array): boolean array, True for the pulses
+        that passed the trigger threshold
+
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    nevents, nphot = len(batch), photon_count(batch)
+    pulses = batch
+    for stage in acquire_stages(inp_dict):
+        with metrics.stage(stage, nevents, nphot if stage in ['pmt', 'analog'] else 0):
+            pulses, t, triggered = apply_stage(stage, pulses, t, inp_dict)
+    count_events(metrics, batch.meta, triggered)
+    return pulses, triggered
+
+def chunk_size(inp_dict, t, energy, mem):
+    '''Number of pulses that can be simulated at once within a memory budget.
+    The estimate accounts for the analog waveforms alive at the same time
+    (histogram, pmt, cable and noise stages), for the photon times and for
+    the FFT work space. The memory used by the interpreter and by the
+    loaded modules is not included.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        t (numpy.array): time axis of the pulses
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        mem (float): memory budget [MB]
+
+    Returns:
+        n (int): number of pulses per chunk
+
+    '''
+    maxphot = max(e.max() for e in energy.values()) * inp_dict['k'] * inp_dict['lc'] * inp_dict['qeff']
+    itemsize = np.dtype(PRECISIONS[inp_dict.get('precision','double')]).itemsize
+    per_pulse = itemsize * 4 * len(t) + 8 * 4 * maxphot
+    fixed = 16 * 8 * 6 * len(t) # FFT work space (see pmt.fft_convolve_rows)
+    return max(1, int((mem * 2**20 - fixed) / per_pulse))
+
+def run_stream(inp_dict, t, scint_dict, energy, intensity, writer, verbose = False, metrics = None):
+    '''Simulates the pulses in chunks, pushing each chunk through all the
+    stages and appending the digitized pulses to the output, so that the
+    memory used does not depend on the number of pulses. The chunk size
+    is calculated from the memory budget "mem" [MB] of the input.
+    Pile-up across the chunk boundaries is preserved.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        writer (OutputWriter): the output
+
+    Kwargs:
+        verbose (bool): print the size of the chunks
+
+        metrics (Metrics): records the stages. The chunk selected for
+        profiling is the index of the chunk
+
+    Returns:
+        nevents (int): number of simulated events (before the trigger)
+
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    nchunk = chunk_size(inp_dict, t, energy, inp_dict['mem'])
+    plen = float(inp_dict['samples'])/inp_dict['sampf']
+    tot_cr = inp_dict['cre'] + inp_dict['crp']
+    remaining = particle_counts(inp_dict, inp_dict['nps'])
+    stream = PileupStream(tot_cr,plen)
+    nevents = 0
+
+    if verbose: print 'Simulating', sum(remaining.values()), 'pulses in chunks of', nchunk, '. . .'
+
+    done = False
+    chunk = 0
+    while not done:
+        with metrics.profiler(chunk):
+            ntot = sum(remaining.values())
+            n = min(nchunk, ntot)
+            if n > 0:
+                # draw the particle types of the chunk without replacement,
+                # as if all the pulses were shuffled at once
+                counts = dict(remaining)
+                if len(remaining) == 2:
+                    counts['electron'] = np.random.hypergeometric(remaining['electron'],remaining['proton'],n)
+                    counts['proton'] = n - counts['electron']
+                else:
+                    counts[inp_dict['ptype']] = n
+                for key in counts:
+                    remaining[key] -= counts[key]
+                with metrics.stage('generate', n) as record:
+                    batch = generate_batch(counts, t, scint_dict, energy, intensity, inp_dict)
+                    record['photons'] = photon_count(batch)
+                with metrics.stage('pileup', n):
+                    pulses, tint = stream.push(batch)
+                del batch
+                writer.append_time_int(tint)
+            else:
+                with metrics.stage('pileup'):
+                    pulses = stream.flush()
+                done = True
+            if len(pulses) > 0:
+                nevents += len(pulses)
+                pulses_dig = acquire(pulses, t, inp_dict, metrics)[0]
+                with metrics.stage('write', len(pulses_dig)):
+                    writer.append(pulses_dig)
+        chunk += 1
+
+    return nevents
+
+def counter_pulses(inp_dict, energy, intensity, index, rng):
+    '''Draws the particle type and the number of photons of the pulses
+    with the given indices, from the counter-based random numbers of each
+    pulse (see streams module). With ptype all, the particle type of each
+    pulse is drawn independently, with the probabilities cre / (cre + crp)
+    and crp / (cre + crp).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        index (numpy.array): indices of the pulses
+
+        rng (CounterRandom): the random numbers
+
+    Returns:
+        pulses (dict): arrays with one entry per pulse: "ptype", "nphot",
+        "energy" and "index"
+
+    '''
+    index = np.asarray(index, dtype = np.int64)
+    if inp_dict['ptype'] == 'all':
+        tot_cr = inp_dict['cre'] + inp_dict['crp']
+        proton = rng.uniform('ptype', index) >= float(inp_dict['cre']) / tot_cr
+        ptype = np.where(proton, PARTICLES.index('proton'), PARTICLES.index('electron'))
+    else:
+        ptype = np.repeat(PARTICLES.index(inp_dict['ptype']), len(index))
+    nphot = np.zeros(len(index), dtype = int)
+    edep = np.zeros(len(index))
+    for code, p in enumerate(PARTICLES):
+        sel = ptype == code
+        if np.any(sel):
+            nphots = energy[p][rng.choice('energy', intensity[p], index[sel])] * inp_dict['k']
+            nphot[sel] = rng.poisson('nphot', nphots * inp_dict['qeff'] * inp_dict['lc'], index[sel])
+            edep[sel] = nphots / inp_dict['k']
+    return {'ptype': ptype, 'nphot': nphot, 'energy': edep, 'index': index}
+
+def draw_events(inp_dict, energy, intensity):
+    '''Draws the particle type, the number of photons and the arrival time
+    of all the pulses and groups them into pile-up events. Only a few numbers
+    per pulse are drawn here; the photon times are drawn later, for each
+    work unit (see run_parallel).
+
+    With counter-based random numbers (input "rng counter"), the pulses
+    are drawn by counter_pulses, the interval before each pulse is keyed
+    by its index and the events are grouped by pileup.local_pileup_groups.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+    Returns:
+        pulses (dict): arrays with one entry per pulse: "ptype", "nphot",
+        "energy", "shift" (time of the pulse from the start of its event [ns])
+        and, with counter-based random numbers, "index"
+
+        first (numpy.array): index of the first pulse of each event
+
+        time_int (numpy.array): the time intervals between pulses [s]
+
+    '''
+    plen = float(inp_dict['samples'])/inp_dict['sampf']
+    tot_cr = inp_dict['cre'] + inp_dict['crp']
+    rng = counter_rng(inp_dict)
+    if rng is not None:
+        index = np.arange(inp_dict['nps'], dtype = np.int64)
+        pulses = counter_pulses(inp_dict, energy, intensity, index, rng)
+        time_int = rng.exponential('interval', index[1:], scale = 1./tot_cr)
+        starts, pulses['shift'] = local_pileup_groups(time_int, plen)
+        return pulses, np.flatnonzero(starts), time_int
+
+    counts = particle_counts(inp_dict, inp_dict['nps'])
+    ptype = np.concatenate([ np.repeat(PARTICLES.index(p), counts[p]) for p in sorted(counts) ])
+    if len(counts) > 1:
+        ptype = ptype[np.random.permutation(len(ptype))]
+    nphot = np.zeros(len(ptype), dtype = int)
+    edep = np.zeros(len(ptype))
+    for p in sorted(counts):
+        code = PARTICLES.index(p)
+        mynphots, nphots = draw_nphots(counts[p], energy[p], intensity[p], inp_dict['k'], inp_dict['lc'], inp_dict['qeff'])
+        nphot[ptype == code] = mynphots
+        edep[ptype == code] = nphots / inp_dict['k']
+
+    time_int = np.random.exponential(1./tot_cr,max(len(ptype)-1,0))
+    starts, arrival = pileup_groups(time_int,plen)
+    first = np.flatnonzero(starts)
+    group = np.cumsum(starts) - 1
+    shift = ((arrival - arrival[first][group]) * 1e9).astype(float)
+    pulses = {'ptype': ptype, 'nphot': nphot, 'energy': edep, 'shift': shift}
+    return pulses, first, time_int
+
+def work_units(nphot, first, max_photons = UNIT_PHOTONS, max_events = UNIT_EVENTS):
+    '''Splits the events into work units with at most max_events events and
+    about max_photons photons each, so that units with high-energy events
+    contain fewer events. The units do not depend on the number of workers.
+
+    Args:
+        nphot (numpy.array): number of photons of each pulse
+
+        first (numpy.array): index of the first pulse of each event
+
+    Kwargs:
+        max_photons (int): number of photons per unit
+
+        max_events (int): maximum number of events per unit
+
+    Returns:
+        bounds (numpy.array): index of the first event of each unit, followed
+        by the number of events
+
+    '''
+    if len(first) == 0:
+        return np.zeros(1, dtype = int)
+    event_phot = np.add.reduceat(nphot, first)
+    cumphot = np.cumsum(event_phot) - event_phot
+    unit = (cumphot // max_photons) * (len(first) + 1) + np.arange(len(first)) // max_events
+    new = np.ones(len(first), dtype = bool)
+    new[1:] = unit[1:] != unit[:-1]
+    return np.append(np.flatnonzero(new), len(first))
+
+_worker = {} # data shared with the worker processes
+
+def _init_worker(t, scint_dict, inp_dict, seed, profile = None, profile_file = None):
+    _worker['t'] = t
+    _worker['scint_dict'] = scint_dict
+    _worker['inp_dict'] = inp_dict
+    _worker['seed'] = seed
+    _worker['profile'] = profile
+    _worker['profile_file'] = profile_file
+
+def _simulate_unit(args):
+    '''Simulates one work unit, with the random stream of the unit.
+    Returns the digitized pulses and the records and counters of the
+    stages (see Metrics)'''
+    index, pulses, counts = args
+    metrics = Metrics(profile = _worker['profile'], profile_file = _worker['profile_file'])
+    with metrics.profiler(index):
+        np.random.seed([_worker['seed'], index + 1])
+        with metrics.stage('generate', len(pulses['nphot'])) as record:
+            batch = event_batch(pulses, counts, _worker['t'], _worker['scint_dict'], _worker['inp_dict'])
+            record['photons'] = photon_count(batch)
+        pulses_dig = acquire(batch, _worker['t'], _worker['inp_dict'], metrics)[0]
+    return pulses_dig, metrics.records, metrics.counters
+
+def event_batch(pulses, counts, t, scint_dict, inp_dict):
+    '''Draws the photon times of the pulses of consecutive events (see
+    draw_events) and shifts them within their events. With counter-based
+    random numbers, the photon times of each pulse are keyed by its index
+    and the index of the first pulse of each event is saved in the
+    metadata "event".
+
+    Args:
+        pulses (dict): arrays with one entry per pulse (see draw_events)
+
+        counts (numpy.array): number of pulses of each event
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        batch (PulseBatch): the photon times of the events
+
+    '''
+    starts = np.zeros(len(counts) + 1, dtype = int)
+    np.cumsum(counts, out = starts[1:])
+    meta = {'pileup': counts - 1, 'ptype': pulses['ptype'][starts[:-1]], 'energy': pulses['energy'][starts[:-1]]}
+    rng = counter_rng(inp_dict)
+    if rng is not None:
+        meta['event'] = pulses['index'][starts[:-1]]
+
+    # photon times of the pulses, then shifted within the events
+    nphot = pulses['nphot']
+    ptype = np.repeat(pulses['ptype'], nphot)
+    times = np.empty(len(ptype))
+    if rng is not None:
+        uniform = rng.uniform('photons', np.repeat(pulses['index'], nphot), positions(nphot))
+    for code, name in enumerate(PARTICLES):
+        if name in scint_dict:
+            sel = pulses['ptype'] == code
+            u = None if rng is None else uniform[ptype == code]
+            decay = photon_decay(scint_dict, name, inp_dict)
+            if decay is not None:
+                times[ptype == code] = sample_times_continuous(nphot[sel], decay, t[-1] + (t[1]-t[0]), uniform = u)
+            else:
+                times[ptype == code] = sample_times(nphot[sel], t, scint_dict[name], uniform = u)
+    times += np.repeat(pulses['shift'], nphot)
+
+    event_nphot = np.add.reduceat(nphot, starts[:-1]) if len(counts) > 0 else counts
+    return PulseBatch.from_counts(times, event_nphot, meta)
+
+def run_parallel(inp_dict, t, scint_dict, energy, intensity, writer, verbose = False, metrics = None):
+    '''Simulates the pulses on a pool of "nworkers" processes (input parameter),
+    appending the digitized pulses to the output in the order of the events.
+
+    The particle types, the numbers of photons and the pile-up are drawn
+    first from the master seed (input parameter "seed"). The events are then
+    split into work units balanced by photon count (see work_units) and
+    each unit draws its photon times and electronic noise from its own random
+    stream, seeded by (seed, unit index). For a given seed the output is the
+    same for any number of workers. With counter-based random numbers (input
+    "rng counter"), the output is also the same as without nworkers and mem.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        writer (OutputWriter): the output
+
+    Kwargs:
+        verbose (bool): print the number of work units
+
+        metrics (Metrics): records the stages, including those run by the
+        workers. The chunk selected for profiling is the index of the work
+        unit, profiled in its worker
+
+    Returns:
+        nevents (int): number of simulated events (before the trigger)
+
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    seed = inp_dict['seed']
+    np.random.seed(seed)
+    with metrics.stage('draw', inp_dict['nps']):
+        pulses, first, time_int = draw_events(inp_dict, energy, intensity)
+    writer.append_time_int(time_int)
+    nevents = len(first)
+
+    max_events = UNIT_EVENTS
+    if inp_dict.get('mem',0) > 0:
+        max_events = min(max_events, chunk_size(inp_dict, t, energy, inp_dict['mem']))
+    bounds = work_units(pulses['nphot'], first, UNIT_PHOTONS, max_events)
+    first = np.append(first, len(pulses['nphot']))
+
+    def units():
+        for i in range(len(bounds) - 1):
+            p0, p1 = first[bounds[i]], first[bounds[i+1]]
+            counts = np.diff(first[bounds[i]:bounds[i+1]+1])
+            yield i, dict((key, value[p0:p1]) for key, value in pulses.items()), counts
+
+    nworkers = inp_dict.get('nworkers', 1)
+    if verbose: print 'Simulating', len(pulses['nphot']), 'pulses in', len(bounds) - 1, 'units on', nworkers, 'workers. . .'
+
+    initargs = (t, scint_dict, inp_dict, seed, metrics.profile, metrics.profile_file)
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers, _init_worker, initargs)
+        results = pool.imap(_simulate_unit, units())
+    else:
+        pool = None
+        _init_worker(*initargs)
+        results = (_simulate_unit(unit) for unit in units())
+    try:
+        for chunk, (pulses_dig, records, counters) in enumerate(results):
+            metrics.merge(records, counters)
+            metrics.chunk = chunk
+            with metrics.stage('write', len(pulses_dig)):
+                writer.append(pulses_dig)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return nevents
+
+def replay_event(inp_dict, t, scint_dict, energy, intensity, event):
+    '''Simulates again one event of a simulation with counter-based random
+    numbers (input "rng counter"), without simulating the events before it.
+    The pile-up pulses of the event are found from the intervals after its
+    first pulse, as in pileup.local_pileup_groups. The result is the same
+    as the event in the output of the whole simulation.
+
+    Whether a pulse starts an event depends on the intervals before it in
+    its cluster (the pulses since the last interval longer than the pulse
+    length), which are drawn again to check that event is the first pulse
+    of an event (ValueError if it is piled up on an earlier pulse).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters (with seed)
+
+        t (numpy.array): time axis of the scintillator pulse shapes
+
+        scint_dict (dict): scintillator pulse shape of each particle type
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+        event (int): the event, as the index of its first pulse (metadata
+        "event" of the output)
+
+    Returns:
+        pulses_dig (PulseBatch): the digitized pulse, if it passed the
+        trigger (one or zero pulses)
+
+        triggered (numpy.array): boolean array with one entry, True if
+        the pulse passed the trigger threshold
+
+    '''
+    rng = counter_rng(inp_dict)
+    if rng is None:
+        raise ValueError('replay_event needs rng counter')
+    if not 0 <= event < inp_dict['nps']:
+        raise ValueError('event %d is not in the simulation (nps %d)' % (event, inp_dict['nps']))
+    plen = float(inp_dict['samples'])/inp_dict['sampf']
+    window = plen*1e-9
+    scale = 1./(inp_dict['cre'] + inp_dict['crp'])
+
+    # start of the cluster of the pulse: the last interval longer than
+    # the window before it, searched backwards one block at a time
+    # ------
+
+    first, hi = 0, event
+    while hi > 0:
+        block = np.arange(max(hi - 63, 1), hi + 1)
+        long = np.flatnonzero(rng.exponential('interval', block, scale = scale) >= window)
+        if len(long) > 0:
+            first = block[long[-1]]
+            break
+        hi = block[0] - 1
+    if first < event:
+        starts = local_pileup_groups(rng.exponential('interval', np.arange(first + 1, event + 1), scale = scale), plen)[0]
+        if not starts[-1]:
+            raise ValueError('pulse %d does not start an event (it is piled up on an earlier pulse)' % event)
+
+    index, shift = [event], [0.]
+    since = 0.
+    for i in range(event + 1, inp_dict['nps']):
+        since = since + rng.exponential('interval', i, scale = scale)
+        if since >= window:
+            break
+        index.append(i)
+        shift.append(since * 1e9)
+    pulses = counter_pulses(inp_dict, energy, intensity, index, rng)
+    pulses['shift'] = np.array(shift)
+    batch = event_batch(pulses, np.array([len(index)]), t, scint_dict, inp_dict)
+    return acquire(batch, t, inp_dict)
@@ -0,0 +1,298 @@
+'''
+Stagecache
+==========
+
+module with an on-disk cache of the results of the simulation stages.
+
+The result of a stage (e.g. the photon pulses after the pile-up, or the
+pulses at the end of the pmt) depends only on the input parameters used by
+that stage and by the stages before it (see sweep.stage_keys), on the
+random seed and on the data files (scintillator coefficients and energy
+spectra). The cache stores each result under a hash of these values, so
+that a run that changes e.g. only the digitizer parameters reads the
+pulses at the end of the cable from the cache instead of simulating them
+again.
+
+Each entry is a directory "<key>" in the cache directory containing:
+
+ - manifest.json: the stage, the parameters, the size and the layout of the
+   stored arrays
+ - <name>.npy: the arrays of the result (see StageCache.store), read back
+   memory-mapped
+ - random.npy: the state of the random generator after the stage, so that
+   the following stages draw the same numbers as without the cache
+
+Entries are written in a temporary directory and renamed to their key
+when complete, and removed by renaming them back to a temporary directory,
+so that several processes can share a cache directory: an entry that is
+missing or incomplete when it is read (e.g. removed meanwhile by another
+process) is a cache miss.
+
+The total size of the cache is limited: when a new entry exceeds the limit,
+the least recently used entries are removed. The content of a cache
+directory can be listed and cleared with the dacsim_cache script
+(see cachetool).
+'''
+
+import os, json, time, shutil, hashlib, tempfile
+import numpy as np
+from pulsebatch import PulseBatch
+
+VERSION = 1 # changes when the stored results are no longer compatible
+
+MANIFEST = 'manifest.json'
+
+def data_digest(coeff_dict, energy, intensity):
+    '''Hash of the data files read by the simulation.
+
+    Args:
+        coeff_dict (dict): the scintillator coefficients
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+    Returns:
+        digest (str): hexadecimal hash of the data
+
+    '''
+    h = hashlib.sha1(json.dumps(coeff_dict, sort_keys = True).encode('utf8'))
+    for ptype in sorted(energy):
+        h.update(ptype.encode('utf8'))
+        h.update(np.ascontiguousarray(energy[ptype], dtype = float).tobytes())
+        h.update(np.ascontiguousarray(intensity[ptype], dtype = float).tobytes())
+    return h.hexdigest()
+
+def stage_key(stage, params, seed, digest):
+    '''Key of the result of a stage.
+
+    Args:
+        stage (str): name of the stage
+
+        params (tuple): (name, value) of the input parameters used by the
+        stage and by the stages before it (see sweep.stage_keys)
+
+        seed (int): the random seed
+
+        digest (str): hash of the data files (see data_digest)
+
+    Returns:
+        key (str): hexadecimal hash
+
+    '''
+    content = json.dumps([VERSION, stage, [list(p) for p in params], seed, digest], sort_keys = True)
+    return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+class StageCache(object):
+    '''Cache of stage results in a directory.
+
+    Args:
+        path (str): the cache directory (created if it does not exist)
+
+    Kwargs:
+        max_mb (float): maximum size of the cache [MB]
+
+    '''
+
+    def __init__(self, path, max_mb = 2048):
+        self.path = os.path.abspath(path)
+        self.max_mb = max_mb
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path, key, MANIFEST))
+
+    def store(self, key, result, stage, params = ()):
+        '''Saves the result of a stage with the current random state, then
+        removes the least recently used entries if the cache is too large.
+        Results larger than the cache are not saved.
+
+        Args:
+            key (str): key of the result (see stage_key)
+
+            result (dict): the result. The values can be arrays, PulseBatch,
+            dictionaries of arrays or numbers (or None)
+
+            stage (str): name of the stage
+
+        Kwargs:
+            params (tuple): the parameters of the key, saved for listing
+
+        Returns:
+            stored (bool): True if the result was saved (or was saved
+            meanwhile by another process)
+
+        '''
+        if key in self:
+            return True
+        tmpdir = tempfile.mkdtemp(dir = self.path, prefix = '.tmp')
+        try:
+            manifest = {'stage': stage, 'params': [list(p) for p in params], 'created': time.time(),
+                        'arrays': [], 'batches': {}, 'dicts': {}, 'scalars': {}}
+            def save(name, value):
+                np.save(os.path.join(tmpdir, name + '.npy'), np.asarray(value), allow_pickle = False)
+
+            for name, value in result.items():
+                if isinstance(value, PulseBatch):
+                    save(name + '.values', value.values)
+                    save(name + '.offsets', value.offsets)
+                    for mkey, mvalue in value.meta.items():
+                        save(name + '.meta.' + mkey, mvalue)
+                    manifest['batches'][name] = {'meta': sorted(value.meta)}
+                elif isinstance(value, dict):
+                    for dkey, dvalue in value.items():
+                        save(name + '.' + dkey, dvalue)
+                    manifest['dicts'][name] = sorted(value)
+                elif isinstance(value, np.ndarray):
+                    save(name, value)
+                    manifest['arrays'].append(name)
+                else:
+                    manifest['scalars'][name] = value
+
+            state = np.random.get_state()
+            save('random', state[1])
+            manifest['random'] = [state[0], int(state[2]), int(state[3]), float(state[4])]
+            manifest['size'] = sum(os.path.getsize(os.path.join(tmpdir, f)) for f in os.listdir(tmpdir))
+            if manifest['size'] > self.max_mb * 1024.**2:
+                return False
+            f = open(os.path.join(tmpdir, MANIFEST), 'w')
+            json.dump(manifest, f, sort_keys = True)
+            f.close()
+            try:
+                os.rename(tmpdir, os.path.join(self.path, key))
+            except OSError:
+                # another process stored the same result first
+                if key not in self:
+                    raise
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+        self.trim(self.max_mb, keep = key)
+        return True
+
+    def load(self, key):
+        '''Reads a result (memory-mapped) and sets the random state saved
+        with it. The entry is marked as used.
+
+        Args:
+            key (str): key of the result
+
+        Returns:
+            result (dict): the result, as passed to store, or None if the
+            entry is missing or incomplete (the random state is then not
+            changed)
+
+        '''
+        dirpath = os.path.join(self.path, key)
+        def load(name):
+            return np.load(os.path.join(dirpath, name + '.npy'), mmap_mode = 'r', allow_pickle = False)
+
+        try:
+            f = open(os.path.join(dirpath, MANIFEST))
+            manifest = json.load(f)
+            f.close()
+            os.utime(os.path.join(dirpath, MANIFEST), None)
+            result = dict((str(name), value) for name, value in manifest['scalars'].items())
+            for name in manifest['arrays']:
+                result[str(name)] = load(name)
+            for name, keys in manifest['dicts'].items():
+                result[str(name)] = dict((str(k), load(name + '.' + k)) for k in keys)
+            for name, layout in manifest['batches'].items():
+                meta = dict((str(k), load(name + '.meta.' + k)) for k in layout['meta'])
+                result[str(name)] = PulseBatch(load(name + '.values'), load(name + '.offsets'), meta)
+            state = np.array(load('random'))
+        except (IOError, OSError):
+            # removed by another process since it was found
+            return None
+
+        name, pos, has_gauss, cached = manifest['random']
+        np.random.set_state((str(name), state, pos, has_gauss, cached))
+        return result
+
+    def entries(self):
+        '''Entries of the cache, from the least to the most recently used.
+
+        Returns:
+            entries (list): for each entry a dictionary with the key, the
+            stage, the parameters, the size [bytes] and the times of
+            creation and last use [s since the epoch]
+
+        '''
+        entries = []
+        for key in os.listdir(self.path):
+            fname = os.path.join(self.path, key, MANIFEST)
+            try:
+                f = open(fname)
+                manifest = json.load(f)
+                f.close()
+                used = os.path.getmtime(fname)
+            except (IOError, OSError):
+                continue # temporary directory, or removed meanwhile
+            entries.append({'key': key, 'stage': manifest['stage'], 'params': manifest['params'], 'size': manifest['size'],
+                            'created': manifest['created'], 'used': used})
+        return sorted(entries, key = lambda entry: entry['used'])
+
+    def size(self):
+        '''Total size of the entries [bytes]'''
+        return sum(entry['size'] for entry in self.entries())
+
+    def remove(self, key):
+        '''Removes one entry. It is first moved to a temporary directory, so
+        that it is never seen partly removed.'''
+        tmpdir = tempfile.mkdtemp(dir = self.path, prefix = '.tmp')
+        try:
+            os.rename(os.path.join(self.path, key), os.path.join(tmpdir, key))
+        except OSError:
+            pass # already removed
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+    def trim(self, max_mb, keep = None):
+        '''Removes the least recently used entries until the size of the
+        cache is below max_mb.
+
+        Args:
+            max_mb (float): maximum size [MB]
+
+        Kwargs:
+            keep (str): key of an entry that is not removed
+
+        Returns:
+            removed (list): keys of the removed entries
+
+        '''
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= max_mb * 1024.**2:
+                break
+            if entry['key'] == keep:
+                continue
+            self.remove(entry['key'])
+            total -= entry['size']
+            removed.append(entry['key'])
+        return removed
+
+    def clear(self, stage = None, before = None):
+        '''Removes the entries of the cache.
+
+        Kwargs:
+            stage (str): remove only the entries of this stage
+
+            before (float): remove only the entries last used before
+            this time [s since the epoch]
+
+        Returns:
+            removed (list): keys of the removed entries
+
+        '''
+        removed = []
+        for entry in self.entries():
+            if (stage is None or entry['stage'] == stage) and (before is None or entry['used'] < before):
+                self.remove(entry['key'])
+                removed.append(entry['key'])
+        for fname in os.listdir(self.path):
+            if fname.startswith('.tmp') and stage is None and before is None:
+                shutil.rmtree(os.path.join(self.path, fname), ignore_errors = True)
+        return removed
@@ -0,0 +1,133 @@
+'''
+Streams
+=======
+
+module with the counter-based random numbers of the simulation (input
+"rng counter").
+
+By default the simulation draws its random numbers from the sequential
+stream of numpy.random, so that each number depends on all the numbers
+drawn before it: the output then depends on the order of the pulses, on
+the chunks (mem) and on the work units (nworkers). With the counter-based
+random numbers, each number is instead a function of the seed, of the
+stage that uses it, of a key and of an index, calculated with the
+Philox4x32-10 generator (J. K. Salmon et al., "Parallel random numbers: as
+easy as 1, 2, 3", SC11, 2011, see kernels.philox_uniform). The keys are:
+
+ - ptype, energy, nphot, interval: the index of the pulse (the interval is
+   the time since the previous pulse)
+ - photons: the index of the pulse, with the index of the photon
+ - pmt, noise, digitize: the event (the index of its first pulse, saved in
+   the metadata "event"), with the index of the photon or of the sample in
+   the event
+
+The random numbers of an event are therefore the same however the events
+are split and in whatever order they are simulated: the output does not
+depend on mem and nworkers, and any event can be simulated again on its
+own, without simulating the events before it (see simulation.replay_event).
+
+The numbers are calculated by the compiled kernel when it is built; its
+NumPy version is several times slower than numpy.random, which matters
+mostly for the noise of the grid chain (one number per point of the time
+axis).
+'''
+
+import numpy as np
+from scipy import special, stats
+from kernels import philox_uniform
+
+STAGES = ['ptype', 'energy', 'nphot', 'interval', 'photons', 'pmt', 'noise', 'digitize'] # codes of the keyed stages
+
+POISSON_SEARCH = 30. # mean below which the poisson numbers are found by a sequential search
+
+def poisson_ppf(u, lam):
+    '''Poisson numbers from uniform numbers (inverse of the cumulative
+    distribution). Small means are searched sequentially, for all the
+    numbers at once; larger means use scipy.stats.poisson.ppf.
+
+    Args:
+        u (numpy.array): uniform numbers in (0, 1)
+
+        lam (numpy.array): means (broadcast with u)
+
+    Returns:
+        k (numpy.array): the poisson numbers
+
+    '''
+    u, lam = np.broadcast_arrays(np.asarray(u, dtype = float), np.asarray(lam, dtype = float))
+    k = np.zeros(u.shape, dtype = int)
+    large = lam >= POISSON_SEARCH
+    if np.any(large):
+        k[large] = stats.poisson.ppf(u[large], lam[large]).astype(int)
+    small = np.flatnonzero(~large)
+    u, lam = u.flat[small], lam.flat[small]
+    p = np.exp(-lam)
+    cdf = p.copy()
+    n = np.zeros(len(small), dtype = int)
+    active = np.flatnonzero((u > cdf) & (p > 0))
+    while len(active) > 0:
+        n[active] += 1
+        p[active] *= lam[active] / n[active]
+        cdf[active] += p[active]
+        active = active[(u[active] > cdf[active]) & (p[active] > 0)]
+    k.flat[small] = n
+    return k
+
+def positions(counts):
+    '''Index of each value within its pulse, for pulses of counts values'''
+    counts = np.asarray(counts, dtype = int)
+    return np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+class CounterRandom(object):
+    '''Counter-based random numbers of a simulation. All the methods take
+    the name of the stage (see STAGES), the keys and the indices of the
+    numbers (broadcast together).
+
+    Args:
+        seed (int): the seed of the simulation
+
+    '''
+
+    def __init__(self, seed):
+        self.seed = int(seed)
+
+    def uniform(self, stage, key, index = 0):
+        '''Uniform numbers in (0, 1)'''
+        return philox_uniform(key, index, STAGES.index(stage), self.seed)
+
+    def normal(self, stage, key, index = 0, scale = 1.):
+        '''Normal numbers with zero mean'''
+        return special.ndtri(self.uniform(stage, key, index)) * scale
+
+    def exponential(self, stage, key, index = 0, scale = 1.):
+        '''Exponential numbers'''
+        return -np.log(self.uniform(stage, key, index)) * scale
+
+    def poisson(self, stage, lam, key, index = 0):
+        '''Poisson numbers of mean lam (see poisson_ppf)'''
+        return poisson_ppf(self.uniform(stage, key, index), lam)
+
+    def choice(self, stage, p, key, index = 0):
+        '''Indices drawn with probabilities p (as numpy.random.choice)'''
+        cdf = np.cumsum(p, dtype = float)
+        cdf /= cdf[-1]
+        return np.minimum(cdf.searchsorted(self.uniform(stage, key, index), side = 'right'), len(cdf) - 1)
+
+    def batch_values(self, stage, batch):
+        '''Keys and indices of the values of a batch of events (the event
+        of each pulse is in the metadata "event")'''
+        if 'event' not in batch.meta:
+            raise ValueError('the counter-based random numbers need the metadata "event"')
+        return np.repeat(batch.meta['event'], batch.counts), positions(batch.counts)
+
+def counter_rng(inp_dict):
+    '''CounterRandom of the input parameters, or None for the sequential
+    stream of numpy.random (input "rng", numpy or counter)'''
+    rng = inp_dict.get('rng', 'numpy')
+    if rng not in ['numpy', 'counter']:
+        raise ValueError('unknown rng "%s"' % rng)
+    if rng == 'numpy':
+        return None
+    if 'seed' not in inp_dict:
+        raise ValueError('rng counter needs a seed')
+    return CounterRandom(inp_dict['seed'])
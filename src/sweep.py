@@ -0,0 +1,324 @@
+'''
+Sweep
+=====
+
+module that runs a simulation for many values of the input parameters
+(sweep points), sharing the stages that do not depend on the swept
+parameters.
+
+The simulation is a chain of stages (see STAGES). Each input parameter is
+used first by one stage, and a point only needs to rerun the stages from
+the first one whose parameters differ from the previous point: e.g. a sweep
+of the cable cutoff generates the scintillator pulses and applies the
+pile-up and the pmt once, and reruns the cable, noise and digitizer for
+each point. The points are sorted so that the points sharing the most
+stages are adjacent, and the result of each stage is kept until a point
+needs a different one.
+
+The random state after each stage is stored with its result and restored
+before the following stages. With the same seed, the output of each point
+is the same as that of a separate simulation with the parameters of the
+point, and all the points share the same scintillator pulses and pile-up.
+The seed is part of the key of every stage, so the points of a sweep of the
+seed (e.g. "sweep_seed 1,2") share no stage.
+'''
+
+import os, json, itertools
+import numpy as np
+from pileup import apply_pileup
+from simulation import pulse_shapes, particle_counts, generate_batch, acquire_stages, apply_stage, count_events
+from metrics import Metrics, photon_count
+from output import OutputWriter
+from features import output_options
+from stagecache import data_digest, stage_key
+
+# stages of the simulation and the input parameters they use first.
+# The pulse length (samples / sampf) is a parameter of the scintillator
+# pulse shapes, so samples and sampf affect all the stages
+STAGES = [('shape', ['dt', 'samples', 'sampf']),
+          ('generate', ['nps', 'ptype', 'cre', 'crp', 'k', 'lc', 'qeff', 'photon_times']),
+          ('pileup', []),
+          ('analog', ['ndyn', 'delta', 'sigma', 'tt', 'precision', 'fused', 'engine']),
+          ('cable', ['cutoff', 'imp']),
+          ('noise', ['noise', 'noise_engine', 'noise_cutoff', 'noise_psd', 'noise_bank']),
+          ('digitize', ['bits', 'minV', 'maxV', 'th_on', 'th_lvl', 'pretrig_samp'])]
+
+# stages saved to the on-disk cache by default (the pulses before the stages
+# that are most often varied; the digitized pulses are the output itself)
+CACHE_STAGES = ['pileup', 'pmt', 'analog', 'cable', 'noise']
+
+def first_stage(param, inp_dict = None):
+    '''Name of the first stage that depends on an input parameter.
+    Parameters that are not used by the stages (e.g. output) return None.
+
+    Args:
+        param (str): name of the input parameter
+
+    Kwargs:
+        inp_dict (dict): with the fused kernel or the grid-free engine, the
+        pmt and the cable are a single stage (analog)
+
+    Returns:
+        stage (str): name of the stage
+
+    '''
+    merged = inp_dict is not None and 'cable' not in acquire_stages(inp_dict)
+    for stage, params in STAGES:
+        if param in params:
+            if stage == 'cable' and merged:
+                return 'analog'
+            return stage
+    return None
+
+def stage_keys(inp_dict):
+    '''Values of the parameters used by each stage and the stages before it,
+    after the seed. Two points can share the result of a stage if their
+    keys for that stage are equal.
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        keys (list): one tuple for each stage of STAGES
+
+    '''
+    keys, values = [], (('seed', inp_dict.get('seed')),)
+    for stage, _ in STAGES:
+        params = sorted(p for p in inp_dict if first_stage(p, inp_dict) == stage)
+        values = values + tuple((p, inp_dict[p]) for p in params)
+        keys.append(values)
+    return keys
+
+def sweep_points(inp_dict):
+    '''Reads the sweep points from the input parameters.
+
+    The points are either a grid, with one input parameter "sweep_<name>"
+    for each swept parameter, with the values separated by commas (e.g.
+    "sweep_cutoff 0.1,0.2,0.4"), or a list of overrides read from the JSON
+    file given by the input parameter "sweep" (a list of dictionaries,
+    e.g. [{"delta": 3, "sigma": 4.}, {"delta": 4, "sigma": 5.}]).
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        points (list): the parameter overrides of each point (dict).
+        Empty if there is no sweep
+
+    '''
+    if 'sweep' in inp_dict:
+        f = open(inp_dict['sweep'])
+        points = json.load(f)
+        f.close()
+        return [dict((str(key), value) for key, value in point.items()) for point in points]
+
+    grid = []
+    for key in sorted(inp_dict):
+        if key.startswith('sweep_'):
+            values = [_parse_value(v) for v in str(inp_dict[key]).split(',')]
+            grid.append([(key[len('sweep_'):], v) for v in values])
+    if len(grid) == 0:
+        return []
+    return [dict(point) for point in itertools.product(*grid)]
+
+def _parse_value(value):
+    '''Converts a value of the input as in dacsim.read_input'''
+    for conv in [int, float]:
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    return value
+
+def stage_name(level, inp_dict):
+    '''Name of the stage of the acquisition chain run at a level of STAGES
+    (pmt or analog for the analog level, depending on the input), or None
+    if the level does nothing (the cable level with the fused kernel or
+    the grid-free engine).
+
+    Args:
+        level (int): index in STAGES
+
+        inp_dict (dict): dictionary with the input parameters
+
+    Returns:
+        stage (str): name of the stage
+
+    '''
+    stage = STAGES[level][0]
+    if stage == 'analog':
+        return acquire_stages(inp_dict)[0]
+    if stage == 'cable' and 'cable' not in acquire_stages(inp_dict):
+        return None
+    return stage
+
+def run_point(inp, coeff_dict, energy, intensity, memo = None, cache = None, metrics = None):
+    '''Runs all the stages for one set of input parameters, starting from
+    the last stage whose result is available, either in memo or in cache.
+    The random generator is seeded with the input parameter "seed" (or
+    set to the state saved with the result).
+
+    Args:
+        inp (dict): dictionary with the input parameters
+
+        coeff_dict (dict): the scintillator coefficients
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+    Kwargs:
+        memo (list): (key, result, random state) of each stage of the
+        previous run, updated with this run (see run_sweep)
+
+        cache (StageCache): on-disk cache. The results of the stages in
+        the input parameter "cache_stages" (comma separated, default
+        CACHE_STAGES) are read from and saved to the cache
+
+        metrics (Metrics): records the stages
+
+    Returns:
+        result (dict): the result of the last stage: the digitized pulses
+        "batch" that passed the trigger, the boolean array "triggered",
+        the time intervals "time_int" and the metadata "meta" of all the
+        events
+
+        level (int): index in STAGES of the first stage that was run
+
+    '''
+    if memo is None:
+        memo = [None] * len(STAGES)
+    if metrics is None:
+        metrics = Metrics()
+    keys = stage_keys(inp)
+    level = 0 # the key of a stage includes the parameters of the stages before it
+    for l in range(len(STAGES)):
+        if memo[l] is not None and memo[l][0] == keys[l]:
+            level = l + 1
+
+    if cache is not None:
+        digest = data_digest(coeff_dict, energy, intensity)
+        cached = str(inp.get('cache_stages', ','.join(CACHE_STAGES))).split(',')
+        cache_keys = [stage_key(stage_name(l, inp), keys[l], inp['seed'], digest) if stage_name(l, inp) in cached else None
+                      for l in range(len(STAGES))]
+        for l in range(len(STAGES) - 1, level - 1, -1):
+            if cache_keys[l] is not None and cache_keys[l] in cache:
+                with metrics.stage('cache', 0):
+                    result = cache.load(cache_keys[l])
+                if result is None:
+                    continue # removed by another process meanwhile
+                memo[l] = (keys[l], result, np.random.get_state())
+                level = l + 1
+                break
+
+    if level > 0:
+        np.random.set_state(memo[level-1][2])
+    else:
+        np.random.seed(inp['seed'])
+    for l in range(level, len(STAGES)):
+        previous = memo[l-1][1] if l > 0 else None
+        result = _run_stage(STAGES[l][0], previous, inp, coeff_dict, energy, intensity, metrics)
+        memo[l] = (keys[l], result, np.random.get_state())
+        if cache is not None and cache_keys[l] is not None:
+            with metrics.stage('cache', 0):
+                cache.store(cache_keys[l], result, stage_name(l, inp), keys[l])
+    return memo[-1][1], level
+
+def run_sweep(inp_dict, points, coeff_dict, energy, intensity, header = None, metrics = None, verbose = False, cache = None):
+    '''Runs the simulation for each sweep point, sharing the stages
+    that do not depend on the parameters that change between points.
+    The output of point i is written to the directory
+    "output/<output>_<i>.dacsim" and the list of points to
+    "output/<output>_sweep.json".
+
+    Args:
+        inp_dict (dict): dictionary with the input parameters (the seed
+        is the input parameter "seed")
+
+        points (list): the parameter overrides of each point (dict)
+
+        coeff_dict (dict): the scintillator coefficients
+
+        energy (dict): energy axis of each particle type [keVee]
+
+        intensity (dict): normalized spectrum of each particle type
+
+    Kwargs:
+        header (dict): information saved in the header of each output
+        (see OutputWriter); the input dictionary of the point is added
+
+        metrics (Metrics): records the stages. The chunk of the records
+        (and the chunk selected for profiling) is the index of the point
+
+        verbose (bool): print the stages rerun for each point
+
+        cache (StageCache): on-disk cache of the stage results (see run_point)
+
+    Returns:
+        paths (list): the output directory of each point
+
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    dirpath = os.path.join(os.getcwd(), 'output')
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath)
+    width = len(str(len(points) - 1))
+    paths = [os.path.join(dirpath, '%s_%0*d' % (inp_dict['output'], width, i)) for i in range(len(points))]
+    inputs = [dict(inp_dict, **point) for point in points]
+    keys = [stage_keys(inp) for inp in inputs]
+    outputs = [None] * len(points)
+
+    memo = [None] * len(STAGES)
+    for i in sorted(range(len(points)), key = lambda i: [repr(k) for k in keys[i]]):
+        with metrics.profiler(i):
+            inp = inputs[i]
+            result, level = run_point(inp, coeff_dict, energy, intensity, memo, cache, metrics)
+            if verbose: print 'Point', i, points[i], '- running from stage', STAGES[min(level, len(STAGES)-1)][0]
+
+            pulses_dig, triggered = result['batch'], result['triggered']
+            count_events(metrics, result['meta'], triggered)
+            with metrics.stage('write', len(pulses_dig)):
+                t_dig = np.arange(0,float(inp['samples'])/inp['sampf'],1./inp['sampf'])
+                writer = OutputWriter(paths[i], inp['samples'], inp['bits'], dict(header or {}, inp_dict = inp, t_dig = t_dig.tolist()),
+                                      **output_options(inp))
+                writer.append(pulses_dig)
+                writer.append_time_int(result['time_int'])
+                writer.close()
+        outputs[i] = writer.path
+
+    f = open(os.path.join(dirpath, inp_dict['output'] + '_sweep.json'), 'w')
+    json.dump([{'path': path, 'overrides': point} for path, point in zip(outputs, points)], f, indent = 1, sort_keys = True)
+    f.close()
+    return outputs
+
+def _run_stage(stage, previous, inp, coeff_dict, energy, intensity, metrics):
+    '''Runs one stage of STAGES from the result of the previous stage.
+    The results are dictionaries with the time axis "t", the pulses
+    "batch" and the other data needed by the following stages.'''
+    if stage == 'shape':
+        plen = float(inp['samples'])/inp['sampf']
+        with metrics.stage('shape'):
+            t, scint_dict = pulse_shapes(coeff_dict,inp['dt'],plen)
+        return {'t': t, 'scint_dict': scint_dict, 'plen': plen}
+
+    result = dict(previous)
+    if stage == 'generate':
+        with metrics.stage('generate', inp['nps']) as record:
+            result['batch'] = generate_batch(particle_counts(inp, inp['nps']), previous['t'], previous['scint_dict'],
+                                             energy, intensity, inp)
+            record['photons'] = photon_count(result['batch'])
+    elif stage == 'pileup':
+        with metrics.stage('pileup', len(previous['batch'])):
+            result['batch'], pileup_log, result['time_int'] = apply_pileup(previous['batch'], inp['cre'] + inp['crp'], previous['plen'])
+        result['meta'] = result['batch'].meta
+    else:
+        stages = acquire_stages(inp)
+        if stage == 'analog':
+            stage = stages[0]
+        if stage in stages:
+            batch = previous['batch']
+            nphot = photon_count(batch) if stage in ['pmt', 'analog'] else 0
+            with metrics.stage(stage, len(batch), nphot):
+                result['batch'], result['t'], result['triggered'] = apply_stage(stage, batch, previous['t'], inp)
+    return result
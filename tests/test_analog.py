@@ -0,0 +1,62 @@
+'''
+Tests of the accuracy of the grid-free engine (analog.apply_analog_samples)
+with respect to the fine-grid chain (pmt.apply_pmt_batch followed by
+cable.apply_cable_batch), at the sampling times of the digitizer.
+'''
+
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from library import Simulation
+from simulation import generate_batch, particle_counts
+from pmt import apply_pmt_batch
+from cable import apply_cable_batch
+from analog import apply_analog_samples
+
+TOLERANCE = 1e-4 # largest difference, relative to the maximum of each pulse
+
+INPUT = {'dt': 0.05, 'samples': 256, 'sampf': 0.4, 'cre': 200000, 'crp': 100000, 'k': 10., 'lc': 0.7, 'qeff': 0.26,
+         'ndyn': 10, 'delta': 4, 'tt': 17.5, 'imp': 50}
+
+class TestAnalogSamples(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def _compare(self, sigma, cutoff, ptype, nps = 200, seed = 1):
+        inp = dict(INPUT, sigma = sigma, cutoff = cutoff, ptype = ptype)
+        t, scint_dict = self.sim.shapes(inp)
+        np.random.seed(seed)
+        batch = generate_batch(particle_counts(inp, nps), t, scint_dict, self.sim.energy, self.sim.intensity, inp)
+        tk = np.arange(0, t[-1] + (t[1]-t[0]), 1./inp['sampf'])
+
+        # the dynode gain is drawn first in both paths
+        state = np.random.get_state()
+        fine = apply_pmt_batch(batch, t, inp['ndyn'], inp['delta'], sigma, inp['tt'])
+        fine = apply_cable_batch(fine, t, cutoff, inp['imp']).as_matrix()
+        np.random.set_state(state)
+        samples = apply_analog_samples(batch, tk, inp['dt'], inp['ndyn'], inp['delta'], sigma, inp['tt'], cutoff, inp['imp'])
+        samples = samples.as_matrix()
+
+        reference = fine[:,np.round(tk / inp['dt']).astype(int)]
+        self.assertEqual(samples.shape, reference.shape)
+        error = np.abs(samples - reference).max(axis = 1) / np.abs(reference).max(axis = 1)
+        self.assertTrue(error.max() < TOLERANCE, 'relative error %g' % error.max())
+
+    def test_electron(self):
+        self._compare(5.2, 0.2, 'electron')
+
+    def test_proton_slow_cable(self):
+        self._compare(2., 0.1, 'proton')
+
+    def test_wide_pmt_response(self):
+        self._compare(8., 0.4, 'all')
+
+    def test_narrow_pmt_response(self):
+        self._compare(1., 0.4, 'proton')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+'''
+Tests of the conversion of the signal to digitizer codes (digitize module).
+'''
+
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from digitize import quantize
+
+class TestQuantize(unittest.TestCase):
+
+    def _check(self, nbits, amprange):
+        levels = np.linspace(amprange[0], amprange[1], 2**nbits)
+        # the levels, the values just below and above them, and random values
+        signal = np.concatenate([levels, np.nextafter(levels, -np.inf), np.nextafter(levels, np.inf),
+                                 np.random.RandomState(nbits).uniform(amprange[0] - 0.5, amprange[1] + 0.5, 4096)])
+        np.testing.assert_array_equal(quantize(signal, nbits, amprange), np.digitize(signal, levels))
+        np.testing.assert_array_equal(quantize(signal.reshape(-1, 2), nbits, amprange),
+                                      np.digitize(signal, levels).reshape(-1, 2))
+
+    def test_edges(self):
+        for nbits in [1, 2, 8, 12, 14]:
+            for amprange in [[-0.1, 1.2], [-1., 1], [0, 5], [-0.3, 0.7]]:
+                self._check(nbits, amprange)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Tests of the kernels (kernels module): the compiled versions must give
+the same output as the NumPy versions, also for empty and read-only
+inputs (e.g. memory-mapped results of the stage cache). The
+comparisons are skipped if the _kernels extension is not built (it is
+found on the Python path, e.g. PYTHONPATH=build/src).
+'''
+
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from kernels import NUMPY, COMPILED, philox4x32
+
+def _inputs(n, seed = 0):
+    '''Random inputs of the kernels, typical of the simulation, for n pulses'''
+    rng = np.random.RandomState(seed)
+    t = np.arange(0, 640., 0.05)
+    counts = rng.poisson(500, n)
+    offsets = np.append(0, np.cumsum(counts))
+    values = rng.exponential(50., offsets[-1])
+    if n > 0:
+        values[rng.randint(0, len(values), 10)] = t[-1] # right edge
+    tint = np.append(rng.exponential(1e-6, n // 2), rng.exponential(1e-7, n - 1 - n // 2)) if n > 0 else np.zeros(0)
+    arrival = np.zeros(n, dtype = np.longdouble)
+    np.cumsum(tint, out = arrival[1:])
+    pulses = rng.normal(0, 0.01, (n // 4, 1000)) + np.exp(-(np.arange(1000) - rng.uniform(0, 1500, (n // 4, 1)))**2 / 1e4)
+    return {'pileup_starts': [(tint, arrival, 640e-9)],
+            'histogram_rows': [(values, offsets, t, None), (values, offsets, t, rng.gamma(4., 1., len(values)))],
+            'one_pole': [(pulses, 0.06, 0.06, -0.88), (pulses.astype(np.float32), 0.06, 0.06, -0.88)],
+            'trigger_windows': [(pulses, 0.5, 256, 64, 2), (pulses.astype(np.float32), 0.5, 256, 64, 2),
+                                (pulses, 1e3, 256, 64, 2)], # no trigger
+            'philox_uniform': [(np.repeat(np.arange(n, dtype = np.uint64) << np.uint64(20), 50),
+                                np.tile(np.arange(50, dtype = np.uint64), n), 4, 2**40 + 7)]}
+
+def _readonly(args):
+    '''Copies of the arguments, with the arrays not writeable'''
+    copies = []
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            arg = arg.copy()
+            arg.flags.writeable = False
+        copies.append(arg)
+    return tuple(copies)
+
+def _check_readonly(test, kernels):
+    '''Checks that each kernel gives the same output for read-only inputs'''
+    for name, args_list in sorted(_inputs(200).items()):
+        for args in args_list:
+            reference, output = kernels[name](*args), kernels[name](*_readonly(args))
+            if not isinstance(reference, tuple):
+                reference, output = (reference,), (output,)
+            for x, y in zip(output, reference):
+                test.assertTrue(np.array_equal(x, y), name)
+
+@unittest.skipIf(not COMPILED, 'the compiled kernels are not built')
+class TestCompiledKernels(unittest.TestCase):
+
+    def _compare(self, cases):
+        for name, args_list in sorted(cases.items()):
+            for args in args_list:
+                reference, output = NUMPY[name](*args), COMPILED[name](*args)
+                if not isinstance(reference, tuple):
+                    reference, output = (reference,), (output,)
+                self.assertEqual(len(output), len(reference))
+                for x, y in zip(output, reference):
+                    self.assertEqual(x.dtype, y.dtype, name)
+                    self.assertEqual(x.shape, y.shape, name)
+                    self.assertTrue(np.array_equal(x, y), name)
+
+    def test_identical(self):
+        self._compare(_inputs(2000))
+
+    def test_one_pulse(self):
+        self._compare(_inputs(4))
+
+    def test_no_pulses(self):
+        self._compare(_inputs(0))
+
+    def test_readonly(self):
+        _check_readonly(self, COMPILED)
+
+class TestNumpyKernels(unittest.TestCase):
+
+    def test_no_pulses(self):
+        for name, args_list in sorted(_inputs(0).items()):
+            for args in args_list:
+                output = NUMPY[name](*args)
+                for x in (output if isinstance(output, tuple) else (output,)):
+                    self.assertEqual(len(x), 0, name)
+
+    def test_readonly(self):
+        _check_readonly(self, NUMPY)
+
+    def test_no_trigger(self):
+        triggered, rows, windows, inside = NUMPY['trigger_windows'](*_inputs(40)['trigger_windows'][2])
+        self.assertEqual(len(triggered), 10)
+        self.assertFalse(triggered.any())
+        self.assertEqual(windows.shape, (0, 256))
+        self.assertEqual(inside.shape, (0, 256))
+
+    def test_philox(self):
+        # known-answer vectors of Philox4x32-10 (Random123)
+        vectors = [((0, 0, 0, 0), (0, 0), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+                   ((0xffffffff,) * 4, (0xffffffff,) * 2, (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+                   ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0),
+                    (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))]
+        for counter, key, expected in vectors:
+            output = philox4x32(*([np.array([c], dtype = np.uint64) for c in counter] + list(key)))
+            self.assertEqual(tuple(int(x[0]) for x in output), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Tests of the list-mode acquisition (listmode module) with few arrivals.
+'''
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from output import load_output
+from library import Simulation
+
+INPUT = {'acq_time': 0.002, 'ptype': 'electron', 'cre': 200, 'crp': 0, 'output': 'test', 'dt': 0.05,
+         'lc': 0.7, 'qeff': 0.26, 'k': 10., 'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+         'cutoff': 0.2, 'imp': 50, 'noise': 0.01, 'bits': 12, 'minV': -0.1, 'maxV': 1.2,
+         'sampf': 0.4, 'samples': 256, 'th_on': 1, 'th_lvl': 200, 'pretrig_samp': 64,
+         'fp': 0, 'seed': 3}
+
+class TestListmode(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_blocks_without_triggers(self):
+        summary = self.sim.run(dict(INPUT, acq_time = 0.005, cre = 2000, noise = 0.001))
+        header, arrays = load_output(summary['path'])
+        self.assertEqual(len(arrays['pulses']), summary['pulses'])
+        self.assertEqual(len(arrays['time_int']), summary['pulses'])
+        self.assertTrue(np.all(arrays['ptype'] == 0))
+
+    def test_noise_before_first_arrival(self):
+        summary = self.sim.run(dict(INPUT, th_lvl = 40))
+        header, arrays = load_output(summary['path'])
+        self.assertTrue(summary['pulses'] > 0)
+        early = arrays['ptype'] == -1
+        self.assertTrue(np.any(early))
+        self.assertTrue(np.all(np.isnan(arrays['energy'][early])))
+        self.assertTrue(np.all(arrays['energy'][~early] > 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+'''
+Tests of the banks of colored noise (noise module).
+'''
+
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import noise
+from noise import noise_bank, MAX_BANKS
+
+class TestNoiseBank(unittest.TestCase):
+
+    def test_cache_bounded(self):
+        banks = [noise_bank(0.01, 2.5, 0.1, size = 4096, seed = seed) for seed in range(3 * MAX_BANKS)]
+        self.assertTrue(len(noise._banks) <= MAX_BANKS)
+        self.assertTrue(noise_bank(0.01, 2.5, 0.1, size = 4096, seed = 3 * MAX_BANKS - 1) is banks[-1])
+        np.testing.assert_array_equal(noise_bank(0.01, 2.5, 0.1, size = 4096, seed = 0), banks[0])
+
+    def test_bank(self):
+        bank = noise_bank(0.01, 2.5, 0.1, size = 4096, seed = 1)
+        self.assertAlmostEqual(bank.std(), 0.01)
+        self.assertAlmostEqual(bank.mean(), 0.)
+        self.assertFalse(bank.flags.writeable)
+
+if __name__ == '__main__':
+    unittest.main()
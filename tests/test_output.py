@@ -0,0 +1,99 @@
+'''
+Tests of the output of the simulation (output module), in particular of
+the runs in which no event triggers.
+'''
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from pulsebatch import PulseBatch
+from output import OutputWriter, load_output
+from features import feature_parameters
+from library import Simulation
+
+INPUT = {'nps': 500, 'ptype': 'all', 'cre': 200000, 'crp': 100000, 'output': 'test', 'dt': 0.05,
+         'lc': 0.7, 'qeff': 0.26, 'k': 10., 'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+         'cutoff': 0.2, 'imp': 50, 'noise': 0.01, 'bits': 12, 'minV': -0.1, 'maxV': 1.2,
+         'sampf': 0.4, 'samples': 256, 'th_on': 1, 'th_lvl': 4000, 'pretrig_samp': 64,
+         'fp': 0, 'seed': 3} # no event triggers (th_lvl above the range of the digitizer)
+
+class TestOutputWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _batch(self, n, samples = 8):
+        values = np.arange(n * samples) % 4096
+        return PulseBatch.from_counts(values, [samples] * n, {'ptype': np.arange(n), 'pileup': np.zeros(n, dtype = int)})
+
+    def test_empty_batch(self):
+        writer = OutputWriter(os.path.join(self.dir, 'out'), 8, 12)
+        writer.append(self._batch(0))
+        writer.append(self._batch(3))
+        writer.append(self._batch(0))
+        writer.close()
+        header, arrays = load_output(writer.path)
+        self.assertEqual(arrays['pulses'].shape, (3, 8))
+        self.assertEqual(header['nevents'], 3)
+        np.testing.assert_array_equal(arrays['pulses'], self._batch(3).as_matrix())
+        np.testing.assert_array_equal(arrays['ptype'], [0, 1, 2])
+        self.assertEqual(len(arrays['pileup_log']), 3)
+
+    def test_only_empty_batches(self):
+        inp_dict = dict(INPUT, features = 1)
+        writer = OutputWriter(os.path.join(self.dir, 'out'), 8, 12, features = feature_parameters(inp_dict), waveforms = 2)
+        writer.append(self._batch(0))
+        writer.close()
+        header, arrays = load_output(writer.path)
+        self.assertEqual(arrays['pulses'].shape, (0, 8))
+        for key in ['ptype', 'pileup_log', 'psd', 'waveform']:
+            self.assertEqual(len(arrays[key]), 0)
+
+class TestNoTrigger(unittest.TestCase):
+    '''Runs in which all the events are below the trigger threshold'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _check(self, **kwargs):
+        summary = self.sim.run(dict(INPUT, **kwargs))
+        self.assertEqual(summary['pulses'], 0)
+        header, arrays = load_output(summary['path'])
+        self.assertEqual(arrays['pulses'].shape, (0, INPUT['samples']))
+        for key in ['ptype', 'energy', 'pileup_log']:
+            self.assertEqual(len(arrays[key]), 0)
+        return arrays
+
+    def test_serial(self):
+        self._check()
+
+    def test_mem(self):
+        self._check(mem = 100)
+
+    def test_nworkers(self):
+        self._check(nworkers = 2)
+
+    def test_features(self):
+        arrays = self._check(features = 1, waveforms = 2)
+        self.assertEqual(len(arrays['psd']), 0)
+
+    def test_counter(self):
+        self._check(rng = 'counter', mem = 100)
+
+if __name__ == '__main__':
+    unittest.main()
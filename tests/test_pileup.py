@@ -0,0 +1,95 @@
+'''
+Tests of the pile-up (pileup module): the vectorized apply_pileup and the
+streamed PileupStream must give the events of the original loop over the
+pulses for the same seed.
+'''
+
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from pulsebatch import PulseBatch
+from pileup import apply_pileup, PileupStream
+
+RATE = 3e6 # many events with several pile-up pulses
+PLEN = 640.
+
+def _baseline_pileup(plist, rate, plen):
+    '''The original apply_pileup, merging the pulses one at a time'''
+    plist = list(plist)
+    tint_array = np.random.exponential(1./rate,len(plist)-1)
+    i, t_0, counter = 0, 0, 0
+    pileup_log = []
+    for tint in tint_array:
+        if (tint + t_0) < plen*1e-9:
+            plist[i] = np.append(plist[i],plist[i+1]+(tint+t_0)*1e9)
+            del plist[i+1]
+            t_0 += tint
+            counter += 1
+        else:
+            i += 1
+            t_0 = 0
+            pileup_log.append(counter)
+            counter = 0
+    if len(plist) - len(pileup_log) == 1:
+        pileup_log.append(counter)
+    return plist, pileup_log, tint_array
+
+def _pulses(n, seed = 1):
+    '''Photon times of n pulses with random numbers of photons'''
+    rs = np.random.RandomState(seed)
+    return [rs.uniform(0, PLEN, rs.randint(0, 50)) for i in range(n)]
+
+class TestApplyPileup(unittest.TestCase):
+
+    def test_baseline(self):
+        plist = _pulses(3000)
+        np.random.seed(2)
+        expected, expected_log, expected_tint = _baseline_pileup(plist, RATE, PLEN)
+        np.random.seed(2)
+        events, pileup_log, tint_array = apply_pileup(plist, RATE, PLEN)
+        self.assertTrue(max(pileup_log) > 1)
+        self.assertEqual(pileup_log, expected_log)
+        np.testing.assert_array_equal(tint_array, expected_tint)
+        self.assertEqual(len(events), len(expected))
+        for event, expected_event in zip(events, expected):
+            np.testing.assert_allclose(event, expected_event, rtol = 0, atol = 1e-6)
+
+    def test_batch(self):
+        plist = _pulses(500)
+        batch = PulseBatch.from_list(plist, {'ptype': np.arange(500)})
+        np.random.seed(3)
+        events, pileup_log = apply_pileup(plist, RATE, PLEN)[:2]
+        np.random.seed(3)
+        newbatch = apply_pileup(batch, RATE, PLEN)[0]
+        np.testing.assert_array_equal(newbatch.meta['pileup'], pileup_log)
+        np.testing.assert_array_equal(newbatch.meta['ptype'], np.cumsum([0] + pileup_log[:-1]) + np.arange(len(pileup_log)))
+        np.testing.assert_array_equal(newbatch.values, np.concatenate(events))
+
+class TestPileupStream(unittest.TestCase):
+    '''The events across the boundaries of the chunks are the same as
+    with all the pulses at once'''
+
+    def test_chunks(self):
+        batch = PulseBatch.from_list(_pulses(3000), {'ptype': np.arange(3000)})
+        np.random.seed(4)
+        expected, expected_log, expected_tint = apply_pileup(batch, RATE, PLEN)
+        np.random.seed(4)
+        stream = PileupStream(RATE, PLEN)
+        parts, tints = [], []
+        bounds = [0, 700, 701, 2000, 3000]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            newbatch, tint_array = stream.push(batch.take(np.arange(lo, hi)))
+            parts.append(newbatch)
+            tints.append(tint_array)
+        parts.append(stream.flush())
+        result = PulseBatch.concatenate(parts)
+        np.testing.assert_array_equal(np.concatenate(tints), expected_tint)
+        np.testing.assert_array_equal(result.offsets, expected.offsets)
+        for key in ['pileup', 'ptype']:
+            np.testing.assert_array_equal(result.meta[key], expected.meta[key])
+        np.testing.assert_allclose(result.values, expected.values, rtol = 0, atol = 1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
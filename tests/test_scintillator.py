@@ -0,0 +1,47 @@
+'''
+Tests of the sampling of the photon times (scintillator module): the
+continuous times drawn from the exponential components must have the
+distribution of the times sampled on the tabulated pulse shape.
+'''
+
+import os, sys, unittest
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from scintillator import load_coefficients, scintillator, decay_components, sample_times, sample_times_continuous
+
+PLEN = 640.
+
+class TestContinuousTimes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.coeff_dict = load_coefficients()
+
+    def _check(self, ptype):
+        t, amp = scintillator(ptype, self.coeff_dict, plen = PLEN, dt = 0.01) # fine grid: small snapping
+        decay = decay_components(ptype, self.coeff_dict, PLEN)
+        nphots = np.repeat(200, 100)
+        np.random.seed(1)
+        grid = sample_times(nphots, t, amp)
+        np.random.seed(2)
+        times = sample_times_continuous(nphots, decay, PLEN)
+        self.assertEqual(len(times), nphots.sum())
+        self.assertTrue(np.all((times >= 0) & (times < PLEN)))
+        self.assertGreater(stats.ks_2samp(times, grid)[1], 1e-3)
+
+        # analytic distribution: the truncated exponential components
+        tau, prob = decay
+        cdf = lambda x: np.sum(prob * -np.expm1(-np.asarray(x)[:,np.newaxis] / tau) / -np.expm1(-PLEN / tau), axis = 1)
+        self.assertGreater(stats.kstest(times, cdf)[1], 1e-3)
+
+    def test_electron(self):
+        self._check('electron')
+
+    def test_proton(self):
+        self._check('proton')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+Tests of the simulation service (service module) on a Unix socket.
+'''
+
+import os, sys, json, time, socket, shutil, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from service import serve, request
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.dir, 'dacsim.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_not_a_socket(self):
+        f = open(self.address, 'w')
+        f.write('{}')
+        f.close()
+        self.assertRaises(ValueError, serve, self.address)
+        self.assertTrue(os.path.isfile(self.address))
+
+    def test_invalid_requests(self):
+        thread = threading.Thread(target = serve, args = (self.address,))
+        thread.daemon = True # a hanging server fails the test instead of blocking it
+        thread.start()
+        try:
+            for i in range(100):
+                if os.path.exists(self.address):
+                    break
+                time.sleep(0.05)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(30)
+            sock.connect(self.address)
+            f = sock.makefile('rw')
+            try:
+                for line in ['[1]', '"x"', '{"command": "ping"}']:
+                    f.write(line + '\n')
+                    f.flush()
+                    response = json.loads(f.readline())
+                    self.assertEqual(response['status'], 'error' if line[0] != '{' else 'ok', line)
+            finally:
+                # the file keeps the connection open: close both, so that
+                # the server (one connection at a time) reads the shutdown
+                f.close()
+                sock.close()
+        finally:
+            request(self.address, {'command': 'shutdown'}, timeout = 30)
+            thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.address))
+
+if __name__ == '__main__':
+    unittest.main()
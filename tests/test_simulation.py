@@ -0,0 +1,126 @@
+'''
+Tests of the simulation module: the replay of single events of a
+simulation with counter-based random numbers (simulation.replay_event),
+the runs streamed in chunks (input "mem", simulation.run_stream), the
+runs on a process pool (input "nworkers", simulation.run_parallel) and
+the single precision acquisition chain (input "precision").
+'''
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+from scipy import stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from output import load_output
+from library import Simulation
+from simulation import generate_batch, particle_counts, apply_stage
+
+INPUT = {'nps': 300, 'ptype': 'all', 'cre': 200000, 'crp': 100000, 'output': 'test', 'dt': 0.05,
+         'lc': 0.7, 'qeff': 0.26, 'k': 10., 'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+         'cutoff': 0.2, 'imp': 50, 'noise': 0.01, 'bits': 12, 'minV': -0.1, 'maxV': 1.2,
+         'sampf': 0.4, 'samples': 256, 'th_on': 1, 'th_lvl': 50, 'pretrig_samp': 64,
+         'fp': 0, 'seed': 3, 'rng': 'counter'}
+
+class TestReplay(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+        cls.cwd = os.getcwd()
+        cls.dir = tempfile.mkdtemp()
+        os.chdir(cls.dir)
+        cls.header, cls.arrays = load_output(cls.sim.run(dict(INPUT))['path'])
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.dir)
+
+    def test_start(self):
+        row = int(np.flatnonzero(self.arrays['pileup_log'] > 0)[0]) # an event with pile-up
+        event = int(self.arrays['event'][row])
+        result = self.sim.replay(dict(INPUT), event)
+        self.assertTrue(result['triggered'])
+        np.testing.assert_array_equal(result['pulses'].as_matrix()[0], self.arrays['pulses'][row])
+
+    def test_not_start(self):
+        row = int(np.flatnonzero(self.arrays['pileup_log'] > 0)[0])
+        event = int(self.arrays['event'][row])
+        self.assertRaises(ValueError, self.sim.replay, dict(INPUT), event + 1) # piled up on event
+
+class TestRunModes(unittest.TestCase):
+    '''Runs of the same seed in memory, streamed in chunks and on a
+    process pool'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _run(self, **kwargs):
+        # one output per run: the arrays of the previous runs are memory-mapped
+        output = '_'.join(['test'] + ['%s%s' % item for item in sorted(kwargs.items())])
+        return load_output(self.sim.run(dict(INPUT, output = output, **kwargs))['path'])[1]
+
+    def _assert_same(self, arrays, expected):
+        self.assertEqual(sorted(arrays), sorted(expected))
+        for key in expected:
+            np.testing.assert_array_equal(arrays[key], expected[key], key)
+
+    def test_mem_counter(self):
+        # each random number depends on its pulse only: same output
+        self._assert_same(self._run(rng = 'counter', mem = 20), self._run(rng = 'counter'))
+
+    def test_mem(self):
+        # the stages draw in another order: same distributions
+        streamed = self._run(rng = 'numpy', nps = 1000, mem = 20)
+        expected = self._run(rng = 'numpy', nps = 1000)
+        self.assertGreater(stats.ks_2samp(streamed['pulses'].max(axis = 1), expected['pulses'].max(axis = 1))[1], 1e-3)
+        self.assertGreater(stats.ks_2samp(streamed['time_int'], expected['time_int'])[1], 1e-3)
+
+    def test_nworkers(self):
+        # the work units (at least 4 here) do not depend on the number of workers
+        expected = self._run(rng = 'numpy', nps = 1000, nworkers = 1)
+        for nworkers in [2, 3]:
+            self._assert_same(self._run(rng = 'numpy', nps = 1000, nworkers = nworkers), expected)
+
+    def test_nworkers_counter(self):
+        self._assert_same(self._run(rng = 'counter', nworkers = 2), self._run(rng = 'counter'))
+
+class TestPrecision(unittest.TestCase):
+    '''ADC codes of the single precision chain, within the bound of the
+    input "precision" (see dacsim)'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def test_codes(self):
+        for bits in [12, 14]:
+            inp = dict(INPUT, rng = 'numpy', nps = 500, bits = bits)
+            expected = self.sim.simulate(inp)['pulses'].as_matrix().astype(int)
+            codes = self.sim.simulate(dict(inp, precision = 'single'))['pulses'].as_matrix().astype(int)
+            self.assertEqual(codes.shape, expected.shape)
+            diff = np.abs(codes - expected)
+            self.assertLessEqual(diff.max(), 1)
+            self.assertLessEqual(np.mean(diff > 0), 2e-6 * 2**bits)
+
+    def test_dtype(self):
+        inp = dict(INPUT, rng = 'numpy', precision = 'single')
+        t, scint_dict = self.sim.shapes(inp)
+        batch = generate_batch(particle_counts(inp, 20), t, scint_dict, self.sim.energy, self.sim.intensity, inp)
+        for stage in ['pmt', 'cable', 'noise']:
+            batch = apply_stage(stage, batch, t, inp)[0]
+            self.assertEqual(batch.values.dtype, np.float32, stage)
+
+if __name__ == '__main__':
+    unittest.main()
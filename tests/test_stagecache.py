@@ -0,0 +1,113 @@
+'''
+Tests of the on-disk cache of the stage results (stagecache module): a
+run that starts from the cached results must give the same pulses as a
+run without the cache.
+'''
+
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from library import Simulation
+from stagecache import StageCache
+from sweep import run_point
+
+INPUT = {'nps': 300, 'ptype': 'all', 'cre': 200000, 'crp': 100000, 'output': 'test', 'dt': 0.05,
+         'lc': 0.7, 'qeff': 0.26, 'k': 10., 'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+         'cutoff': 0.2, 'imp': 50, 'noise': 0.01, 'bits': 12, 'minV': -0.1, 'maxV': 1.2,
+         'sampf': 0.4, 'samples': 256, 'th_on': 1, 'th_lvl': 50, 'pretrig_samp': 64,
+         'fp': 0, 'seed': 3}
+
+class TestCachedRerun(unittest.TestCase):
+    '''Reruns that change only the parameters of a later stage, reading the
+    results of the earlier stages from the cache (memory-mapped read-only)'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _rerun(self, start, **kwargs):
+        self.sim.simulate(dict(INPUT, cache = self.dir))
+        cached = self.sim.simulate(dict(INPUT, cache = self.dir, **kwargs))
+        self.assertEqual(cached['start'], start)
+        reference = self.sim.simulate(dict(INPUT, **kwargs))
+        np.testing.assert_array_equal(cached['pulses'].as_matrix(), reference['pulses'].as_matrix())
+        np.testing.assert_array_equal(cached['time_int'], reference['time_int'])
+
+    def test_threshold(self):
+        self._rerun('digitize', th_lvl = 80)
+
+    def test_cutoff(self):
+        self._rerun('cable', cutoff = 0.1)
+
+    def test_sigma(self):
+        self._rerun('analog', sigma = 4.)
+
+class _EvictedCache(StageCache):
+    '''A cache whose entries are removed by another process between the
+    test of the key and the load'''
+
+    def load(self, key):
+        self.remove(key)
+        return StageCache.load(self, key)
+
+class _RacingCache(StageCache):
+    '''A cache whose first test of a key misses, as if another process
+    stored the same result between the test and the rename'''
+
+    def __init__(self, path):
+        StageCache.__init__(self, path)
+        self.tested = False
+
+    def __contains__(self, key):
+        if not self.tested:
+            self.tested = True
+            return False
+        return StageCache.__contains__(self, key)
+
+class TestConcurrent(unittest.TestCase):
+    '''Several processes sharing a cache directory'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.result = {'x': np.arange(10.), 'n': 3}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_missing(self):
+        cache = StageCache(self.dir)
+        cache.store('key', self.result, 'pmt')
+        os.remove(os.path.join(self.dir, 'key', 'x.npy'))
+        state = np.random.get_state()
+        self.assertTrue(cache.load('key') is None)
+        self.assertTrue(cache.load('other') is None)
+        np.testing.assert_array_equal(np.random.get_state()[1], state[1])
+
+    def test_same_key(self):
+        StageCache(self.dir).store('key', self.result, 'pmt')
+        self.assertTrue(_RacingCache(self.dir).store('key', dict(self.result, n = 4), 'pmt'))
+        self.assertEqual(StageCache(self.dir).load('key')['n'], 3)
+        self.assertEqual(os.listdir(self.dir), ['key']) # no temporary directory left
+
+    def test_evicted(self):
+        inp = dict(INPUT, cache = self.dir)
+        self.sim.simulate(inp)
+        result, level = run_point(inp, self.sim.coeff_dict, self.sim.energy, self.sim.intensity, cache = _EvictedCache(self.dir))
+        self.assertEqual(level, 0)
+        reference = self.sim.simulate(dict(INPUT))
+        np.testing.assert_array_equal(result['batch'].as_matrix(), reference['pulses'].as_matrix())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+'''
+Tests of the sweeps of the input parameters (sweep module).
+'''
+
+import os, sys, json, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from output import load_output
+from library import Simulation
+
+INPUT = {'nps': 300, 'ptype': 'all', 'cre': 200000, 'crp': 100000, 'output': 'test', 'dt': 0.05,
+         'lc': 0.7, 'qeff': 0.26, 'k': 10., 'ndyn': 10, 'delta': 4, 'sigma': 5.2, 'tt': 17.5,
+         'cutoff': 0.2, 'imp': 50, 'noise': 0.01, 'bits': 12, 'minV': -0.1, 'maxV': 1.2,
+         'sampf': 0.4, 'samples': 256, 'th_on': 1, 'th_lvl': 50, 'pretrig_samp': 64,
+         'fp': 0, 'seed': 3}
+
+class TestSweep(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sim = Simulation()
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def _pulses(self, summary):
+        return [load_output(path)[1]['pulses'] for path in summary['paths']]
+
+    def test_seed(self):
+        inp_dict = dict(INPUT, sweep_seed = '1,2')
+        del inp_dict['seed']
+        first, second = self._pulses(self.sim.run(inp_dict))
+        self.assertFalse(first.shape == second.shape and np.all(first == second))
+        single = self.sim.run(dict(INPUT, seed = 2))
+        np.testing.assert_array_equal(second, load_output(single['path'])[1]['pulses'])
+
+    def test_shared_stages(self):
+        pulses = self._pulses(self.sim.run(dict(INPUT, sweep_cutoff = '0.1,0.2')))
+        single = self.sim.run(dict(INPUT, cutoff = 0.2))
+        np.testing.assert_array_equal(pulses[1], load_output(single['path'])[1]['pulses'])
+
+    def test_point_overrides(self):
+        fname = os.path.join(self.dir, 'points.json')
+        for point in [{'rng': 'counter'}, {'nworkers': 2}, {'waveforms': -1}]:
+            f = open(fname, 'w')
+            json.dump([{'delta': 3}, point], f)
+            f.close()
+            self.assertRaises(ValueError, self.sim.run, dict(INPUT, sweep = fname))
+
+if __name__ == '__main__':
+    unittest.main()